@@ -1,106 +1,182 @@
 #!/usr/bin/python3
 import sys
+import json
 import errno
-import serial
-import struct
+import argparse
+import uwf_image
+import uwf_plan
+import uwf_flash
+import uwf_link
+import uwf_journal
+import uwf_stats
 import uwf_processor
+import uwf_cache
+import uwf_gpio
 
 SERIAL_TIMEOUT = 1
 
 EXIT_CODE_SUCCESS = 0
 
-UWF_READ_SUCCESS = 1
-UWF_READ_DONE = 0
-UWF_COMMAND_HEADER_LENGTH = 6
-UWF_TARGET_PLATFORM_LENGTH = 4
-UWF_REGISTER_DEVICE_LENGTH = 11
-UWF_SELECT_DEVICE_LENGTH = 2
-UWF_SECTOR_MAP_LENGTH = 8
-UWF_ERASE_BLOCK_LENGTH = 8
-UWF_WRITE_BLOCK_LENGTH = 8
-UWF_UNREGISTER_DEVICE_LENGTH = 1
-
-UWF_OFFSET_HEADER_COMMAND_ID = 1
-UWF_OFFSET_HEADER_LENGTH_START = 2
-UWF_OFFSET_HEADER_LENGTH_END = 6
-
-UWF_COMMAND_TARGET_PLATFORM = 'T'
-UWF_COMMAND_REGISTER = 'G'
-UWF_COMMAND_SELECT = 'S'
-UWF_COMMAND_SECTOR_MAP = 'M'
-UWF_COMMAND_ERASE = 'E'
-UWF_COMMAND_WRITE = 'W'
-UWF_COMMAND_UNREGISTER = 'U'
+parser = argparse.ArgumentParser(prog='btpa_firmware_loader')
+parser.add_argument('port', help='serial port, or a comma separated list of ports to flash in parallel')
+parser.add_argument('baudrate', type=int)
+parser.add_argument('file_path', metavar='path to UWF file')
+parser.add_argument('type', metavar='device type', nargs='?', default=None)
+parser.add_argument('--base', metavar='PATH', default=None,
+	help='base UWF file that a delta image applies to (see uwf_delta)')
+parser.add_argument('--pipeline-window', type=int, default=0,
+	help='number of write/data pairs to keep in flight (0 disables pipelining)')
+parser.add_argument('--adaptive-verify', action='store_true',
+	help='adapt the verify interval to the link and resend failed windows instead of aborting')
+parser.add_argument('--differential', action='store_true',
+	help='only erase and rewrite sectors that do not already hold the image')
+parser.add_argument('--negotiate', action='store_true',
+	help='probe enhanced bootloaders for the fastest stable baudrate and write length and cache the result')
+parser.add_argument('--link-cache', default=uwf_link.LINK_CACHE_PATH,
+	help='file holding the negotiated link settings (default: %(default)s)')
+parser.add_argument('--retries', type=int, default=uwf_processor.SECTION_RETRY_LIMIT,
+	help='times a section failing with a link error is repeated in place (default: %(default)s)')
+parser.add_argument('--resume', action='store_true',
+	help='continue an interrupted flash of the same image from its last verified window')
+parser.add_argument('--journal-dir', default=None,
+	help='keep per-port progress journals in this directory (default: {} with --resume, none otherwise)'.format(uwf_journal.JOURNAL_DIR))
+parser.add_argument('--ready-timeout', type=float, default=uwf_processor.BOOTLOADER_READY_TIMEOUT_SEC,
+	help='seconds to wait for the bootloader to answer after the reset (default: %(default)s)')
+parser.add_argument('--gpio-backend', choices=[uwf_gpio.GPIO_BACKEND_AUTO, uwf_gpio.GPIO_BACKEND_CHARDEV, uwf_gpio.GPIO_BACKEND_SYSFS], default=uwf_gpio.GPIO_BACKEND_AUTO,
+	help='how the boot mode and reset lines are driven; auto prefers the GPIO character device (default: %(default)s)')
+parser.add_argument('--reset-pulse', type=float, default=uwf_gpio.GPIO_RESET_PULSE_SEC,
+	help='seconds the reset line is held low (default: %(default)s)')
+parser.add_argument('--reset-lines', metavar='PORT=BOOT_MODE_LINE,RESET_LINE', action='append', default=None,
+	help='GPIO lines of the module on PORT, for flashing several ports (default: {},{} for every port)'.format(*uwf_gpio.GPIO_LINES))
+parser.add_argument('--cache', action='store_true',
+	help='keep the section index and block checksums of the image in a cache keyed by its hash')
+parser.add_argument('--cache-dir', default=uwf_cache.IMAGE_CACHE_DIR,
+	help='directory of the image cache (default: %(default)s)')
+parser.add_argument('--cache-size', type=int, default=uwf_cache.IMAGE_CACHE_SIZE,
+	help='bytes the image cache may use before old entries are evicted (default: %(default)s)')
+parser.add_argument('--workers', type=int, default=None,
+	help='number of devices to flash at once when several ports are given, also with --asyncio (default: all)')
+parser.add_argument('--asyncio', action='store_true',
+	help='drive all ports from one asyncio event loop instead of a thread pool')
+parser.add_argument('--stats-json', metavar='PATH', default=None,
+	help='write per-phase and per-command timing statistics as JSON (- for stdout)')
+parser.add_argument('--progress', action='store_true',
+	help='show a live progress and throughput line on stderr')
+parser.add_argument('--verify', action='store_true',
+	help='audit only: verify the image on the device without writing and print a JSON pass/fail and mismatch report')
+parser.add_argument('--verify-min-window', type=int, default=uwf_processor.AUDIT_WINDOW_MIN,
+	help='smallest verify window a mismatch is narrowed down to, in bytes (default: %(default)s)')
+parser.add_argument('--dry-run', action='store_true',
+	help='validate the image and print the flash plan without touching the device')
 
 exit_code = EXIT_CODE_SUCCESS	# Success (for now)
 if len(sys.argv) >= 4:
-	port = sys.argv[1]
-	baudrate = int(sys.argv[2])
-	file_path = sys.argv[3]
-
-	if len(sys.argv) == 5:
-		type = sys.argv[4]
-	else:
-		type = None
+	args = parser.parse_args()
+	ports = args.port.split(',')
+	baudrate = args.baudrate
+	file_path = args.file_path
+	type = args.type
 
 	try:
-		# Open the UWF file
-		f = open(file_path,'rb')
-	except IOError as i:
+		# Open and index the UWF file
+		image = uwf_image.UwfImage(file_path, args.base, not args.cache)
+	except (IOError, OSError) as i:
 		# Failed to open the file
 		sys.stderr.write('{}\n'.format(i))
 		exit_code = errno.ENOENT
 	else:
-		if f.mode == 'rb':
-			# Initialize the processor
+		# Restore or build the section index and checksum tables
+		checksum_tables = None
+		if args.cache:
+			checksum_tables = uwf_cache.ImageCache(args.cache_dir, args.cache_size).load(image)
+
+		# Reject a malformed image before touching the bootloader
+		error = image.validate()
+		if error == None:
+			plan = uwf_plan.compile_flash_plan(image)
+			sys.stderr.write(''.join(plan.warnings))
+			if plan.errors:
+				error = ''.join(plan.errors)
+			if args.dry_run:
+				sys.stdout.write(plan.describe(baudrate))
+				# The bootloader version is only known once connected; an enhanced one
+				# switches to its own baudrate, write length and erase size
+				enhanced_plan = uwf_plan.compile_flash_plan(image, uwf_processor.ENHANCED_WRITE_BLOCK_SIZE, plan.verify_write_limit, True)
+				sys.stdout.write('enhanced bootloader: {}\n'.format(enhanced_plan.describe_estimate(max(baudrate, uwf_processor.ENHANCED_BAUDRATE))))
+
+		if error == None:
 			try:
-				processor = uwf_processor.init_processor(type, port, baudrate)
-				status = UWF_READ_SUCCESS
-				while (status == UWF_READ_SUCCESS):
-					# Read the next section (in bytes)
-					bytes = f.read(UWF_COMMAND_HEADER_LENGTH)
-					if bytes:
-						cmd = bytes[:UWF_OFFSET_HEADER_COMMAND_ID].decode('utf-8')
-						data_length = struct.unpack('<I', bytes[UWF_OFFSET_HEADER_LENGTH_START:UWF_OFFSET_HEADER_LENGTH_END])[0]
+				port_reset_lines = uwf_gpio.parse_reset_lines(args.reset_lines)
+				# Resetting one module must not reset another one being flashed
+				error = uwf_flash.check_ports(ports, type, {'port_reset_lines': port_reset_lines})
+			except ValueError as v:
+				error = '{}\n'.format(v)
+
+		if error != None:
+			sys.stderr.write(error)
+			exit_code = errno.EINVAL
+		elif args.dry_run:
+			pass
+		else:
+			options = {
+				'pipeline_window': args.pipeline_window,
+				'adaptive_verify': args.adaptive_verify,
+				'differential': args.differential,
+				'negotiate': args.negotiate,
+				'journal_dir': args.journal_dir,
+				'resume': args.resume,
+				'ready_timeout': args.ready_timeout,
+				'gpio_backend': args.gpio_backend,
+				'reset_pulse': args.reset_pulse,
+				'port_reset_lines': port_reset_lines,
+				'section_retries': args.retries,
+				'checksum_tables': checksum_tables,
+			}
+			if args.negotiate:
+				options['link_cache'] = uwf_link.LinkCache(args.link_cache)
+
+			# Instrumentation is only installed when a report or progress line is wanted
+			collector = None
+			if args.stats_json != None or args.progress:
+				collector = uwf_stats.StatsCollector(args.progress)
 
-						if cmd == UWF_COMMAND_TARGET_PLATFORM and data_length == UWF_TARGET_PLATFORM_LENGTH:
-							error = processor.process_command_target_platform(f, data_length)
-						elif cmd == UWF_COMMAND_REGISTER and data_length == UWF_REGISTER_DEVICE_LENGTH:
-							error = processor.process_command_register_device(f, data_length)
-						elif cmd == UWF_COMMAND_SELECT and data_length == UWF_SELECT_DEVICE_LENGTH:
-							error = processor.process_command_select_device(f, data_length)
-						elif cmd == UWF_COMMAND_SECTOR_MAP and data_length == UWF_SECTOR_MAP_LENGTH:
-							error = processor.process_command_sector_map(f, data_length)
-						elif cmd == UWF_COMMAND_ERASE and data_length == UWF_ERASE_BLOCK_LENGTH:
-							error = processor.process_command_erase_blocks(f, data_length)
-						elif cmd == UWF_COMMAND_WRITE and data_length >= UWF_WRITE_BLOCK_LENGTH:
-							error = processor.process_command_write_blocks(f, data_length)
-						elif cmd == UWF_COMMAND_UNREGISTER and data_length == UWF_UNREGISTER_DEVICE_LENGTH:
-							error = processor.process_command_unregister(f, data_length)
-						else:
-							# Unknown command; read to the next section and continue
-							f.read(data_length)
-							status = UWF_READ_SUCCESS
+			if args.verify:
+				# Verify only; the thread pool is used with or without --asyncio
+				options['audit_min_window'] = max(1, args.verify_min_window)
+				results, elapsed = uwf_flash.audit_devices(image, plan, ports, baudrate, type, options, args.workers)
+				json.dump(uwf_flash.audit_report(image, results, elapsed), sys.stdout, indent=2)
+				sys.stdout.write('\n')
+				for result in results:
+					if result.exit_code != EXIT_CODE_SUCCESS:
+						exit_code = result.exit_code
+						break
+			elif len(ports) == 1:
+				if args.asyncio:
+					results, elapsed = uwf_flash.flash_devices_async(image, plan, ports, baudrate, type, options, args.workers, collector)
+					result = results[0]
+				else:
+					result = uwf_flash.flash_device(image, plan, ports[0], baudrate, type, options, collector)
+				if result.error != None:
+					sys.stderr.write(result.error)
+				exit_code = result.exit_code
+			else:
+				# Flash every port concurrently from the one parsed image
+				if args.asyncio:
+					results, elapsed = uwf_flash.flash_devices_async(image, plan, ports, baudrate, type, options, args.workers, collector)
+				else:
+					results, elapsed = uwf_flash.flash_devices(image, plan, ports, baudrate, type, options, args.workers, collector)
+				sys.stdout.write(uwf_flash.format_results(results, elapsed))
+				for result in results:
+					if result.exit_code != EXIT_CODE_SUCCESS:
+						exit_code = result.exit_code
+						break
 
-						if error != None:
-							processor.process_reboot()
-							status = UWF_READ_DONE
-							sys.stderr.write(error)
-							exit_code = errno.EPERM
-					else:
-						# Reached the end of the file
-						processor.process_reboot()
-						status = UWF_READ_DONE
-			except serial.SerialException as s:
-				sys.stderr.write('{}\n'.format(s))
-				exit_code = errno.ENETUNREACH
-			except Exception as e:
-				sys.stderr.write('{}\n'.format(e))
-				exit_code = errno.EPERM
+			if args.stats_json != None:
+				collector.write_json(args.stats_json)
 		# Close the local file
-		f.close()
+		image.close()
 else:
-	print('usage: btpa_firmware_loader <port> <baudrate> <path to UWF file> [device type]\n')
+	print('usage: btpa_firmware_loader <port>[,<port>...] <baudrate> <path to UWF file> [device type] [--base <path>] [--pipeline-window <pairs>] [--adaptive-verify] [--differential] [--negotiate] [--link-cache <path>] [--retries <n>] [--resume] [--journal-dir <path>] [--ready-timeout <seconds>] [--gpio-backend auto|chardev|sysfs] [--reset-pulse <seconds>] [--reset-lines <port>=<boot mode line>,<reset line>] [--cache] [--cache-dir <path>] [--cache-size <bytes>] [--workers <n>] [--asyncio] [--stats-json <path>] [--progress] [--verify] [--verify-min-window <bytes>] [--dry-run]\n')
 	exit_code = errno.EINVAL
 
 sys.exit(exit_code)
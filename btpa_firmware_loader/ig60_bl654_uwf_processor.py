@@ -1,18 +1,126 @@
-import dbus
-import struct
+import threading
+import xml.etree.ElementTree
+import uwf_errors
 from uwf_processor import UwfProcessor
+from uwf_processor import ERROR_BOOTLOADER
 from uwf_processor import ERROR_REGISTER_DEVICE
-from uwf_processor import UWF_OFFSET_ERASE_START_ADDR
-from uwf_processor import UWF_OFFSET_ERASE_SIZE
-from uwf_processor import COMMAND_ERASE_SECTOR
-from uwf_processor import RESPONSE_ACKNOWLEDGE
-from uwf_processor import RESPONSE_ACKNOWLEDGE_SIZE
-from uwf_processor import ERROR_ERASE_BLOCKS
+from uwf_async_processor import AsyncUwfProcessor
 
 BT_BOOTLOADER_MODE = 0
 BT_SMART_BASIC_MODE = 1
 
-FUP_OPTION_CURRENT_ERASE_LEN_BYTES = 0x0000
+DEVICE_SERVICE_NAME = 'com.lairdtech.device.DeviceService'
+DEVICE_SERVICE_PATH = '/com/lairdtech/device/DeviceService'
+DEVICE_SERVICE_INTERFACE = 'com.lairdtech.device.public.DeviceInterface'
+
+# DeviceService signals that report a boot mode change contain this in their
+# name; their first argument is the new boot mode
+DEVICE_SERVICE_BOOT_MODE_KEYWORD = 'bootmode'
+
+# Wait for the DeviceService to signal a boot mode change before going on without it
+BOOT_MODE_SIGNAL_TIMEOUT_SEC = 2
+
+class DeviceServiceBus():
+	"""
+	The system bus connection and DeviceService interface shared by every
+	IG60 processor. With the GLib main loop integration of dbus-python
+	installed, the boot mode signals the service declares are listed in
+	'signals' and dispatched by 'loop_thread', a daemon thread running the
+	GLib main loop for the rest of the process; without it 'signals' is
+	empty and there is no loop thread
+	"""
+	instance = None
+	lock = threading.Lock()
+
+	def __init__(self):
+		import dbus
+
+		try:
+			from dbus.mainloop.glib import DBusGMainLoop
+			from dbus.mainloop.glib import threads_init
+			from gi.repository import GLib
+		except ImportError:
+			GLib = None
+
+		self.condition = threading.Condition()
+		self.events = 0
+		self.boot_mode = None
+		self.signals = []
+		self.loop_thread = None
+		if GLib is None:
+			self.bus = dbus.SystemBus()
+		else:
+			threads_init()
+			self.bus = dbus.SystemBus(mainloop=DBusGMainLoop())
+
+		device = self.bus.get_object(DEVICE_SERVICE_NAME, DEVICE_SERVICE_PATH)
+		self.device_svc = dbus.Interface(device, DEVICE_SERVICE_INTERFACE)
+		if GLib is not None:
+			self.subscribe(device)
+			if self.signals:
+				# Signal handlers run on this thread; wait() is called from the processors'
+				self.loop_thread = threading.Thread(target=GLib.MainLoop().run, name='dbus-glib', daemon=True)
+				self.loop_thread.start()
+
+	@classmethod
+	def shared(cls):
+		with cls.lock:
+			if cls.instance is None:
+				cls.instance = cls()
+			return cls.instance
+
+	def subscribe(self, device):
+		"""
+		Listens to the boot mode signals that the service declares (older
+		DeviceService versions have none)
+		"""
+		try:
+			introspection = device.Introspect(dbus_interface='org.freedesktop.DBus.Introspectable')
+			root = xml.etree.ElementTree.fromstring(str(introspection))
+		except Exception:
+			return
+
+		for interface in root.findall('interface'):
+			if interface.get('name') == DEVICE_SERVICE_INTERFACE:
+				for signal in interface.findall('signal'):
+					name = signal.get('name')
+					if DEVICE_SERVICE_BOOT_MODE_KEYWORD in name.lower():
+						self.bus.add_signal_receiver(self.on_signal, signal_name=name,
+							dbus_interface=DEVICE_SERVICE_INTERFACE, path=DEVICE_SERVICE_PATH, member_keyword='member')
+						self.signals.append(name)
+
+	def on_signal(self, *args, **keywords):
+		"""
+		Records the boot mode reported by a boot mode signal; other signals
+		and signals without a boot mode are ignored
+		"""
+		member = keywords.get('member')
+		if member is None or DEVICE_SERVICE_BOOT_MODE_KEYWORD not in member.lower() or not args:
+			return
+		try:
+			boot_mode = int(args[0])
+		except (TypeError, ValueError):
+			return
+
+		with self.condition:
+			self.events += 1
+			self.boot_mode = boot_mode
+			self.condition.notify_all()
+
+	def mark(self):
+		"""
+		Returns the signal count to pass to wait()
+		"""
+		with self.condition:
+			return self.events
+
+	def wait(self, mark, boot_mode, timeout):
+		"""
+		Waits until a signal after mark() returned 'mark' reports 'boot_mode'
+		Returns False on timeout
+		"""
+		with self.condition:
+			return self.condition.wait_for(lambda: self.events != mark and self.boot_mode == boot_mode, timeout)
 
 class Ig60Bl654UwfProcessor(UwfProcessor):
 	"""
@@ -24,94 +132,70 @@ class Ig60Bl654UwfProcessor(UwfProcessor):
 		UwfProcessor.__init__(self, port, baudrate)
 
 		# Setup the DBus connection to the device service
-		self.bus = dbus.SystemBus()
-		self.device_svc = dbus.Interface(self.bus.get_object('com.lairdtech.device.DeviceService',
-			'/com/lairdtech/device/DeviceService'), 'com.lairdtech.device.public.DeviceInterface')
+		self.service_bus = None
+		self.boot_mode_timeout = BOOT_MODE_SIGNAL_TIMEOUT_SEC
+		try:
+			self.device_svc = self.connect_device_service()
+		except Exception:
+			self.port_close()
+			raise
 
 		# Expected registration values for an IG60 BL654
 		self.expected_handle = 0
 		self.expected_num_banks = 1
 		self.expected_bank_algo = 1
 
-	def enter_bootloader(self):
-		success = False
+	def connect_device_service(self):
+		"""
+		Returns the DBus interface of the device service
+		"""
+		self.service_bus = DeviceServiceBus.shared()
+		self.bus = self.service_bus.bus
+		return self.service_bus.device_svc
 
-		# Enter the bootloader via the Device Service
-		if self.device_svc.SetBtBootMode(BT_BOOTLOADER_MODE) != 0:
-			raise Exception('Failed to enter bootloader via smartBASIC and DBus')
-		else:
-			success = True
+	def set_boot_mode(self, mode):
+		"""
+		Sets the BT boot mode via the Device Service and, when it signals boot
+		mode changes, waits up to 'boot_mode_timeout' for the signal of this mode
+		Returns the result of SetBtBootMode
+		"""
+		if self.service_bus is None or not self.service_bus.signals:
+			return self.device_svc.SetBtBootMode(mode)
 
-			# Clear the serial line before starting
-			self.ser.readline()
+		mark = self.service_bus.mark()
+		result = self.device_svc.SetBtBootMode(mode)
+		if result == 0:
+			# A missing signal is not an error: the bootloader is polled for anyway
+			self.service_bus.wait(mark, mode, self.boot_mode_timeout)
+		return result
 
-		return success
+	def reset_into_bootloader(self):
+		# Enter the bootloader via the Device Service
+		if self.set_boot_mode(BT_BOOTLOADER_MODE) != 0:
+			raise uwf_errors.DeviceError(ERROR_BOOTLOADER.format('Failed to enter bootloader via smartBASIC and DBus'))
 
-	def process_command_register_device(self, file, data_length):
+	def process_command_register_device(self, data):
 		error = None
 
-		UwfProcessor.process_command_register_device(self, file, data_length)
+		UwfProcessor.process_command_register_device(self, data)
 
 		# Validate the registration data
 		if self.handle == self.expected_handle and self.num_banks == self.expected_num_banks and self.bank_size > 0 and self.bank_algo == self.expected_bank_algo:
 			self.registered = True
 		else:
-			error = ERROR_REGISTER_DEVICE.format('Unexpected registration data')
+			error = uwf_errors.DeviceError(ERROR_REGISTER_DEVICE.format('Unexpected registration data'))
 			self.registered = False
 
 		return error
 
-	def process_command_erase_blocks(self, file, data_length):
-		"""
-		In enhanced bootloader mode, if total erase size is factor of 64k, erase block size is 64k
-		Else, erase block according to the sector size value from the the UWF file
-		"""
-		error = None
-		erase_mode_64k = False
-		erase_block_64k = 0x10000
-
-		if self.synchronized and self.registered and self.sectors > 0 and self.sector_size > 0:
-			# Get the UWF erase data
-			erase_data = file.read(data_length)
-			start = self.base_address + struct.unpack('<I', erase_data[:UWF_OFFSET_ERASE_START_ADDR])[0]
-			size = struct.unpack('<I', erase_data[UWF_OFFSET_ERASE_START_ADDR:UWF_OFFSET_ERASE_SIZE])[0]
-
-			# Check if 64k erase block size can be used
-			if self.enhanced_mode and (size % erase_block_64k == 0):
-				UwfProcessor.process_setting_set(self, FUP_OPTION_CURRENT_ERASE_LEN_BYTES, 0x2)
-				erase_mode_64k = True
-
-			if size < self.bank_size:
-				erase_command = bytearray(COMMAND_ERASE_SECTOR, 'utf-8')
-				while size > 0:
-					erase_sector = struct.pack('<I', start)
-					if erase_mode_64k:
-						erase_block_size = struct.pack('<I',0x2)
-						port_cmd_bytes = erase_command + erase_sector + erase_block_size
-					else:
-						port_cmd_bytes = erase_command + erase_sector
-					response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-					if response.decode('utf-8') != RESPONSE_ACKNOWLEDGE:
-						error = ERROR_ERASE_BLOCKS.format('Non-ack to erase command')
-						break
-					if erase_mode_64k:
-						start += erase_block_64k
-						size -= erase_block_64k
-					else:
-						start += self.sector_size
-						size -= self.sector_size
-				else:
-					self.erased = True
-			else:
-				error = ERROR_ERASE_BLOCKS.format('Erase block size > bank size')
-		else:
-			error = ERROR_ERASE_BLOCKS.format('Target platform, register device, or sector map commands not yet processed')
-
-		return error
+	def reset_into_firmware(self):
+		# Use the device service to return the bt_boot_mode to smartBASIC; waiting
+		# for its signal keeps a following operation from racing the restart
+		self.set_boot_mode(BT_SMART_BASIC_MODE)
 
-	def process_reboot(self):
-		# Use the device service to return the bt_boot_mode to smartBASIC
-		self.device_svc.SetBtBootMode(BT_SMART_BASIC_MODE)
-
-		# Cleanup
-		self.ser.close()
+class AsyncIg60Bl654UwfProcessor(AsyncUwfProcessor, Ig60Bl654UwfProcessor):
+	"""
+	asyncio version of Ig60Bl654UwfProcessor; the IG60 hooks come from
+	Ig60Bl654UwfProcessor and the I/O hooks from AsyncUwfProcessor
+	"""
+	pass
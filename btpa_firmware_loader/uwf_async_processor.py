@@ -0,0 +1,193 @@
+import os
+import asyncio
+from uwf_processor import UwfProcessor
+from uwf_processor import DEVICE_TYPE_IG60
+from uwf_processor import SERIAL_TIMEOUT_SEC
+from uwf_processor import BOOTLOADER_READY_TIMEOUT_SEC
+from uwf_processor import GPIO_BACKEND_AUTO
+from uwf_processor import GPIO_RESET_PULSE_SEC
+from uwf_processor import GPIO_LINES
+from uwf_processor import RESPONSE_ACKNOWLEDGE
+from uwf_processor import RESPONSE_ACKNOWLEDGE_SIZE
+
+TRANSPORT_READ_SIZE = 4096
+
+async def init_async_processor(type, port, baudrate, ready_timeout=BOOTLOADER_READY_TIMEOUT_SEC,
+		gpio_backend=GPIO_BACKEND_AUTO, reset_pulse=GPIO_RESET_PULSE_SEC, reset_lines=GPIO_LINES):
+	"""
+	Instantiates the requested asyncio processor and enters its bootloader
+	Must be called from a running event loop
+	"""
+	if type == DEVICE_TYPE_IG60:
+		# Import the IG60 custom processor
+		from ig60_bl654_uwf_processor import AsyncIg60Bl654UwfProcessor
+
+		processor = AsyncIg60Bl654UwfProcessor(port, baudrate)
+	else:
+		processor = AsyncUwfProcessor(port, baudrate)
+
+	processor.ready_timeout = ready_timeout
+	processor.gpio_backend = gpio_backend
+	processor.reset_pulse = reset_pulse
+	processor.reset_lines = reset_lines
+	try:
+		await processor.enter_bootloader()
+	except Exception:
+		processor.close()
+		raise
+
+	return processor
+
+class AsyncSerialTransport():
+	"""
+	Awaitable reads, writes and command/response exchanges on an open pyserial
+	port. The port's file descriptor is switched to non-blocking mode and
+	serviced by the event loop, so one loop can drive many ports
+	"""
+	def __init__(self, ser):
+		self.ser = ser
+		self.loop = asyncio.get_running_loop()
+		self.buffer = bytearray()
+		self.waiter = None
+
+		self.fd = ser.fileno()
+		os.set_blocking(self.fd, False)
+		self.loop.add_reader(self.fd, self.on_readable)
+
+	def on_readable(self):
+		try:
+			data = os.read(self.fd, TRANSPORT_READ_SIZE)
+		except BlockingIOError:
+			return
+
+		self.buffer += data
+		if self.waiter is not None and not self.waiter.done():
+			self.waiter.set_result(None)
+
+	async def wait_for_data(self, deadline):
+		self.waiter = self.loop.create_future()
+		try:
+			await asyncio.wait_for(self.waiter, max(0, deadline - self.loop.time()))
+		except asyncio.TimeoutError:
+			pass
+		finally:
+			self.waiter = None
+
+	async def read(self, size, timeout=SERIAL_TIMEOUT_SEC):
+		"""
+		Returns 'size' bytes, or fewer if the timeout expires first (like a pyserial read)
+		"""
+		deadline = self.loop.time() + timeout
+		while len(self.buffer) < size and self.loop.time() < deadline:
+			await self.wait_for_data(deadline)
+
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return data
+
+	async def readline(self, timeout=SERIAL_TIMEOUT_SEC):
+		"""
+		Returns the next line including its newline, or whatever arrived before the timeout
+		"""
+		deadline = self.loop.time() + timeout
+		while b'\n' not in self.buffer and self.loop.time() < deadline:
+			await self.wait_for_data(deadline)
+
+		end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+		data = bytes(self.buffer[:end])
+		del self.buffer[:end]
+		return data
+
+	async def write(self, data):
+		view = memoryview(data)
+		while len(view):
+			try:
+				view = view[os.write(self.fd, view):]
+			except BlockingIOError:
+				pass
+
+			if len(view):
+				# Wait until the kernel buffer drains
+				writable = self.loop.create_future()
+				self.loop.add_writer(self.fd, writable.set_result, None)
+				try:
+					await writable
+				finally:
+					self.loop.remove_writer(self.fd)
+
+	async def exchange(self, data, resp_size):
+		await self.write(data)
+		return await self.read(resp_size)
+
+	def reset_input_buffer(self):
+		self.buffer = bytearray()
+		self.ser.reset_input_buffer()
+
+	def set_baudrate(self, baudrate):
+		self.ser.baudrate = baudrate
+
+	def close(self):
+		if self.fd is not None:
+			self.loop.remove_reader(self.fd)
+			self.fd = None
+
+class AsyncUwfProcessor(UwfProcessor):
+	"""
+	asyncio version of UwfProcessor: the protocol steps are shared and run()
+	drives them with awaitable I/O, so the entry points (enter_bootloader,
+	process_image, audit_image, process_reboot...) are awaited. Blocking calls
+	(GPIO, DBus, journal files) run in the event loop's default executor
+	"""
+	def __init__(self, port, baudrate):
+		# None until the port is open; a subclass failing in its __init__ closes the port without it
+		self.transport = None
+		super().__init__(port, baudrate)
+		self.transport = AsyncSerialTransport(self.ser)
+
+	async def run(self, steps):
+		response = None
+		error = None
+		while True:
+			try:
+				if error is not None:
+					request = steps.throw(error)
+				else:
+					request = steps.send(response)
+			except StopIteration as stop:
+				return stop.value
+
+			error = None
+			try:
+				response = await getattr(self, request[0])(*request[1:])
+			except Exception as e:
+				error = e
+
+	async def write_to_comm(self, data, resp_size):
+		return await self.transport.exchange(data, resp_size)
+
+	async def write_frame(self, data):
+		await self.transport.write(data)
+
+	async def read_port(self, size, timeout=None):
+		return await self.transport.read(size, SERIAL_TIMEOUT_SEC if timeout is None else timeout)
+
+	async def read_acks(self, count):
+		response = await self.transport.read(count * RESPONSE_ACKNOWLEDGE_SIZE)
+		return response == bytearray(RESPONSE_ACKNOWLEDGE * count, 'utf-8')
+
+	async def reset_input(self):
+		self.transport.reset_input_buffer()
+
+	async def set_port_baudrate(self, baudrate):
+		self.transport.set_baudrate(baudrate)
+
+	async def sleep(self, seconds):
+		await asyncio.sleep(seconds)
+
+	async def call(self, function, *args):
+		return await self.transport.loop.run_in_executor(None, function, *args)
+
+	def port_close(self):
+		if self.transport is not None:
+			self.transport.close()
+		super().port_close()
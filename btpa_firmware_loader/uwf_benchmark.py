@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the firmware loader: microbenchmarks of the hot paths and
+whole-image flashing against the simulated bootloader (uwf_simulator)
+
+usage: uwf_benchmark.py [checksum|encode|flash|all] [--iterations <n>] [--size <bytes>]
+	[--time-scale <factor>] [--error-rate <probability>] [--type IG60]
+"""
+import os
+import time
+import struct
+import timeit
+import argparse
+import tempfile
+import uwf_checksum
+import uwf_protocol
+import uwf_image
+import uwf_plan
+import uwf_simulator
+import uwf_errors
+
+BENCH_ITERATIONS = 200
+
+# Size of the synthetic image flashed by the flash benchmark
+FLASH_IMAGE_SIZE = 0x40000
+
+# Flash scenarios: name, bootloader version and processor options
+FLASH_SCENARIOS = [
+	('legacy', uwf_simulator.VERSION_LEGACY, {}),
+	('legacy pipelined', uwf_simulator.VERSION_LEGACY, {'pipeline_window': 8}),
+	('enhanced', uwf_simulator.VERSION_ENHANCED, {}),
+	('enhanced pipelined', uwf_simulator.VERSION_ENHANCED, {'pipeline_window': 8}),
+]
+
+CHECKSUM_BLOCK_SIZES = [252, 1024, 4096, 8192, 16384, 65536]
+
+def legacy_checksum(data):
+	# Per-byte loop the data command used before uwf_checksum
+	i = 0
+	checksum = 0
+	while i < len(data):
+		checksum += struct.unpack('B', data[i:i+1])[0]
+		i += 1
+	return checksum
+
+def legacy_write_command(offset, bytes_to_write, enhanced_mode):
+	# Write command as built before uwf_protocol
+	write_command = bytearray('w', 'utf-8')
+	start_addr = struct.pack('<I', offset)
+	if enhanced_mode:
+		data_block_size_l = struct.pack('B', bytes_to_write & 0xff)
+		data_block_size_h = struct.pack('B', (bytes_to_write & 0xff00) >> 8)
+		return write_command + start_addr + data_block_size_l + data_block_size_h
+	else:
+		data_block_size = struct.pack('B', bytes_to_write)
+		return write_command + start_addr + data_block_size
+
+def legacy_data_command(data):
+	checksum = uwf_checksum.checksum(data)
+	port_cmd_bytes = bytearray(len(data) + 2)
+	port_cmd_bytes[0] = ord('d')
+	port_cmd_bytes[1:-1] = data
+	port_cmd_bytes[-1] = checksum & 0xff
+	return port_cmd_bytes, checksum
+
+def legacy_verify_command(start, size, checksum):
+	verify_command = bytearray('v', 'utf-8')
+	verify_start_addr = struct.pack('<I', start)
+	verify_data_block_size_bytes = struct.pack('<I', size)
+	verify_checksum_bytes = struct.pack('<I', checksum)
+	return verify_command + verify_start_addr + verify_data_block_size_bytes + verify_checksum_bytes
+
+def legacy_erase_command(start):
+	erase_command = bytearray('e', 'utf-8')
+	erase_sector = struct.pack('<I', start)
+	return erase_command + erase_sector
+
+def legacy_setting_command(fup_option, set_value):
+	command = bytearray('s', 'utf-8')
+	command.append(fup_option & 0xff)
+	command.append((fup_option & 0xff00) >> 8)
+	command.append(set_value & 0xff)
+	command.append(0x00)
+	command.append(0x00)
+	command.append(0x00)
+	return command
+
+def bench(stmt, iterations):
+	"""
+	Returns the best time per call (in seconds) of the given callable
+	"""
+	return min(timeit.repeat(stmt, number=iterations, repeat=3)) / iterations
+
+def bench_checksum(iterations):
+	print('checksum (numpy {})'.format('available' if uwf_checksum.numpy is not None else 'not available'))
+	print('{:>8} {:>12} {:>12} {:>9}'.format('bytes', 'legacy us', 'engine us', 'speedup'))
+	for size in CHECKSUM_BLOCK_SIZES:
+		data = os.urandom(size)
+		legacy = bench(lambda: legacy_checksum(data), max(1, iterations // 10))
+		engine = bench(lambda: uwf_checksum.checksum(data), iterations)
+		print('{:>8} {:>12.1f} {:>12.1f} {:>8.0f}x'.format(size, legacy * 1e6, engine * 1e6, legacy / engine))
+
+def bench_encode(iterations):
+	encoder = uwf_protocol.ProtocolEncoder()
+	block = os.urandom(252)
+	enhanced_block = os.urandom(8192)
+	packets = [
+		('write', lambda: legacy_write_command(0x1000, 252, False), lambda: encoder.write(0x1000, 252, False)),
+		('write enhanced', lambda: legacy_write_command(0x1000, 8192, True), lambda: encoder.write(0x1000, 8192, True)),
+		('data 252', lambda: legacy_data_command(block), lambda: encoder.data(block)),
+		('data 8192', lambda: legacy_data_command(enhanced_block), lambda: encoder.data(enhanced_block)),
+		('verify', lambda: legacy_verify_command(0x1000, 2016, 0x12345), lambda: encoder.verify(0x1000, 2016, 0x12345)),
+		('erase', lambda: legacy_erase_command(0x1000), lambda: encoder.erase(0x1000)),
+		('setting', lambda: legacy_setting_command(0x0005, 0xa), lambda: encoder.setting(0x0005, 0xa)),
+	]
+
+	print('encode (per packet)')
+	print('{:<16} {:>12} {:>12} {:>9}'.format('packet', 'legacy ns', 'encoder ns', 'speedup'))
+	for name, legacy_encode, encode in packets:
+		legacy = bench(legacy_encode, iterations * 50)
+		encoded = bench(encode, iterations * 50)
+		print('{:<16} {:>12.0f} {:>12.0f} {:>8.1f}x'.format(name, legacy * 1e9, encoded * 1e9, legacy / encoded))
+
+def flash_simulated(image, plan, version, options, time_scale, error_rate, type=None):
+	"""
+	Flashes the image on a fresh simulated bootloader
+	Returns the error, the elapsed seconds and the simulator
+	"""
+	simulator = uwf_simulator.SimulatedBootloader(version=version, time_scale=time_scale,
+		data_error_rate=error_rate, seed=0)
+
+	start = time.time()
+	processor = uwf_simulator.init_simulated_processor(simulator, type)
+	processor.plan = plan
+	for name, value in options.items():
+		setattr(processor, name, value)
+	error = None
+	try:
+		processor.process_image(image)
+	except uwf_errors.FlashError as f:
+		error = '{}'.format(f)
+	processor.process_reboot()
+
+	return error, time.time() - start, simulator
+
+def bench_flash(size, time_scale, error_rate, type=None):
+	with tempfile.NamedTemporaryFile(suffix='.uwf') as f:
+		f.write(uwf_simulator.build_image(os.urandom(size)))
+		f.flush()
+		image = uwf_image.UwfImage(f.name)
+		plan = uwf_plan.compile_flash_plan(image)
+
+		print('flash {} bytes (time scale {}, data error rate {})'.format(size, time_scale, error_rate))
+		print('{:<20} {:>9} {:>10} {:>12} {:>7} {:>8}'.format('scenario', 'result', 'seconds', 'bytes/s', 'trips', 'errors'))
+		for name, version, options in FLASH_SCENARIOS:
+			error, seconds, simulator = flash_simulated(image, plan, version, options, time_scale, error_rate, type)
+			print('{:<20} {:>9} {:>10.2f} {:>12.0f} {:>7} {:>8}'.format(name, 'ok' if error == None else 'failed',
+				seconds, size / seconds, simulator.round_trips, simulator.errors))
+			if error != None:
+				print('  {}'.format(error.strip()))
+
+		image.close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Firmware loader benchmarks')
+	parser.add_argument('suite', nargs='?', choices=['checksum', 'encode', 'flash', 'all'], default='all')
+	parser.add_argument('--iterations', type=int, default=BENCH_ITERATIONS,
+		help='calls per checksum measurement, and 50 times as many per encode measurement (default: %(default)s)')
+	parser.add_argument('--size', type=int, default=FLASH_IMAGE_SIZE,
+		help='payload bytes of the flashed image (default: %(default)s)')
+	parser.add_argument('--time-scale', type=float, default=1.0,
+		help='factor applied to every simulated delay; below 1 runs faster than a real link (default: %(default)s)')
+	parser.add_argument('--error-rate', type=float, default=0.0,
+		help='probability of the simulator refusing a data block (default: %(default)s)')
+	parser.add_argument('--type', default=None,
+		help='processor type, e.g. IG60')
+	args = parser.parse_args()
+
+	if args.suite in ('checksum', 'all'):
+		bench_checksum(args.iterations)
+	if args.suite in ('encode', 'all'):
+		bench_encode(args.iterations)
+	if args.suite in ('flash', 'all'):
+		bench_flash(args.size, args.time_scale, args.error_rate, args.type)
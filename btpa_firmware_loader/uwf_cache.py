@@ -0,0 +1,142 @@
+import os
+import json
+import uwf_checksum
+import uwf_plan
+from uwf_image import UwfSection
+from uwf_processor import ENHANCED_WRITE_BLOCK_SIZE
+
+IMAGE_CACHE_DIR = os.path.expanduser('~/.cache/lrd-bt-utils/images')
+
+# Upper bound of the cache directory; least recently used entries are evicted first
+IMAGE_CACHE_SIZE = 8 * 1024 * 1024
+
+# Write block sizes the processors use: the legacy default and the enhanced bootloader size
+CACHE_BLOCK_SIZES = [252, ENHANCED_WRITE_BLOCK_SIZE]
+
+CACHE_VERSION = 1
+
+class ChecksumTable():
+	"""
+	Byte sums of every write block of an image for one write block size, keyed
+	by the flash address of the block. Blocks are counted from the start of
+	each write range, which is where a full (not resumed) write starts them
+	"""
+	def __init__(self, block_size, ranges):
+		self.block_size = block_size
+		self.ranges = ranges
+		self.blocks = {}
+		for start, size, sums in ranges:
+			for index, checksum in enumerate(sums):
+				address = start + index * block_size
+				self.blocks[address] = (min(block_size, start + size - address), checksum)
+
+	@classmethod
+	def compute(cls, plan, block_size):
+		ranges = []
+		for write in plan.write_ranges:
+			sums = [uwf_checksum.checksum(write.payload[position:position + block_size]) for position in range(0, write.size, block_size)]
+			ranges.append((write.start, write.size, sums))
+		return cls(block_size, ranges)
+
+	def lookup(self, address, size):
+		"""
+		Returns the checksum of the block, or None if it is not a block of the table
+		"""
+		entry = self.blocks.get(address)
+		if entry is None or entry[0] != size:
+			return None
+		return entry[1]
+
+class ImageCache():
+	"""
+	On-disk cache keyed by the image's SHA-256: the section index and the
+	checksum tables of CACHE_BLOCK_SIZES. Verify checksums are the sum of the
+	block checksums of their window, so they need no table of their own
+	"""
+	def __init__(self, directory=IMAGE_CACHE_DIR, max_size=IMAGE_CACHE_SIZE):
+		self.directory = directory
+		self.max_size = max_size
+
+	def path(self, image_hash):
+		return os.path.join(self.directory, image_hash + '.json')
+
+	def load(self, image, block_sizes=CACHE_BLOCK_SIZES):
+		"""
+		Restores the section index of an image opened without indexing, or
+		indexes it and stores the index and checksum tables for the next run
+		Returns the checksum tables keyed by block size
+		"""
+		if image.error != None:
+			image.index()
+			return {}
+
+		path = self.path(image.digest())
+		entry = self.read(path)
+		if entry is not None:
+			image.sections = [UwfSection(*section) for section in entry['sections']]
+			image.truncated = entry['truncated']
+			tables = dict((int(size), ChecksumTable(int(size), ranges)) for size, ranges in entry['checksums'].items())
+			if all(size in tables for size in block_sizes):
+				# Mark the entry as recently used
+				os.utime(path, None)
+				return tables
+		else:
+			image.index()
+
+		plan = uwf_plan.compile_flash_plan(image)
+		tables = dict((size, ChecksumTable.compute(plan, size)) for size in block_sizes)
+		self.store(path, image, tables)
+		return tables
+
+	def read(self, path):
+		try:
+			with open(path) as f:
+				entry = json.load(f)
+		except (IOError, OSError, ValueError):
+			return None
+
+		if entry.get('version') != CACHE_VERSION:
+			return None
+		return entry
+
+	def store(self, path, image, tables):
+		entry = {
+			'version': CACHE_VERSION,
+			'sections': [list(section) for section in image.sections],
+			'truncated': image.truncated,
+			'checksums': dict((str(size), table.ranges) for size, table in tables.items()),
+		}
+
+		# Replace the entry atomically, like the flash journal
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			temp_path = path + '.tmp'
+			with open(temp_path, 'w') as f:
+				json.dump(entry, f)
+			os.rename(temp_path, path)
+		except (IOError, OSError):
+			# The cache is only an optimization
+			return
+
+		self.evict()
+
+	def evict(self):
+		"""
+		Removes the least recently used entries until the cache fits in max_size
+		"""
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith('.json'):
+				stat = os.stat(os.path.join(self.directory, name))
+				entries.append((stat.st_mtime, stat.st_size, name))
+
+		total = sum(size for mtime, size, name in entries)
+		for mtime, size, name in sorted(entries):
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				pass
+			total -= size
@@ -0,0 +1,28 @@
+"""
+Checksum helpers shared by the UWF processors
+
+The bootloader data command carries the LSB of the byte sum of its block and
+the verify command carries the full byte sum of the verified range, so both
+reduce to summing a whole buffer in one pass.
+"""
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Below this size the NumPy call overhead costs more than the builtin sum
+NUMPY_MIN_SIZE = 4096
+
+def checksum(data):
+	"""
+	Returns the sum of all bytes in the given bytes-like object
+	"""
+	if numpy is not None and len(data) >= NUMPY_MIN_SIZE:
+		return int(numpy.frombuffer(data, dtype=numpy.uint8).sum(dtype=numpy.uint64))
+	return sum(memoryview(data).cast('B'))
+
+def checksum_lsb(data):
+	"""
+	Returns the least significant byte of the sum of all bytes in the given data
+	"""
+	return checksum(data) & 0xff
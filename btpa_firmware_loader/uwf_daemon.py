@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+"""
+Long-running flashing service. Jobs arrive over a Unix domain socket as one
+JSON object per line and are answered with a stream of JSON event lines:
+
+  {"job": "flash", "port": "/dev/ttyS2", "baudrate": 115200, "file": "fw.uwf"}
+  {"job": "verify", "port": ..., "baudrate": ..., "file": ..., "type": "IG60"}
+  {"job": "upload", "port": ..., "baudrate": ..., "name": "$autorun$", "path": "autorun.sb"}
+  {"job": "list", "port": ..., "baudrate": ...}
+
+  {"event": "queued", "id": 1, "position": 0}
+  {"event": "started", "id": 1}
+  {"event": "progress", "id": 1, "phase": "write", "bytes": 8192, "total": 180224}
+  {"event": "done", "id": 1, "exit_code": 0, "error": null, ...}
+
+Every port has its own queue and worker thread, so jobs for one device run
+one at a time while different devices run in parallel; flash and verify jobs
+whose modules share GPIO reset lines (or an IG60 device service) still take
+turns, as each reset would restart the other module. The serial and DBus
+modules are imported once, parsed images and their flash plans are kept
+between jobs, and the AT session of a port stays open between upload and
+list jobs until a flash or verify job resets the module
+"""
+import os
+import sys
+import json
+import time
+import errno
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+import serial
+import uwf_image
+import uwf_plan
+import uwf_flash
+import uwf_link
+import uwf_journal
+import uwf_stats
+import uwf_processor
+import uwf_cache
+import uwf_gpio
+
+try:
+	# Installed next to the loader modules by setup.py
+	import btpa_utility
+except ImportError:
+	btpa_utility = None
+
+DAEMON_SOCKET_PATH = os.path.expanduser('~/.cache/lrd-bt-utils/daemon.sock')
+
+# Parsed images kept between jobs; the least recently used one is dropped first
+DAEMON_IMAGE_LIMIT = 4
+
+EXIT_CODE_SUCCESS = 0
+
+JOB_TYPES = ['flash', 'verify', 'upload', 'list']
+
+# Processor options a flash or verify job may set (see btpa_firmware_loader)
+JOB_OPTIONS = ['pipeline_window', 'adaptive_verify', 'differential', 'negotiate', 'resume',
+	'ready_timeout', 'section_retries', 'audit_min_window', 'gpio_backend', 'reset_pulse', 'reset_lines']
+
+class JobEvents():
+	"""
+	Sends the events of one job to its client. A client that went away only
+	stops the events, never the job
+	"""
+	def __init__(self, wfile, job_id):
+		self.wfile = wfile
+		self.job_id = job_id
+		self.lock = threading.Lock()
+		self.connected = True
+		self.done = threading.Event()
+
+	def send(self, event, **fields):
+		fields['event'] = event
+		fields['id'] = self.job_id
+		line = (json.dumps(fields, sort_keys=True) + '\n').encode('utf-8')
+		with self.lock:
+			if not self.connected:
+				return
+			try:
+				self.wfile.write(line)
+				self.wfile.flush()
+			except (IOError, OSError):
+				self.connected = False
+
+	def finish(self, exit_code, error, **fields):
+		self.send('done', exit_code=exit_code, error=error.strip() if error != None else None, **fields)
+		self.done.set()
+
+class JobProgress():
+	"""
+	Stands in for uwf_stats.ProgressLine: turns the payload progress of the
+	FlashStats of a job into progress events, at most every PROGRESS_INTERVAL_SEC
+	"""
+	def __init__(self, events):
+		self.events = events
+		self.last_update = 0.0
+
+	def update(self, stats, force=False):
+		now = time.time()
+		if not force and now - self.last_update < uwf_stats.PROGRESS_INTERVAL_SEC:
+			return
+		self.last_update = now
+		self.events.send('progress', phase=stats.phase, bytes=stats.payload_bytes, total=stats.total_bytes)
+
+class ImageStore():
+	"""
+	Parsed images with their flash plans and checksum tables, keyed by path,
+	base path, size and modification time so that a replaced file is parsed again
+	An image is closed once it is dropped and no job uses it any more
+	"""
+	def __init__(self, cache=None, limit=DAEMON_IMAGE_LIMIT):
+		self.cache = cache
+		self.limit = limit
+		self.entries = {}
+		self.users = {}
+		self.lock = threading.Lock()
+
+	def get(self, path, base_path=None):
+		"""
+		Returns (image, plan, checksum_tables), held for the job until release(image)
+		Raises IOError/OSError for a missing file and ValueError for an image
+		that does not validate
+		"""
+		stat = os.stat(path)
+		key = (os.path.abspath(path), base_path, stat.st_size, stat.st_mtime)
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None:
+				entry = self.load(path, base_path)
+			# Most recently used last
+			self.entries[key] = entry
+			self.users[entry[0]] = self.users.get(entry[0], 0) + 1
+			while len(self.entries) > self.limit:
+				self.close_unused(self.entries.pop(next(iter(self.entries)))[0])
+		return entry
+
+	def release(self, image):
+		with self.lock:
+			self.users[image] -= 1
+			self.close_unused(image)
+
+	def close_unused(self, image):
+		"""
+		Closes an image that was dropped and is not used by any job
+		"""
+		if self.users.get(image, 0) > 0 or any(entry[0] is image for entry in self.entries.values()):
+			return
+		self.users.pop(image, None)
+		image.close()
+
+	def load(self, path, base_path):
+		image = uwf_image.UwfImage(path, base_path, self.cache is None)
+		checksum_tables = None
+		if self.cache is not None:
+			checksum_tables = self.cache.load(image)
+
+		error = image.validate()
+		if error == None:
+			plan = uwf_plan.compile_flash_plan(image)
+			sys.stderr.write(''.join(plan.warnings))
+			if plan.errors:
+				error = ''.join(plan.errors)
+		if error != None:
+			image.close()
+			raise ValueError(error.strip())
+		return image, plan, checksum_tables
+
+class PortWorker(threading.Thread):
+	"""
+	Runs the jobs of one port in the order they were queued; holds the AT
+	session of the port between upload and list jobs
+	"""
+	def __init__(self, daemon, port):
+		threading.Thread.__init__(self, name='port {}'.format(port), daemon=True)
+		self.service = daemon
+		self.port = port
+		self.jobs = queue.Queue()
+		self.session = None
+
+		# Jobs queued or running; a new job's position is the number ahead of it
+		self.pending = 0
+		self.lock = threading.Lock()
+
+	def submit(self, job, events):
+		with self.lock:
+			position = self.pending
+			self.pending += 1
+		events.send('queued', port=self.port, position=position)
+		self.jobs.put((job, events))
+
+	def run(self):
+		while True:
+			job, events = self.jobs.get()
+			events.send('started')
+			try:
+				self.run_job(job, events)
+			except serial.SerialException as s:
+				self.close_session()
+				events.finish(errno.ENETUNREACH, '{}'.format(s))
+			except Exception as e:
+				self.close_session()
+				events.finish(errno.EPERM, '{}'.format(e))
+			with self.lock:
+				self.pending -= 1
+
+	def run_job(self, job, events):
+		baudrate = job['baudrate']
+		if job['job'] in ['flash', 'verify']:
+			try:
+				image, plan, checksum_tables = self.service.images.get(job['file'], job.get('base'))
+			except (IOError, OSError) as i:
+				events.finish(errno.ENOENT, '{}'.format(i))
+				return
+			except ValueError as v:
+				events.finish(errno.EINVAL, '{}'.format(v))
+				return
+
+			try:
+				# The processor resets the module and opens the port itself
+				self.close_session()
+				options = self.service.job_options(job)
+				options['checksum_tables'] = checksum_tables
+
+				locks = self.service.reset_locks(job, options)
+				for lock in locks:
+					lock.acquire()
+				try:
+					if job['job'] == 'flash':
+						collector = uwf_stats.StatsCollector()
+						collector.progress = JobProgress(events)
+						result = uwf_flash.flash_device(image, plan, self.port, baudrate, job.get('type'), options, collector)
+						events.finish(result.exit_code, result.error, seconds=round(result.seconds, 3), bytes=result.bytes,
+							stats=collector.report()['devices'][0])
+					else:
+						result = uwf_flash.audit_device(image, plan, self.port, baudrate, job.get('type'), options)
+						report = uwf_flash.audit_report(image, [result], result.seconds)
+						events.finish(result.exit_code, result.error, report=report)
+				finally:
+					for lock in locks:
+						lock.release()
+			finally:
+				self.service.images.release(image)
+		else:
+			session = self.open_session(baudrate)
+			if session is None:
+				events.finish(errno.ETIMEDOUT, 'BT module did not answer after the reset')
+			elif job['job'] == 'list':
+				entries = session.list()
+				if entries is None:
+					# Late responses would be taken for the next job's
+					self.close_session()
+					events.finish(errno.EPERM, 'Failed to list the files')
+				else:
+					events.finish(EXIT_CODE_SUCCESS, None, entries=entries)
+			else:
+				exit_code = session.upload(job['name'], job['path'], job.get('window', btpa_utility.UPLOAD_WINDOW), job.get('skip_existing', False))
+				if exit_code == btpa_utility.UPLOAD_SKIPPED:
+					events.finish(EXIT_CODE_SUCCESS, None, skipped=True)
+					return
+				if exit_code != EXIT_CODE_SUCCESS:
+					# The module may still have writes to answer and the file open; the
+					# next job resets it and starts a new session
+					self.close_session()
+				events.finish(exit_code, None if exit_code == EXIT_CODE_SUCCESS else 'Upload of {} failed'.format(job['name']))
+
+	def open_session(self, baudrate):
+		"""
+		Returns the open AT session of the port, or None if the module did not answer
+		"""
+		if self.session is not None and self.session.ser.baudrate != baudrate:
+			self.close_session()
+		if self.session is None:
+			session = btpa_utility.BtpaSession(self.port, baudrate, self.service.ready_timeout)
+			if not session.ready:
+				session.close()
+				return None
+			self.session = session
+		return self.session
+
+	def close_session(self):
+		if self.session is not None:
+			try:
+				self.session.close()
+			except serial.SerialException:
+				pass
+			self.session = None
+
+class FlashDaemon():
+	"""
+	Accepts jobs and hands each one to the worker of its port
+	"""
+	def __init__(self, options=None, cache=None, link_cache=None, ready_timeout=uwf_processor.BOOTLOADER_READY_TIMEOUT_SEC):
+		self.options = options or {}
+		self.images = ImageStore(cache)
+		self.link_cache = link_cache
+		self.ready_timeout = ready_timeout
+		self.workers = {}
+		self.lock = threading.Lock()
+		self.next_id = 1
+
+		# One lock per GPIO line name, and one for the IG60 device service
+		self.line_locks = {}
+
+		# Pay for the optional IG60 imports once instead of on the first job
+		try:
+			import dbus
+			import ig60_bl654_uwf_processor
+		except ImportError:
+			pass
+
+	def check_job(self, job):
+		"""
+		Returns an error string for a malformed job, otherwise None
+		"""
+		if not isinstance(job, dict) or job.get('job') not in JOB_TYPES:
+			return 'job must be one of {}'.format(', '.join(JOB_TYPES))
+		if not isinstance(job.get('port'), str) or not isinstance(job.get('baudrate'), int):
+			return 'port and baudrate are required'
+		if job['job'] in ['flash', 'verify']:
+			if not isinstance(job.get('file'), str):
+				return 'file is required'
+			unknown = [name for name in job.get('options', {}) if name not in JOB_OPTIONS]
+			if unknown:
+				return 'unknown options: {}'.format(', '.join(unknown))
+			lines = job.get('options', {}).get('reset_lines', uwf_gpio.GPIO_LINES)
+			if not isinstance(lines, (list, tuple)) or len(lines) != len(uwf_gpio.GPIO_LINES) or not all(isinstance(line, str) for line in lines):
+				return 'reset_lines must be the names of the boot mode and reset lines'
+		else:
+			if btpa_utility is None:
+				return 'btpa_utility is not installed'
+			if job['job'] == 'upload' and not (isinstance(job.get('name'), str) and isinstance(job.get('path'), str)):
+				return 'name and path are required'
+			window = job.get('window', 1)
+			if job['job'] == 'upload' and (not isinstance(window, int) or isinstance(window, bool) or window < 1):
+				return 'window must be a number of at least 1'
+		return None
+
+	def job_options(self, job):
+		"""
+		Returns the processor options of a job: the daemon defaults updated with the job's own
+		"""
+		options = dict(self.options)
+		options['ready_timeout'] = self.ready_timeout
+		options.update(job.get('options', {}))
+		if options.get('negotiate') and self.link_cache is not None:
+			options['link_cache'] = self.link_cache
+		return options
+
+	def reset_locks(self, job, options):
+		"""
+		Returns the locks of the GPIO lines, or of the IG60 device service, that
+		the module of a flash or verify job is reset with, in a fixed order
+		"""
+		if job.get('type') == uwf_processor.DEVICE_TYPE_IG60:
+			names = [uwf_processor.DEVICE_TYPE_IG60]
+		else:
+			names = sorted(set(options.get('reset_lines', uwf_gpio.GPIO_LINES)))
+		with self.lock:
+			return [self.line_locks.setdefault(name, threading.Lock()) for name in names]
+
+	def submit(self, job, wfile):
+		"""
+		Queues a job on the worker of its port
+		Returns the JobEvents of the job, already finished for a rejected job
+		"""
+		with self.lock:
+			events = JobEvents(wfile, self.next_id)
+			self.next_id += 1
+
+		error = self.check_job(job)
+		if error != None:
+			events.finish(errno.EINVAL, error)
+			return events
+
+		with self.lock:
+			worker = self.workers.get(job['port'])
+			if worker is None:
+				worker = self.workers[job['port']] = PortWorker(self, job['port'])
+				worker.start()
+		worker.submit(job, events)
+		return events
+
+class JobHandler(socketserver.StreamRequestHandler):
+	"""
+	Reads jobs from one client connection, one per line, and streams their
+	events back; the next job of the connection is read once this one is done
+	"""
+	def handle(self):
+		for line in self.rfile:
+			try:
+				job = json.loads(line.decode('utf-8'))
+			except ValueError:
+				job = None
+			events = self.server.service.submit(job, self.wfile)
+			events.done.wait()
+			if not events.connected:
+				break
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path, service):
+		self.service = service
+		socketserver.UnixStreamServer.__init__(self, path, JobHandler)
+
+def serve(path, service):
+	"""
+	Serves jobs on the Unix socket at 'path' until interrupted
+	Raises OSError (EADDRINUSE) if a daemon already serves 'path'
+	"""
+	directory = os.path.dirname(path)
+	if directory and not os.path.isdir(directory):
+		os.makedirs(directory)
+	if os.path.exists(path):
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+		except (IOError, OSError):
+			# Left over from a previous run
+			os.remove(path)
+		else:
+			raise OSError(errno.EADDRINUSE, 'A daemon is already serving {}'.format(path))
+		finally:
+			probe.close()
+
+	server = DaemonServer(path, service)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.remove(path)
+
+def submit(path, job, stream=sys.stdout):
+	"""
+	Sends one job to the daemon and copies its events to 'stream'
+	Returns the exit code of the job
+	"""
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(path)
+	with client, client.makefile('rwb') as f:
+		f.write((json.dumps(job) + '\n').encode('utf-8'))
+		f.flush()
+		for line in f:
+			stream.write(line.decode('utf-8'))
+			stream.flush()
+			event = json.loads(line.decode('utf-8'))
+			if event['event'] == 'done':
+				return event['exit_code']
+	return errno.ECONNRESET
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(prog='uwf_daemon', description='Flashing service on a Unix domain socket')
+	parser.add_argument('--socket', default=DAEMON_SOCKET_PATH,
+		help='path of the control socket (default: %(default)s)')
+	parser.add_argument('--submit', metavar='JSON', default=None,
+		help='send one job to a running daemon and print its events instead of serving')
+	parser.add_argument('--journal-dir', default=None,
+		help='keep per-port progress journals in this directory (default: {} for jobs with resume, none otherwise)'.format(uwf_journal.JOURNAL_DIR))
+	parser.add_argument('--link-cache', default=uwf_link.LINK_CACHE_PATH,
+		help='file holding the negotiated link settings (default: %(default)s)')
+	parser.add_argument('--ready-timeout', type=float, default=uwf_processor.BOOTLOADER_READY_TIMEOUT_SEC,
+		help='seconds to wait for the module to answer after a reset (default: %(default)s)')
+	parser.add_argument('--cache', action='store_true',
+		help='keep the section index and block checksums of images in the image cache')
+	parser.add_argument('--cache-dir', default=uwf_cache.IMAGE_CACHE_DIR,
+		help='directory of the image cache (default: %(default)s)')
+	args = parser.parse_args()
+
+	exit_code = EXIT_CODE_SUCCESS
+	if args.submit != None:
+		try:
+			exit_code = submit(args.socket, json.loads(args.submit))
+		except ValueError as v:
+			sys.stderr.write('{}\n'.format(v))
+			exit_code = errno.EINVAL
+		except (IOError, OSError) as i:
+			sys.stderr.write('{}\n'.format(i))
+			exit_code = errno.ECONNREFUSED
+	else:
+		cache = None
+		if args.cache:
+			cache = uwf_cache.ImageCache(args.cache_dir)
+		service = FlashDaemon({'journal_dir': args.journal_dir}, cache, uwf_link.LinkCache(args.link_cache), args.ready_timeout)
+		try:
+			serve(args.socket, service)
+		except KeyboardInterrupt:
+			pass
+		except (IOError, OSError) as i:
+			sys.stderr.write('{}\n'.format(i))
+			exit_code = errno.EADDRINUSE if i.errno == errno.EADDRINUSE else errno.EPERM
+
+	sys.exit(exit_code)
@@ -0,0 +1,170 @@
+import sys
+import lzma
+import zlib
+import errno
+import struct
+import hashlib
+import argparse
+import uwf_image
+
+# Delta image: header, then copy and insert records that rebuild the target
+# image from the base image
+#   header: magic, format version, target size, SHA-256 of the base and of the target
+#   'C' <base offset> <length>: copy bytes of the base
+#   'I' <length> <bytes>: insert the bytes
+DELTA_MAGIC = b'UWFD'
+DELTA_VERSION = 1
+DELTA_HEADER = struct.Struct('<4sBI32s32s')
+DELTA_COPY = struct.Struct('<cII')
+DELTA_INSERT = struct.Struct('<cI')
+DELTA_RECORD_COPY = b'C'
+DELTA_RECORD_INSERT = b'I'
+
+# Granularity of the base index used to find matching data; shorter matches are inserted
+DELTA_MATCH_SIZE = 32
+
+class DeltaError(Exception):
+	pass
+
+def is_delta(data):
+	return bytes(data[:len(DELTA_MAGIC)]) == DELTA_MAGIC
+
+def apply_delta(base, delta):
+	"""
+	Rebuilds the target image from the base image and the delta
+	Returns the target as a bytearray; raises DeltaError if the delta does not
+	apply to this base or the result does not match the target digest
+	"""
+	delta = memoryview(delta)
+	if len(delta) < DELTA_HEADER.size or not is_delta(delta):
+		raise DeltaError('Not a delta image')
+
+	magic, version, target_size, base_digest, target_digest = DELTA_HEADER.unpack_from(delta)
+	if version != DELTA_VERSION:
+		raise DeltaError('Unsupported delta version {}'.format(version))
+	if hashlib.sha256(base).digest() != base_digest:
+		raise DeltaError('Delta was made against a different base image')
+
+	target = bytearray(target_size)
+	position = 0
+	offset = DELTA_HEADER.size
+	try:
+		while offset < len(delta):
+			record = bytes(delta[offset:offset + 1])
+			if record == DELTA_RECORD_COPY:
+				record, start, length = DELTA_COPY.unpack_from(delta, offset)
+				offset += DELTA_COPY.size
+				if start + length > len(base):
+					raise DeltaError('Copy beyond the end of the base image')
+				target[position:position + length] = base[start:start + length]
+			elif record == DELTA_RECORD_INSERT:
+				record, length = DELTA_INSERT.unpack_from(delta, offset)
+				offset += DELTA_INSERT.size
+				if offset + length > len(delta):
+					raise DeltaError('Truncated insert record')
+				target[position:position + length] = delta[offset:offset + length]
+				offset += length
+			else:
+				raise DeltaError('Unknown record at offset {}'.format(offset))
+			position += length
+	except struct.error:
+		raise DeltaError('Truncated record at offset {}'.format(offset))
+
+	if position != target_size or hashlib.sha256(target).digest() != target_digest:
+		raise DeltaError('Rebuilt image does not match the target digest')
+
+	return target
+
+def make_delta(base, target):
+	"""
+	Returns a delta rebuilding 'target' from 'base'. Blocks of DELTA_MATCH_SIZE
+	bytes found in the base are extended to the longest match and copied;
+	everything else is inserted
+	"""
+	base = bytes(base)
+	target = bytes(target)
+
+	index = {}
+	for start in range(0, len(base) - DELTA_MATCH_SIZE + 1, DELTA_MATCH_SIZE):
+		index.setdefault(base[start:start + DELTA_MATCH_SIZE], start)
+
+	records = [DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, len(target),
+		hashlib.sha256(base).digest(), hashlib.sha256(target).digest())]
+	literal = 0
+	position = 0
+	while position < len(target):
+		start = index.get(target[position:position + DELTA_MATCH_SIZE])
+		if start is None:
+			position += 1
+			continue
+
+		# Extend the match backwards into the pending literal bytes, then forwards
+		while position > literal and start > 0 and base[start - 1] == target[position - 1]:
+			start -= 1
+			position -= 1
+		length = DELTA_MATCH_SIZE
+		while position + length < len(target) and start + length < len(base) and base[start + length] == target[position + length]:
+			length += 1
+
+		if position > literal:
+			records.append(DELTA_INSERT.pack(DELTA_RECORD_INSERT, position - literal))
+			records.append(target[literal:position])
+		records.append(DELTA_COPY.pack(DELTA_RECORD_COPY, start, length))
+		position += length
+		literal = position
+
+	if literal < len(target):
+		records.append(DELTA_INSERT.pack(DELTA_RECORD_INSERT, len(target) - literal))
+		records.append(target[literal:])
+
+	return b''.join(records)
+
+def compress(data, method):
+	"""
+	Compresses a distribution image with 'xz', 'zlib' or 'zstd' ('none' returns it unchanged)
+	"""
+	if method == 'xz':
+		return lzma.compress(data, preset=9 | lzma.PRESET_EXTREME)
+	elif method == 'zlib':
+		return zlib.compress(data, 9)
+	elif method == 'zstd':
+		# Optional dependency, only needed for zstd images
+		import zstandard
+		return zstandard.ZstdCompressor(level=19).compress(data)
+	return data
+
+def make_image(target_path, base_path=None, method='xz'):
+	"""
+	Builds the distribution image of a UWF file: a delta against the base, if
+	given, compressed with 'method'. Either file may itself be compressed
+	Returns the size of the uncompressed image and the distribution image
+	"""
+	data = uwf_image.read_image(target_path)
+	if base_path != None:
+		data = make_delta(uwf_image.read_image(base_path), data)
+	return len(data), compress(bytes(data), method)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(prog='uwf_delta', description='Builds compressed and delta UWF distribution images')
+	parser.add_argument('target', metavar='path to UWF file')
+	parser.add_argument('output', metavar='path to distribution image')
+	parser.add_argument('--base', default=None,
+		help='UWF file already on the gateways, plain or compressed; the output is then a delta against it')
+	parser.add_argument('--compress', choices=['xz', 'zlib', 'zstd', 'none'], default='xz',
+		help='compression of the output (default: %(default)s)')
+	args = parser.parse_args()
+
+	exit_code = 0
+	try:
+		size, packed = make_image(args.target, args.base, args.compress)
+		with open(args.output, 'wb') as f:
+			f.write(packed)
+		print('{} bytes -> {} bytes'.format(size, len(packed)))
+	except (IOError, OSError) as i:
+		sys.stderr.write('{}\n'.format(i))
+		exit_code = errno.ENOENT
+	except (zlib.error, lzma.LZMAError, EOFError, ImportError) as e:
+		sys.stderr.write('{}\n'.format(e))
+		exit_code = errno.EINVAL
+
+	sys.exit(exit_code)
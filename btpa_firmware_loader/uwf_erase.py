@@ -0,0 +1,65 @@
+import collections
+
+# 64 KiB block erase of the enhanced bootloader
+ERASE_BLOCK_64K = 0x10000
+
+# FUP_OPTION_CURRENT_ERASE_LEN_BYTES values; the bootloader starts with sector erases
+FUP_ERASE_LEN_SECTOR = 0x0
+FUP_ERASE_LEN_64K = 0x2
+
+# Absolute flash range to erase
+EraseRange = collections.namedtuple('EraseRange', ['start', 'size'])
+
+# One erase command: absolute start address and the number of bytes it erases
+EraseCommand = collections.namedtuple('EraseCommand', ['start', 'size'])
+
+def coalesce(ranges):
+	"""
+	Returns the ranges sorted, with overlapping and adjacent ranges merged
+	"""
+	merged = []
+	for start, size in sorted(ranges):
+		if merged and start <= merged[-1].start + merged[-1].size:
+			last = merged[-1]
+			merged[-1] = EraseRange(last.start, max(last.size, start + size - last.start))
+		else:
+			merged.append(EraseRange(start, size))
+	return merged
+
+def erase_commands(ranges, sector_size, block_size=None):
+	"""
+	Returns the erase commands covering the ranges (rounded up to whole sectors)
+	With a block_size, the block aligned part of each range is erased in blocks
+	and only the unaligned edges in sectors. Sector erases come first so the
+	erase length setting changes at most once
+	"""
+	sectors = []
+	blocks = []
+	rounded = [EraseRange(start, (size + sector_size - 1) // sector_size * sector_size) for start, size in ranges]
+	for start, size in coalesce(rounded):
+		end = start + size
+		if block_size:
+			block_start = min(end, (start + block_size - 1) // block_size * block_size)
+			block_end = max(block_start, end // block_size * block_size)
+		else:
+			block_start = block_end = end
+
+		for address in range(start, block_start, sector_size):
+			sectors.append(EraseCommand(address, sector_size))
+		for address in range(block_start, block_end, block_size or sector_size):
+			blocks.append(EraseCommand(address, block_size))
+		for address in range(block_end, end, sector_size):
+			sectors.append(EraseCommand(address, sector_size))
+
+	return sectors + blocks
+
+def batch_ranges(plan):
+	"""
+	Returns the merged erase ranges of every erase record in the plan, so the
+	whole image can be erased when its first erase record is processed
+	Returns None without a plan, or when an erase record overlaps an earlier
+	write (the records must then be erased one by one, in image order)
+	"""
+	if plan is None or not plan.erase_ranges or plan.erase_after_write:
+		return None
+	return coalesce(plan.erase_ranges)
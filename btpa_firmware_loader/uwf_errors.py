@@ -0,0 +1,75 @@
+import errno
+
+class FlashError(Exception):
+	"""
+	Base of the errors of a flash run. The message is the handler's formatted
+	error string (e.g. 'process_command_write_blocks: ...\\n'); 'retryable'
+	tells whether repeating the failed section in place may succeed, and
+	'exit_code' is what the loader exits with
+	"""
+	retryable = False
+	exit_code = errno.EPERM
+
+	def __init__(self, message, address=None):
+		Exception.__init__(self, message)
+		self.message = message
+		self.address = address
+
+	def __str__(self):
+		return self.message
+
+class SyncError(FlashError):
+	"""
+	The bootloader did not answer the sync, or the ATS acknowledge failed
+	"""
+	retryable = True
+	exit_code = errno.ENETUNREACH
+
+class LinkTimeoutError(FlashError):
+	"""
+	A command got no response within the serial timeout
+	"""
+	retryable = True
+	exit_code = errno.ETIMEDOUT
+
+class LinkError(FlashError):
+	"""
+	A link negotiation candidate was not stable; the repeat restarts the
+	bootloader at the port's baudrate and probes the next candidate, or
+	continues in legacy mode once none is left
+	"""
+	retryable = True
+	exit_code = errno.ENETUNREACH
+
+class NakError(FlashError):
+	"""
+	The bootloader refused a write, data or erase command
+	"""
+	retryable = True
+
+class VerifyError(FlashError):
+	"""
+	A verify command failed; 'address' is the start of the failed window
+	"""
+	retryable = True
+	exit_code = errno.EIO
+
+class DeviceError(FlashError):
+	"""
+	The device is not the one the image is for, or could not be reset into its bootloader
+	"""
+	exit_code = errno.ENODEV
+
+class ImageError(FlashError):
+	"""
+	The image asks for something the device cannot do, or has its sections out of order
+	"""
+	exit_code = errno.EINVAL
+
+def response_error(response, message, address=None, error_class=NakError):
+	"""
+	Returns a LinkTimeoutError for an empty response, otherwise an 'error_class' error
+	"""
+	if len(response) == 0:
+		return LinkTimeoutError(message, address)
+	return error_class(message, address)
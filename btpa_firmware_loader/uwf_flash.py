@@ -0,0 +1,311 @@
+import time
+import errno
+import serial
+import asyncio
+import collections
+import concurrent.futures
+import uwf_processor
+import uwf_async_processor
+import uwf_errors
+import uwf_gpio
+
+EXIT_CODE_SUCCESS = 0
+
+# Outcome of flashing one device; 'error' is None on success
+DeviceResult = collections.namedtuple('DeviceResult', ['port', 'exit_code', 'error', 'seconds', 'bytes'])
+
+# Outcome of auditing one device; 'mismatches' holds the [start, end) flash
+# ranges that do not match the image, and is None if the audit did not complete
+AuditResult = collections.namedtuple('AuditResult', ['port', 'exit_code', 'error', 'seconds', 'device_id', 'verifies', 'mismatches'])
+
+# Options used while the processor resets the module, before the other options can be applied
+INIT_OPTIONS = ['ready_timeout', 'gpio_backend', 'reset_pulse', 'reset_lines']
+
+ERROR_PORTS = 'uwf_flash: {}\n'
+
+def init_options(options):
+	"""
+	Returns the options that init_processor takes as keyword arguments
+	"""
+	return dict((name, value) for name, value in (options or {}).items() if name in INIT_OPTIONS)
+
+def port_options(options, port):
+	"""
+	Returns the options of one port: a 'port_reset_lines' map of port names to
+	(boot mode, reset) line names is replaced by the 'reset_lines' of the port
+	"""
+	options = dict(options or {})
+	port_reset_lines = options.pop('port_reset_lines', None) or {}
+	if port in port_reset_lines:
+		options['reset_lines'] = port_reset_lines[port]
+	return options
+
+def check_ports(ports, type=None, options=None):
+	"""
+	Returns an error string if the ports cannot be flashed at the same time,
+	otherwise None: resetting one module must not reset another, so every port
+	needs its own boot mode and reset lines, and an IG60 has a single module
+	behind its device service
+	"""
+	if len(ports) < 2:
+		return None
+	if type == uwf_processor.DEVICE_TYPE_IG60:
+		return ERROR_PORTS.format('An IG60 resets its one BT module through the device service; flash one port at a time')
+
+	owners = {}
+	for port in ports:
+		for line in port_options(options, port).get('reset_lines', uwf_gpio.GPIO_LINES):
+			if line in owners:
+				return ERROR_PORTS.format('{} and {} share the GPIO line {}; give each port its own lines with --reset-lines'.format(owners[line], port, line))
+			owners[line] = port
+	return None
+
+class DeviceRun():
+	"""
+	State of one flash or audit of one port, shared by flash_device,
+	flash_device_async and audit_device: applies the options and
+	instrumentation to the processor, keeps the first error and releases
+	the processor
+	"""
+	def __init__(self, plan, port, options=None, collector=None):
+		self.plan = plan
+		self.port = port
+		self.options = port_options(options, port)
+		self.start = time.time()
+		self.exit_code = EXIT_CODE_SUCCESS
+		self.error = None
+		self.mismatches = None
+		self.processor = None
+		self.stats = None
+		if collector is not None:
+			self.stats = collector.device(port, plan.write_bytes)
+
+	def init_options(self):
+		return init_options(self.options)
+
+	def attach(self, processor):
+		self.processor = processor
+		processor.plan = self.plan
+		for name, value in self.options.items():
+			setattr(processor, name, value)
+		if self.stats is not None:
+			self.stats.time_phase('reset', time.time() - self.start)
+			self.stats.attach(processor)
+		return processor
+
+	def fail(self, e):
+		"""
+		Records the error and exit code of an exception, unless an earlier one was recorded
+		"""
+		if self.error != None:
+			return
+		if isinstance(e, uwf_errors.FlashError):
+			self.error = '{}'.format(e)
+			self.exit_code = e.exit_code
+		elif isinstance(e, serial.SerialException):
+			self.error = '{}\n'.format(e)
+			self.exit_code = errno.ENETUNREACH
+		else:
+			self.error = '{}\n'.format(e)
+			self.exit_code = errno.EPERM
+
+	def close(self):
+		# Release the port and GPIO lines, also when the reboot failed or was never reached
+		if self.processor is not None:
+			self.processor.close()
+
+	def flash_result(self):
+		written = self.plan.write_bytes if self.error == None else 0
+		if self.stats is not None:
+			self.stats.finish(self.error)
+		return DeviceResult(self.port, self.exit_code, self.error, time.time() - self.start, written)
+
+	def audit_result(self):
+		exit_code = self.exit_code
+		if self.mismatches:
+			exit_code = uwf_errors.VerifyError.exit_code
+
+		device_id = None
+		verifies = 0
+		if self.processor is not None:
+			device_id = self.processor.device_id
+			verifies = self.processor.audit_verifies
+		return AuditResult(self.port, exit_code, self.error, time.time() - self.start, device_id, verifies, self.mismatches)
+
+def flash_device(image, plan, port, baudrate, type=None, options=None, collector=None):
+	"""
+	Enters the bootloader on one port, programs the image and reboots the module
+	'options' maps processor attribute names to values (e.g. pipeline_window)
+	With a uwf_stats.StatsCollector, the processor is instrumented and timed
+	Returns a DeviceResult; errors are reported in the result, never raised
+	"""
+	run = DeviceRun(plan, port, options, collector)
+	try:
+		processor = run.attach(uwf_processor.init_processor(type, port, baudrate, **run.init_options()))
+		try:
+			processor.process_image(image)
+		except uwf_errors.FlashError as f:
+			run.fail(f)
+		processor.process_reboot()
+	except Exception as e:
+		# Failed before flashing started (e.g. the reset into the bootloader), or in the reboot
+		run.fail(e)
+	finally:
+		run.close()
+
+	return run.flash_result()
+
+def flash_devices(image, plan, ports, baudrate, type=None, options=None, workers=None, collector=None):
+	"""
+	Programs the same parsed image on several ports concurrently, one processor
+	per port, with at most 'workers' at a time
+	A failing device does not stop the others
+	Returns the DeviceResults in port order and the total elapsed time
+	Raises ValueError for ports that cannot be flashed together (see check_ports)
+	"""
+	error = check_ports(ports, type, options)
+	if error != None:
+		raise ValueError(error)
+
+	start = time.time()
+	workers = workers or len(ports)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(flash_device, image, plan, port, baudrate, type, options, collector) for port in ports]
+		results = [future.result() for future in futures]
+
+	return results, time.time() - start
+
+async def flash_device_async(image, plan, port, baudrate, type=None, options=None, collector=None):
+	"""
+	asyncio version of flash_device
+	"""
+	run = DeviceRun(plan, port, options, collector)
+	try:
+		processor = run.attach(await uwf_async_processor.init_async_processor(type, port, baudrate, **run.init_options()))
+		try:
+			await processor.process_image(image)
+		except uwf_errors.FlashError as f:
+			run.fail(f)
+		await processor.process_reboot()
+	except Exception as e:
+		run.fail(e)
+	finally:
+		run.close()
+
+	return run.flash_result()
+
+def flash_devices_async(image, plan, ports, baudrate, type=None, options=None, workers=None, collector=None):
+	"""
+	Programs the image on every port from a single asyncio event loop, with at
+	most 'workers' devices at a time
+	Returns the DeviceResults in port order and the total elapsed time
+	Raises ValueError for ports that cannot be flashed together (see check_ports)
+	"""
+	error = check_ports(ports, type, options)
+	if error != None:
+		raise ValueError(error)
+
+	async def flash_all():
+		slots = asyncio.Semaphore(workers or len(ports))
+
+		async def flash_one(port):
+			async with slots:
+				return await flash_device_async(image, plan, port, baudrate, type, options, collector)
+
+		return await asyncio.gather(*[flash_one(port) for port in ports])
+
+	start = time.time()
+	results = asyncio.run(flash_all())
+
+	return list(results), time.time() - start
+
+def audit_device(image, plan, port, baudrate, type=None, options=None):
+	"""
+	Enters the bootloader on one port, verifies the image without writing and
+	reboots the module
+	Returns an AuditResult; a mismatch exits with EIO, like a failed verify
+	"""
+	run = DeviceRun(plan, port, options)
+	try:
+		processor = run.attach(uwf_processor.init_processor(type, port, baudrate, **run.init_options()))
+		try:
+			run.mismatches = processor.audit_image(image)
+		except uwf_errors.FlashError as f:
+			run.fail(f)
+		processor.process_reboot()
+	except Exception as e:
+		run.fail(e)
+	finally:
+		run.close()
+
+	return run.audit_result()
+
+def audit_devices(image, plan, ports, baudrate, type=None, options=None, workers=None):
+	"""
+	Audits several ports concurrently, one processor per port
+	Returns the AuditResults in port order and the total elapsed time
+	Raises ValueError for ports that cannot be audited together (see check_ports)
+	"""
+	error = check_ports(ports, type, options)
+	if error != None:
+		raise ValueError(error)
+
+	start = time.time()
+	workers = workers or len(ports)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(audit_device, image, plan, port, baudrate, type, options) for port in ports]
+		results = [future.result() for future in futures]
+
+	return results, time.time() - start
+
+def audit_report(image, results, elapsed):
+	"""
+	Returns the machine-readable audit report: an overall and a per-device
+	result ('pass', 'fail' or 'error') with the mismatch map of each device
+	"""
+	devices = []
+	for result in results:
+		if result.error != None:
+			status = 'error'
+		elif result.mismatches:
+			status = 'fail'
+		else:
+			status = 'pass'
+		mismatches = [{'start': start, 'end': end, 'size': end - start} for start, end in result.mismatches or []]
+		devices.append({
+			'port': result.port,
+			'result': status,
+			'error': result.error.strip() if result.error != None else None,
+			'device_id': result.device_id,
+			'seconds': round(result.seconds, 3),
+			'verifies': result.verifies,
+			'mismatches': mismatches,
+		})
+
+	return {
+		'image': image.digest(),
+		'result': 'pass' if all(device['result'] == 'pass' for device in devices) else 'fail',
+		'seconds': round(elapsed, 3),
+		'devices': devices,
+	}
+
+def format_results(results, elapsed):
+	"""
+	Returns a per-device result table and a total throughput line
+	"""
+	lines = ['{:<20} {:<6} {:>9} {:>12}'.format('port', 'result', 'seconds', 'bytes/s')]
+	for result in results:
+		if result.error == None:
+			status = 'ok'
+		else:
+			status = 'failed'
+		lines.append('{:<20} {:<6} {:>9.1f} {:>12.0f}'.format(result.port, status, result.seconds, result.bytes / result.seconds if result.seconds else 0))
+		if result.error != None:
+			lines.append('  {}'.format(result.error.strip()))
+
+	total = sum(result.bytes for result in results)
+	passed = len([result for result in results if result.error == None])
+	lines.append('{} of {} devices flashed, {} bytes in {:.1f} s ({:.0f} bytes/s)'.format(passed, len(results), total, elapsed, total / elapsed if elapsed else 0))
+	return '\n'.join(lines) + '\n'
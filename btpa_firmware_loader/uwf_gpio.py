@@ -0,0 +1,260 @@
+import os
+import glob
+import time
+import fcntl
+import struct
+import uwf_errors
+
+GPIO_BASE_PATH = '/sys/devices/platform/gpio/'
+GPIO_CARD_NRESET = 'card_nreset'
+GPIO_BT_BOOT_MODE = 'bt_boot_mode'
+
+# Names of the boot mode and the reset line of the module; a gateway with
+# several modules has a pair of lines per module
+GPIO_LINES = (GPIO_BT_BOOT_MODE, GPIO_CARD_NRESET)
+
+GPIO_BACKEND_AUTO = 'auto'
+GPIO_BACKEND_CHARDEV = 'chardev'
+GPIO_BACKEND_SYSFS = 'sysfs'
+GPIO_BACKEND_FAKE = 'fake'
+GPIO_BACKENDS = [GPIO_BACKEND_AUTO, GPIO_BACKEND_CHARDEV, GPIO_BACKEND_SYSFS, GPIO_BACKEND_FAKE]
+
+# Time card_nreset is held low; the nRF52 needs far less, this leaves margin for slow pull-ups
+GPIO_RESET_PULSE_SEC = 0.001
+
+GPIO_CHIP_GLOB = '/dev/gpiochip*'
+GPIO_CONSUMER = b'lrd-bt-utils'
+
+ERROR_GPIO = 'open_gpio: {}\n'
+
+# Linux GPIO character device, v1 ABI (linux/gpio.h)
+#   gpiochip_info: name[32], label[32], u32 lines
+#   gpioline_info: u32 line_offset, u32 flags, name[32], consumer[32]
+#   gpiohandle_request: u32 lineoffsets[64], u32 flags, u8 default_values[64], consumer_label[32], u32 lines, int fd
+#   gpiohandle_data: u8 values[64]
+GPIOHANDLES_MAX = 64
+GPIOCHIP_INFO = struct.Struct('32s32sI')
+GPIOLINE_INFO = struct.Struct('II32s32s')
+GPIOHANDLE_REQUEST = struct.Struct('{0}II{0}B32sIi'.format(GPIOHANDLES_MAX))
+GPIOHANDLE_DATA = struct.Struct('{}B'.format(GPIOHANDLES_MAX))
+GPIOHANDLE_REQUEST_OUTPUT = 1 << 1
+
+def gpio_ioctl(direction, number, layout):
+	return (direction << 30) | (layout.size << 16) | (0xb4 << 8) | number
+
+GPIO_GET_CHIPINFO_IOCTL = gpio_ioctl(2, 0x01, GPIOCHIP_INFO)
+GPIO_GET_LINEINFO_IOCTL = gpio_ioctl(3, 0x02, GPIOLINE_INFO)
+GPIO_GET_LINEHANDLE_IOCTL = gpio_ioctl(3, 0x03, GPIOHANDLE_REQUEST)
+GPIOHANDLE_SET_LINE_VALUES_IOCTL = gpio_ioctl(3, 0x09, GPIOHANDLE_DATA)
+
+class GpioLines():
+	"""
+	The boot mode and reset lines of the BT module, set by their roles
+	GPIO_BT_BOOT_MODE and GPIO_CARD_NRESET; 'lines' names the lines that
+	play these roles. Backends hold their lines open from open_gpio() until
+	close(); set() changes several lines at once where the backend can
+	"""
+	def __init__(self, pulse=GPIO_RESET_PULSE_SEC, lines=GPIO_LINES):
+		self.pulse = pulse
+		self.names = dict(zip(GPIO_LINES, lines))
+
+	def set(self, values):
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+	def reset(self, boot_mode):
+		"""
+		Resets the module into the given boot mode: the boot mode is selected
+		together with the start of the reset pulse and held while reset is released
+		"""
+		self.set({GPIO_BT_BOOT_MODE: boot_mode, GPIO_CARD_NRESET: 0})
+		hold(self.pulse)
+		self.set({GPIO_CARD_NRESET: 1})
+
+def hold(seconds):
+	"""
+	Waits for 'seconds'; the sleep is topped up with a short spin so that the
+	pulse is never shorter than asked, whatever the scheduler granularity
+	"""
+	deadline = time.perf_counter() + seconds
+	time.sleep(seconds)
+	while time.perf_counter() < deadline:
+		pass
+
+class ChardevGpio(GpioLines):
+	"""
+	Lines requested from the GPIO character devices by name, one line handle
+	per chip; lines of the same chip are set with a single ioctl
+	"""
+	def __init__(self, pulse=GPIO_RESET_PULSE_SEC, lines=GPIO_LINES, chips=None):
+		GpioLines.__init__(self, pulse, lines)
+		self.handles = {}
+		self.lines = {}
+
+		names = list(self.names.values())
+		found = find_lines(names, chips or sorted(glob.glob(GPIO_CHIP_GLOB)))
+		missing = [name for name in names if name not in found]
+		if missing:
+			raise uwf_errors.DeviceError(ERROR_GPIO.format('No GPIO line named {}'.format(', '.join(missing))))
+
+		by_chip = {}
+		for role, name in self.names.items():
+			chip, offset = found[name]
+			by_chip.setdefault(chip, []).append((role, offset))
+
+		try:
+			for chip, lines in by_chip.items():
+				# Output lines start high: the module keeps running and its boot mode is unchanged until reset()
+				fd = request_lines(chip, [offset for role, offset in lines], [1] * len(lines))
+				self.handles[chip] = [fd, bytearray(GPIOHANDLE_DATA.size)]
+				for index, (role, offset) in enumerate(lines):
+					self.lines[role] = (chip, index)
+					self.handles[chip][1][index] = 1
+		except (IOError, OSError) as e:
+			self.close()
+			raise uwf_errors.DeviceError(ERROR_GPIO.format(e))
+
+	def set(self, values):
+		changed = set()
+		for role, value in values.items():
+			chip, index = self.lines[role]
+			self.handles[chip][1][index] = 1 if int(value) else 0
+			changed.add(chip)
+		for chip in changed:
+			fd, data = self.handles[chip]
+			fcntl.ioctl(fd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, data)
+
+	def close(self):
+		for fd, data in self.handles.values():
+			os.close(fd)
+		self.handles = {}
+
+def find_lines(names, chips):
+	"""
+	Returns {name: (chip path, line offset)} for the named lines found on the chips
+	"""
+	found = {}
+	for chip in chips:
+		try:
+			fd = os.open(chip, os.O_RDWR)
+		except OSError:
+			continue
+		try:
+			info = bytearray(GPIOCHIP_INFO.size)
+			fcntl.ioctl(fd, GPIO_GET_CHIPINFO_IOCTL, info)
+			lines = GPIOCHIP_INFO.unpack(info)[2]
+			for offset in range(lines):
+				line = bytearray(GPIOLINE_INFO.pack(offset, 0, b'', b''))
+				fcntl.ioctl(fd, GPIO_GET_LINEINFO_IOCTL, line)
+				name = GPIOLINE_INFO.unpack(line)[2].split(b'\0', 1)[0].decode('utf-8', 'replace')
+				if name in names and name not in found:
+					found[name] = (chip, offset)
+		except (IOError, OSError):
+			pass
+		finally:
+			os.close(fd)
+	return found
+
+def request_lines(chip, offsets, defaults):
+	"""
+	Requests the lines of one chip as outputs
+	Returns the file descriptor of the line handle
+	"""
+	request = bytearray(GPIOHANDLE_REQUEST.size)
+	fields = list(offsets) + [0] * (GPIOHANDLES_MAX - len(offsets))
+	fields += [GPIOHANDLE_REQUEST_OUTPUT]
+	fields += list(defaults) + [0] * (GPIOHANDLES_MAX - len(defaults))
+	fields += [GPIO_CONSUMER, len(offsets), -1]
+	GPIOHANDLE_REQUEST.pack_into(request, 0, *fields)
+
+	fd = os.open(chip, os.O_RDWR)
+	try:
+		fcntl.ioctl(fd, GPIO_GET_LINEHANDLE_IOCTL, request)
+	finally:
+		os.close(fd)
+	return GPIOHANDLE_REQUEST.unpack(request)[-1]
+
+class SysfsGpio(GpioLines):
+	"""
+	Value files of the lines under GPIO_BASE_PATH, kept open; lines are written one at a time
+	"""
+	def __init__(self, pulse=GPIO_RESET_PULSE_SEC, lines=GPIO_LINES, base_path=GPIO_BASE_PATH):
+		GpioLines.__init__(self, pulse, lines)
+		self.files = {}
+		try:
+			for role, name in self.names.items():
+				self.files[role] = open(os.path.join(base_path, name, 'value'), 'w')
+		except (IOError, OSError) as e:
+			self.close()
+			raise uwf_errors.DeviceError(ERROR_GPIO.format(e))
+
+	def set(self, values):
+		# The boot mode goes first, so that it is in place before reset changes
+		for role in sorted(values, key=lambda role: role != GPIO_BT_BOOT_MODE):
+			f = self.files[role]
+			f.seek(0)
+			f.write('%d' % int(values[role]))
+			f.flush()
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+		self.files = {}
+
+class FakeGpio(GpioLines):
+	"""
+	Test backend: keeps the line values and a log of (time, values) changes
+	by role, and calls 'listener(role, value)' for every line written
+	"""
+	def __init__(self, pulse=GPIO_RESET_PULSE_SEC, listener=None, lines=GPIO_LINES):
+		GpioLines.__init__(self, pulse, lines)
+		self.listener = listener
+		self.values = {GPIO_BT_BOOT_MODE: 1, GPIO_CARD_NRESET: 1}
+		self.log = []
+		self.closed = False
+
+	def set(self, values):
+		self.values.update(values)
+		self.log.append((time.perf_counter(), dict(values)))
+		if self.listener is not None:
+			for name in sorted(values, key=lambda name: name != GPIO_BT_BOOT_MODE):
+				self.listener(name, values[name])
+
+	def close(self):
+		self.closed = True
+
+def open_gpio(backend=GPIO_BACKEND_AUTO, pulse=GPIO_RESET_PULSE_SEC, lines=GPIO_LINES):
+	"""
+	Returns the GpioLines of the named backend for the (boot mode, reset)
+	line names; 'auto' uses the character device when it has the named lines
+	and sysfs otherwise
+	Raises DeviceError when the lines cannot be opened
+	"""
+	if backend == GPIO_BACKEND_CHARDEV:
+		return ChardevGpio(pulse, lines)
+	elif backend == GPIO_BACKEND_SYSFS:
+		return SysfsGpio(pulse, lines)
+	elif backend == GPIO_BACKEND_FAKE:
+		return FakeGpio(pulse, lines=lines)
+
+	try:
+		return ChardevGpio(pulse, lines)
+	except uwf_errors.DeviceError:
+		# No GPIO character device with these line names, or the lines are exported to sysfs
+		return SysfsGpio(pulse, lines)
+
+def parse_reset_lines(values):
+	"""
+	Parses PORT=BOOT_MODE_LINE,RESET_LINE arguments into {port: (boot mode line, reset line)}
+	Raises ValueError for a malformed argument
+	"""
+	ports = {}
+	for value in values or []:
+		port, equals, names = value.partition('=')
+		lines = tuple(name.strip() for name in names.split(','))
+		if not port or not equals or len(lines) != len(GPIO_LINES) or not all(lines):
+			raise ValueError('Expected PORT=BOOT_MODE_LINE,RESET_LINE, got {!r}'.format(value))
+		ports[port] = lines
+	return ports
@@ -0,0 +1,236 @@
+import mmap
+import lzma
+import zlib
+import struct
+import hashlib
+import collections
+import uwf_delta
+
+UWF_COMMAND_HEADER_LENGTH = 6
+UWF_TARGET_PLATFORM_LENGTH = 4
+UWF_REGISTER_DEVICE_LENGTH = 11
+UWF_SELECT_DEVICE_LENGTH = 2
+UWF_SECTOR_MAP_LENGTH = 8
+UWF_ERASE_BLOCK_LENGTH = 8
+UWF_WRITE_BLOCK_LENGTH = 8
+UWF_UNREGISTER_DEVICE_LENGTH = 1
+
+UWF_OFFSET_HEADER_COMMAND_ID = 1
+UWF_OFFSET_HEADER_LENGTH_START = 2
+UWF_OFFSET_HEADER_LENGTH_END = 6
+
+UWF_COMMAND_TARGET_PLATFORM = 'T'
+UWF_COMMAND_REGISTER = 'G'
+UWF_COMMAND_SELECT = 'S'
+UWF_COMMAND_SECTOR_MAP = 'M'
+UWF_COMMAND_ERASE = 'E'
+UWF_COMMAND_WRITE = 'W'
+UWF_COMMAND_UNREGISTER = 'U'
+
+# Expected payload length of each known section; write sections carry at least a header
+UWF_SECTION_LENGTHS = {
+	UWF_COMMAND_TARGET_PLATFORM: UWF_TARGET_PLATFORM_LENGTH,
+	UWF_COMMAND_REGISTER: UWF_REGISTER_DEVICE_LENGTH,
+	UWF_COMMAND_SELECT: UWF_SELECT_DEVICE_LENGTH,
+	UWF_COMMAND_SECTOR_MAP: UWF_SECTOR_MAP_LENGTH,
+	UWF_COMMAND_ERASE: UWF_ERASE_BLOCK_LENGTH,
+	UWF_COMMAND_WRITE: UWF_WRITE_BLOCK_LENGTH,
+	UWF_COMMAND_UNREGISTER: UWF_UNREGISTER_DEVICE_LENGTH,
+}
+
+ERROR_IMAGE = 'uwf_image: {}\n'
+
+# Leading bytes of the compressed distribution formats; zlib streams start
+# with a CMF byte of 0x78 (deflate, 32K window)
+MAGIC_GZIP = b'\x1f\x8b'
+MAGIC_ZLIB = b'\x78'
+MAGIC_XZ = b'\xfd7zXZ\x00'
+MAGIC_ZSTD = b'\x28\xb5\x2f\xfd'
+MAGIC_SIZE = 6
+
+# Compressed images are read and expanded in chunks of this size
+EXPAND_READ_SIZE = 0x10000
+
+def decompressor(magic):
+	"""
+	Returns a decompressor object for an image starting with 'magic', or None
+	for an uncompressed image
+	"""
+	if magic.startswith(MAGIC_XZ):
+		return lzma.LZMADecompressor()
+	elif magic.startswith(MAGIC_ZSTD):
+		# Optional dependency, only needed for zstd images
+		import zstandard
+		return zstandard.ZstdDecompressor().decompressobj()
+	elif magic.startswith(MAGIC_GZIP) or (magic.startswith(MAGIC_ZLIB) and len(magic) > 1 and (magic[0] << 8 | magic[1]) % 31 == 0):
+		# zlib or gzip header, detected by zlib itself
+		return zlib.decompressobj(47)
+	return None
+
+def expand(f):
+	"""
+	Returns the decompressed contents of the open file as a bytearray, or None
+	if it is not compressed. The file is read in EXPAND_READ_SIZE chunks, so
+	only the expanded image is held in memory
+	"""
+	magic = f.read(MAGIC_SIZE)
+	f.seek(0)
+	expander = decompressor(magic)
+	if expander is None:
+		return None
+
+	data = bytearray()
+	chunk = f.read(EXPAND_READ_SIZE)
+	while chunk:
+		data += expander.decompress(chunk)
+		chunk = f.read(EXPAND_READ_SIZE)
+	if hasattr(expander, 'flush'):
+		data += expander.flush()
+	if not getattr(expander, 'eof', True):
+		raise EOFError('Compressed image is truncated')
+	return data
+
+def read_image(path):
+	"""
+	Returns the contents of a plain or compressed image file
+	"""
+	with open(path, 'rb') as f:
+		data = expand(f)
+		if data is None:
+			data = f.read()
+	return data
+
+# A section of the image; 'offset' is the file offset of the section payload
+UwfSection = collections.namedtuple('UwfSection', ['command', 'offset', 'length'])
+
+def is_known_section(section):
+	"""
+	Returns True if the section is a command the processors handle, with the expected length
+	"""
+	expected = UWF_SECTION_LENGTHS.get(section.command)
+	if expected is None:
+		return False
+	elif section.command == UWF_COMMAND_WRITE:
+		return section.length >= expected
+	else:
+		return section.length == expected
+
+class UwfImage():
+	"""
+	Memory-maps a UWF file and indexes all of its sections in one pass
+	Section payloads are handed out as memoryviews into the mapping, so
+	nothing is copied until the data is framed for the serial port
+	Compressed images (xz, zlib/gzip, zstd) and delta images (see uwf_delta,
+	given the path of the base image) are expanded in memory instead, so no
+	temporary full-size file is written
+	With index=False the sections are left for the caller to restore (see uwf_cache)
+	"""
+	def __init__(self, path, base_path=None, index=True):
+		self.path = path
+		self.sections = []
+		self.truncated = False
+		self.sha256 = None
+		self.error = None
+		self.map = None
+
+		self.file = open(path, 'rb')
+		try:
+			expanded = self.expand(base_path)
+		except (zlib.error, lzma.LZMAError, EOFError, ImportError, uwf_delta.DeltaError) as e:
+			self.error = '{}'.format(e)
+			expanded = bytearray()
+
+		if expanded is not None:
+			self.data = memoryview(expanded)
+		else:
+			try:
+				self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty files cannot be mapped
+				self.map = None
+			self.data = memoryview(self.map if self.map is not None else b'')
+		self.size = len(self.data)
+
+		if index:
+			self.index()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def expand(self, base_path):
+		"""
+		Returns the expanded image, or None for a plain UWF file
+		"""
+		expanded = expand(self.file)
+		if expanded is None:
+			is_delta = uwf_delta.is_delta(self.file.read(len(uwf_delta.DELTA_MAGIC)))
+			self.file.seek(0)
+			if not is_delta:
+				return None
+			expanded = bytearray(self.file.read())
+
+		if uwf_delta.is_delta(expanded):
+			if base_path is None:
+				raise uwf_delta.DeltaError('Delta image needs a base image')
+			expanded = uwf_delta.apply_delta(read_image(base_path), expanded)
+		return expanded
+
+	def index(self):
+		offset = 0
+		while offset < self.size:
+			header = self.data[offset:offset + UWF_COMMAND_HEADER_LENGTH]
+			if len(header) < UWF_COMMAND_HEADER_LENGTH:
+				self.truncated = True
+				break
+
+			command = header[:UWF_OFFSET_HEADER_COMMAND_ID].tobytes().decode('utf-8', 'replace')
+			length = struct.unpack('<I', header[UWF_OFFSET_HEADER_LENGTH_START:UWF_OFFSET_HEADER_LENGTH_END])[0]
+			offset += UWF_COMMAND_HEADER_LENGTH
+
+			if offset + length > self.size:
+				self.truncated = True
+				break
+
+			self.sections.append(UwfSection(command, offset, length))
+			offset += length
+
+	def payload(self, section):
+		"""
+		Returns a memoryview of the section payload
+		"""
+		return self.data[section.offset:section.offset + section.length]
+
+	def digest(self):
+		"""
+		Returns the SHA-256 hex digest of the whole image
+		"""
+		if self.sha256 is None:
+			self.sha256 = hashlib.sha256(self.data).hexdigest()
+		return self.sha256
+
+	def validate(self):
+		"""
+		Checks the structure of the image before anything is sent to the bootloader
+		Returns an error string or None
+		"""
+		if self.error != None:
+			return ERROR_IMAGE.format(self.error)
+		elif self.size == 0:
+			return ERROR_IMAGE.format('Empty image')
+		elif self.truncated:
+			return ERROR_IMAGE.format('Truncated section after offset {}'.format(self.sections[-1].offset + self.sections[-1].length if self.sections else 0))
+		return None
+
+	def close(self):
+		self.data.release()
+		if self.map is not None:
+			try:
+				self.map.close()
+			except BufferError:
+				# Payload views are still held (e.g. by a flash plan); the
+				# mapping is released with the last of them
+				pass
+		self.file.close()
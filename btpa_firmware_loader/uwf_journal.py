@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+
+JOURNAL_DIR = os.path.expanduser('~/.cache/lrd-bt-utils/journal')
+
+# Verified windows are written out every JOURNAL_SAVE_WINDOWS windows or
+# JOURNAL_SAVE_SEC seconds, whichever comes first; a resume may then repeat
+# the windows verified since the last save
+JOURNAL_SAVE_WINDOWS = 16
+JOURNAL_SAVE_SEC = 1.0
+
+WARNING_JOURNAL = 'uwf_journal: warning: {}\n'
+
+def journal_path(directory, port):
+	"""
+	Returns the journal file for a serial port, e.g. <directory>/dev_ttyS1.json
+	"""
+	name = port.strip('/').replace('/', '_').replace(':', '_')
+	return os.path.join(directory, name + '.json')
+
+class FlashJournal():
+	"""
+	Records flashing progress for one port: the image hash, the number of
+	erase sections completed, the write section in progress and the end of
+	its last verified window, plus the negotiated link settings
+	When resuming the same image, completed erases are skipped and each
+	write section restarts at its last verified address
+	Without a path the progress is only kept in memory, for in-place retries
+	A journal that cannot be written is reported once and otherwise ignored:
+	it only costs the resume, never the flash in progress
+	"""
+	def __init__(self, path, image_hash, resume=False):
+		self.path = path
+		self.image_hash = image_hash
+		self.settings = {}
+		self.unsaved = 0
+		self.saved_at = time.monotonic()
+		self.save_error = None
+
+		# Progress of this run
+		self.erase_count = 0
+		self.write_index = -1
+		self.verified_address = None
+		self.write_start = None
+
+		# Progress of the interrupted run, if resuming the same image
+		self.resume_erase_count = 0
+		self.resume_write_index = -1
+		self.resume_address = None
+		if resume and path is not None:
+			self.load()
+
+	def load(self):
+		try:
+			with open(self.path) as f:
+				entry = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+
+		if entry.get('image') == self.image_hash:
+			self.resume_erase_count = entry['erase_count']
+			self.resume_write_index = entry['write_index']
+			self.resume_address = entry['verified_address']
+
+	def save(self):
+		self.unsaved = 0
+		self.saved_at = time.monotonic()
+		if self.path is None:
+			return
+
+		entry = {
+			'image': self.image_hash,
+			'erase_count': self.erase_count,
+			'write_index': self.write_index,
+			'verified_address': self.verified_address,
+			'settings': self.settings,
+		}
+
+		# Replace the journal atomically so an interruption leaves the old or the new one
+		try:
+			directory = os.path.dirname(self.path)
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			temp_path = self.path + '.tmp'
+			with open(temp_path, 'w') as f:
+				json.dump(entry, f)
+			os.replace(temp_path, self.path)
+		except (IOError, OSError) as e:
+			if self.save_error is None:
+				sys.stderr.write(WARNING_JOURNAL.format('Cannot save {}, the flash cannot be resumed: {}'.format(self.path, e)))
+			self.save_error = e
+
+	def begin_erase(self):
+		"""
+		Returns True if this erase section already completed in the interrupted run
+		"""
+		if self.erase_count < self.resume_erase_count:
+			self.erase_count += 1
+			return True
+		return False
+
+	def end_erase(self):
+		self.erase_count += 1
+		self.save()
+
+	def begin_write(self, start, size):
+		"""
+		Returns the address this write section should start writing at
+		A repeat of the section in progress resumes at its last verified window
+		"""
+		if start == self.write_start and self.verified_address is not None:
+			return self.verified_address
+
+		self.write_start = start
+		self.write_index += 1
+		self.verified_address = start
+
+		if self.write_index < self.resume_write_index:
+			# Completed before the interruption
+			self.verified_address = start + size
+		elif self.write_index == self.resume_write_index and self.resume_address is not None:
+			self.verified_address = min(max(start, self.resume_address), start + size)
+
+		return self.verified_address
+
+	def verified(self, address):
+		"""
+		Records that everything up to 'address' in the current write section was verified
+		The file is only written every JOURNAL_SAVE_WINDOWS calls or JOURNAL_SAVE_SEC seconds
+		"""
+		self.verified_address = address
+		self.unsaved += 1
+		if self.unsaved >= JOURNAL_SAVE_WINDOWS or time.monotonic() - self.saved_at >= JOURNAL_SAVE_SEC:
+			self.save()
+
+	def rewind(self, address):
+		"""
+		Moves the verified end of the current write section back to 'address'
+		before the flash from there on is erased again
+		"""
+		if self.verified_address is not None and address < self.verified_address:
+			self.verified_address = max(self.write_start, address)
+			self.save()
+
+	def finish(self):
+		"""
+		Removes the journal once the whole image was programmed
+		"""
+		if self.path is None:
+			return
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+
+# FUP_OPTION_CURRENT_BAUDRATE values known for the enhanced bootloader; extend
+# this table to let negotiation consider more baudrates
+FUP_BAUDRATE_SETTINGS = {
+	1000000: 0xa,
+}
+
+# FUP_OPTION_CURRENT_WRITE_LEN_BYTES values known for the enhanced bootloader,
+# keyed by write block size; 0x0 is the bootloader's default length, which
+# keeps the one-byte length field of the legacy write command
+FUP_WRITE_LEN_SETTINGS = {
+	252: 0x0,
+	8192: 0x2,
+}
+
+# Write/data pairs of the candidate's write length sent to probe each candidate
+NEGOTIATION_PROBE_BLOCKS = 2
+
+LINK_CACHE_PATH = os.path.expanduser('~/.cache/lrd-bt-utils/link.json')
+
+def link_candidates(current, failed=()):
+	"""
+	Returns the (baudrate, write block size) pairs to probe, fastest first:
+	each known baudrate faster than the current one, then the current one, with
+	the known write lengths from the largest, leaving out the 'failed' pairs
+	"""
+	baudrates = sorted([baudrate for baudrate in FUP_BAUDRATE_SETTINGS if baudrate > current], reverse=True)
+	block_sizes = sorted(FUP_WRITE_LEN_SETTINGS, reverse=True)
+	return [(baudrate, block_size) for baudrate in baudrates + [current] for block_size in block_sizes
+		if (baudrate, block_size) not in failed]
+
+def cache_key(port, device_id):
+	return '{}:{}'.format(port, device_id)
+
+class LinkCache():
+	"""
+	JSON file remembering the negotiated link settings per port and device ID
+	"""
+	def __init__(self, path=LINK_CACHE_PATH):
+		self.path = path
+		self.lock = threading.Lock()
+		try:
+			with open(path) as f:
+				self.entries = json.load(f)
+		except (IOError, OSError, ValueError):
+			self.entries = {}
+
+	def get(self, key):
+		with self.lock:
+			return self.entries.get(key)
+
+	def put(self, key, baudrate, write_block_size, turnaround):
+		with self.lock:
+			self.entries[key] = {
+				'baudrate': baudrate,
+				'write_block_size': write_block_size,
+				'turnaround': turnaround,
+			}
+			self.save()
+
+	def remove(self, key):
+		with self.lock:
+			if self.entries.pop(key, None) is not None:
+				self.save()
+
+	def save(self):
+		try:
+			directory = os.path.dirname(self.path)
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			with open(self.path, 'w') as f:
+				json.dump(self.entries, f, indent=1, sort_keys=True)
+		except (IOError, OSError):
+			# A cache that cannot be written only costs a probe next time
+			pass
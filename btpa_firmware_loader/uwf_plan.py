@@ -0,0 +1,226 @@
+import struct
+import collections
+import uwf_checksum
+import uwf_erase
+from uwf_erase import EraseRange
+from uwf_image import UWF_COMMAND_TARGET_PLATFORM
+from uwf_image import UWF_COMMAND_REGISTER
+from uwf_image import UWF_COMMAND_SECTOR_MAP
+from uwf_image import UWF_COMMAND_ERASE
+from uwf_image import UWF_COMMAND_WRITE
+from uwf_image import UWF_WRITE_BLOCK_LENGTH
+from uwf_image import is_known_section
+
+ERROR_PLAN = 'uwf_plan: {}\n'
+WARNING_PLAN = 'uwf_plan: warning: {}\n'
+
+# Wire size of each bootloader command, excluding any data payload
+PLAN_ERASE_COMMAND_SIZE = 5
+PLAN_WRITE_COMMAND_SIZE = 6
+PLAN_WRITE_COMMAND_SIZE_ENHANCED = 7
+PLAN_DATA_OVERHEAD_SIZE = 2
+PLAN_VERIFY_COMMAND_SIZE = 13
+PLAN_ACK_SIZE = 1
+
+# 8N1 framing: one start and one stop bit per byte
+PLAN_BITS_PER_BYTE = 10
+
+# Assumed time between sending a command and receiving its ack, on top of the wire time
+PLAN_TURNAROUND_SEC = 0.001
+
+# Absolute flash ranges; 'payload' is a memoryview of the data to write
+WriteRange = collections.namedtuple('WriteRange', ['start', 'size', 'payload'])
+VerifyCheckpoint = collections.namedtuple('VerifyCheckpoint', ['start', 'size'])
+
+class FlashPlan():
+	"""
+	In-memory description of everything a UWF image will do to the flash:
+	erase ranges, write ranges, verify checkpoints and the expected traffic
+	"""
+	def __init__(self, write_block_size, verify_write_limit, enhanced_mode):
+		self.write_block_size = write_block_size
+		self.verify_write_limit = verify_write_limit
+		self.enhanced_mode = enhanced_mode
+
+		self.platform_id = None
+		self.base_address = None
+		self.bank_size = 0
+		self.sectors = 0
+		self.sector_size = 0
+
+		self.erase_ranges = []
+		self.erase_after_write = False
+		self.write_ranges = []
+		self.verify_checkpoints = []
+		self.errors = []
+		self.warnings = []
+
+		self.erase_packets = 0
+		self.write_packets = 0
+		self.verify_packets = 0
+		self.write_bytes = 0
+
+	def checksum(self, start, size):
+		"""
+		Returns the byte sum the flash range will hold once the plan is programmed
+		Bytes outside the write ranges are expected to be erased (0xff)
+		"""
+		end = start + size
+		covered = 0
+		total = 0
+		for write in self.write_ranges:
+			low = max(start, write.start)
+			high = min(end, write.start + write.size)
+			if low < high:
+				total += uwf_checksum.checksum(write.payload[low - write.start:high - write.start])
+				covered += high - low
+		return total + 0xff * (size - covered)
+
+	def round_trips(self):
+		"""
+		Returns the number of command/ack exchanges (each write block is a write and a data exchange)
+		"""
+		return self.erase_packets + 2 * self.write_packets + self.verify_packets
+
+	def wire_bytes(self):
+		"""
+		Returns the number of bytes sent and received over the serial port
+		"""
+		if self.enhanced_mode:
+			write_command_size = PLAN_WRITE_COMMAND_SIZE_ENHANCED
+		else:
+			write_command_size = PLAN_WRITE_COMMAND_SIZE
+
+		return (self.erase_packets * PLAN_ERASE_COMMAND_SIZE +
+			self.write_packets * (write_command_size + PLAN_DATA_OVERHEAD_SIZE) +
+			self.write_bytes +
+			self.verify_packets * PLAN_VERIFY_COMMAND_SIZE +
+			self.round_trips() * PLAN_ACK_SIZE)
+
+	def estimate_seconds(self, baudrate, turnaround=PLAN_TURNAROUND_SEC):
+		"""
+		Returns the estimated erase and write time at the given baudrate
+		"""
+		return self.wire_bytes() * PLAN_BITS_PER_BYTE / float(baudrate) + self.round_trips() * turnaround
+
+	def describe(self, baudrate=None):
+		"""
+		Returns a printable summary of the plan
+		"""
+		lines = []
+		lines.append('platform: {}'.format(self.platform_id))
+		if self.base_address is not None:
+			lines.append('bank: base 0x{:08x} size 0x{:x}'.format(self.base_address, self.bank_size))
+		lines.append('sector map: {} x 0x{:x}'.format(self.sectors, self.sector_size))
+		for erase in self.erase_ranges:
+			lines.append('erase  0x{:08x}-0x{:08x} ({} bytes)'.format(erase.start, erase.start + erase.size, erase.size))
+		for write in self.write_ranges:
+			lines.append('write  0x{:08x}-0x{:08x} ({} bytes)'.format(write.start, write.start + write.size, write.size))
+		lines.append('verify checkpoints: {}'.format(len(self.verify_checkpoints)))
+		lines.append('packets: {} erase, {} write/data, {} verify'.format(self.erase_packets, self.write_packets, self.verify_packets))
+		lines.append('bytes: {} to write, {} on the wire, {} round trips'.format(self.write_bytes, self.wire_bytes(), self.round_trips()))
+		if baudrate:
+			lines.append(self.describe_estimate(baudrate))
+		return '\n'.join(lines) + '\n'
+
+	def describe_estimate(self, baudrate):
+		"""
+		Returns the estimated time at the given baudrate, with the link settings the plan was compiled for
+		"""
+		erases = ' and 64 KiB erases' if self.enhanced_mode else ''
+		return 'estimated time at {} baud with {} byte writes{}: {:.1f} s'.format(baudrate, self.write_block_size, erases, self.estimate_seconds(baudrate))
+
+def blocks(size, block_size):
+	"""
+	Returns the number of block_size blocks needed to cover size bytes
+	"""
+	return (size + block_size - 1) // block_size
+
+def compile_flash_plan(image, write_block_size=252, verify_write_limit=8, enhanced_mode=False):
+	"""
+	Builds a FlashPlan from an indexed UwfImage and checks it against the
+	register device and sector map records. Problems are collected in plan.errors;
+	unknown sections, which the processors skip, are noted in plan.warnings
+	"""
+	plan = FlashPlan(write_block_size, verify_write_limit, enhanced_mode)
+
+	for section in image.sections:
+		data = image.payload(section)
+
+		if not is_known_section(section):
+			plan.warnings.append(WARNING_PLAN.format('Skipping unknown section {!r} with length {} at offset {}'.format(section.command, section.length, section.offset)))
+		elif section.command == UWF_COMMAND_TARGET_PLATFORM:
+			plan.platform_id = data.tobytes()
+		elif section.command == UWF_COMMAND_REGISTER:
+			plan.base_address = struct.unpack('<I', data[1:5])[0]
+			plan.bank_size = struct.unpack('<I', data[6:10])[0]
+		elif section.command == UWF_COMMAND_SECTOR_MAP:
+			plan.sectors, plan.sector_size = struct.unpack('<II', data[:8])
+			if plan.sectors * plan.sector_size > plan.bank_size:
+				plan.errors.append(ERROR_PLAN.format('Sector map larger than the bank'))
+		elif section.command == UWF_COMMAND_ERASE:
+			if plan.platform_id is None or plan.base_address is None or plan.sector_size == 0:
+				plan.errors.append(ERROR_PLAN.format('Erase before target platform, register device, or sector map'))
+				continue
+			start, size = struct.unpack('<II', data[:8])
+			if size >= plan.bank_size or start + size > plan.bank_size:
+				plan.errors.append(ERROR_PLAN.format('Erase 0x{:x}+0x{:x} outside the bank'.format(start, size)))
+			elif start % plan.sector_size:
+				plan.errors.append(ERROR_PLAN.format('Erase 0x{:x} not sector aligned'.format(start)))
+			else:
+				# The processors erase whole sectors
+				erase = EraseRange(plan.base_address + start, blocks(size, plan.sector_size) * plan.sector_size)
+				for write in plan.write_ranges:
+					if erase.start < write.start + write.size and write.start < erase.start + erase.size:
+						plan.erase_after_write = True
+				plan.erase_ranges.append(erase)
+		elif section.command == UWF_COMMAND_WRITE:
+			if not plan.erase_ranges:
+				plan.errors.append(ERROR_PLAN.format('Write before erase'))
+				continue
+			offset = struct.unpack('<I', data[:4])[0]
+			payload = data[UWF_WRITE_BLOCK_LENGTH:]
+			size = len(payload)
+			start = plan.base_address + offset
+			if size >= plan.bank_size or offset + size > plan.bank_size:
+				plan.errors.append(ERROR_PLAN.format('Write 0x{:x}+0x{:x} outside the bank'.format(offset, size)))
+				continue
+			if not is_erased(plan, start, size):
+				plan.errors.append(ERROR_PLAN.format('Write 0x{:08x}+0x{:x} not covered by an erase'.format(start, size)))
+			for write in plan.write_ranges:
+				if start < write.start + write.size and write.start < start + size:
+					plan.errors.append(ERROR_PLAN.format('Write 0x{:08x}+0x{:x} overlaps an earlier write'.format(start, size)))
+					break
+
+			plan.write_ranges.append(WriteRange(start, size, payload))
+			plan.write_bytes += size
+			plan.write_packets += blocks(size, write_block_size)
+
+			# One verify per 'verify_write_limit' blocks
+			window = write_block_size * verify_write_limit
+			for position in range(0, size, window):
+				plan.verify_checkpoints.append(VerifyCheckpoint(start + position, min(window, size - position)))
+			plan.verify_packets += blocks(size, window)
+
+	if plan.sector_size:
+		ranges = uwf_erase.batch_ranges(plan) or plan.erase_ranges
+		plan.erase_packets = len(uwf_erase.erase_commands(ranges, plan.sector_size, uwf_erase.ERASE_BLOCK_64K if enhanced_mode else None))
+
+	if plan.platform_id is None:
+		plan.errors.append(ERROR_PLAN.format('No target platform section'))
+	if not plan.write_ranges:
+		plan.errors.append(ERROR_PLAN.format('No write sections'))
+
+	return plan
+
+def is_erased(plan, start, size):
+	"""
+	Returns True if every byte of the range lies in one of the plan's erase ranges
+	"""
+	end = start + size
+	for erase in sorted(plan.erase_ranges):
+		if erase.start <= start < erase.start + erase.size:
+			start = erase.start + erase.size
+			if start >= end:
+				return True
+	return start >= end
@@ -1,19 +1,49 @@
+import time
 import serial
 import binascii
 import struct
+import inspect
+import uwf_link
+import uwf_journal
+import uwf_erase
+import uwf_protocol
+import uwf_errors
+import uwf_gpio
+import itertools
+from uwf_image import UWF_COMMAND_TARGET_PLATFORM
+from uwf_image import UWF_COMMAND_REGISTER
+from uwf_image import UWF_COMMAND_SELECT
+from uwf_image import UWF_COMMAND_SECTOR_MAP
+from uwf_image import UWF_COMMAND_ERASE
+from uwf_image import UWF_COMMAND_WRITE
+from uwf_image import UWF_COMMAND_UNREGISTER
+from uwf_image import is_known_section
+from uwf_gpio import GPIO_BASE_PATH
+from uwf_gpio import GPIO_CARD_NRESET
+from uwf_gpio import GPIO_BT_BOOT_MODE
+from uwf_gpio import GPIO_BACKEND_AUTO
+from uwf_gpio import GPIO_LINES
+from uwf_gpio import GPIO_RESET_PULSE_SEC
 
 DEVICE_TYPE_IG60 = 'IG60'
 
 SERIAL_TIMEOUT_SEC = 3
 
-COMMAND_SYNC_WITH_BOOTLOADER = '80'
-COMMAND_PLATFORM_CHECK = 'p'
-COMMAND_ERASE_SECTOR = 'e'
-COMMAND_WRITE_SECTOR = 'w'
-COMMAND_DATA_SECTION = 'd'
-COMMAND_VERIFY_DATA = 'v'
-COMMAND_SETTINGS_SET = 's'
-COMMAND_BOOTLOADER_VERSION = 'V'
+# After a reset the bootloader is polled with the sync command until it answers,
+# for at most BOOTLOADER_READY_TIMEOUT_SEC; each poll waits BOOTLOADER_POLL_SEC.
+# Late answers to earlier polls are dropped once none came for BOOTLOADER_QUIET_SEC
+BOOTLOADER_READY_TIMEOUT_SEC = SERIAL_TIMEOUT_SEC
+BOOTLOADER_POLL_SEC = 0.05
+BOOTLOADER_QUIET_SEC = 0.2
+
+from uwf_protocol import COMMAND_SYNC_WITH_BOOTLOADER
+from uwf_protocol import COMMAND_PLATFORM_CHECK
+from uwf_protocol import COMMAND_ERASE_SECTOR
+from uwf_protocol import COMMAND_WRITE_SECTOR
+from uwf_protocol import COMMAND_DATA_SECTION
+from uwf_protocol import COMMAND_VERIFY_DATA
+from uwf_protocol import COMMAND_SETTINGS_SET
+from uwf_protocol import COMMAND_BOOTLOADER_VERSION
 
 UWF_OFFSET_HANDLE = 1
 UWF_OFFSET_BANK = 2
@@ -42,21 +72,71 @@ ERROR_TARGET_PLATFORM = 'process_command_target_platform: {}\n'
 ERROR_REGISTER_DEVICE = 'process_command_register_device: {}\n'
 ERROR_ERASE_BLOCKS = 'process_command_erase_blocks: {}\n'
 ERROR_WRITE_BLOCKS = 'process_command_write_blocks: {}\n'
+ERROR_AUDIT = 'audit_image: {}\n'
+ERROR_NEGOTIATE = 'negotiate_link: {}\n'
+
+# Number of times a verify window is resent before aborting
+WRITE_RETRY_LIMIT = 3
+
+# Number of times a section that failed with a retryable error is repeated in
+# place, and the time left for late responses to arrive before each retry
+SECTION_RETRY_LIMIT = 2
+SECTION_RETRY_SETTLE_SEC = 0.1
+
+# Number of erase commands in flight in enhanced mode
+ERASE_PIPELINE_DEPTH = 4
+
+# Bounds of the verify interval (in blocks) when it adapts to the link
+VERIFY_WRITE_LIMIT_MIN = 1
+VERIFY_WRITE_LIMIT_MAX = 64
 
-GPIO_BASE_PATH = '/sys/devices/platform/gpio/'
-GPIO_CARD_NRESET = 'card_nreset'
-GPIO_BT_BOOT_MODE = 'bt_boot_mode'
+# Verify-only audits: largest verify window tried first, and the smallest window
+# a failed window is split into, which is the resolution of the mismatch map
+AUDIT_WINDOW_MAX = 0x100000
+AUDIT_WINDOW_MIN = 256
 
 BT_BOOTLOADER_MODE = 0
 BT_FIRMWARE_MODE = 1
 
+FUP_OPTION_CURRENT_ERASE_LEN_BYTES = 0x0000
 FUP_OPTION_CURRENT_WRITE_LEN_BYTES = 0x0002
 FUP_OPTION_CURRENT_BAUDRATE = 0x0005
 
 #Version numbed used to differentiate legacy and enhanced bootloaders
 FUP_EXTENDED_VERSION_NUMBER = 6
 
-def init_processor(type, port, baudrate):
+# Write block size of legacy bootloaders, and of the default write length setting
+LEGACY_WRITE_BLOCK_SIZE = 252
+
+# Link settings used with enhanced bootloaders
+ENHANCED_BAUDRATE = 1000000
+ENHANCED_BAUDRATE_SETTING = 0xa
+ENHANCED_WRITE_BLOCK_SIZE = 8192
+ENHANCED_WRITE_LEN_SETTING = 0x2
+
+# I/O requests yielded by the protocol steps (the *_steps methods and the helpers
+# they delegate to). Each is a tuple of the name of the hook that performs it
+# and its arguments; run() returns the hook's result to the steps
+#   IO_EXCHANGE (data, resp_size): sends a command and returns its response
+#   IO_WRITE (data): sends without waiting for a response
+#   IO_READ (size, timeout): returns up to 'size' bytes; a None timeout is the port's
+#   IO_READ_ACKS (count): returns True if 'count' acknowledgements arrived
+#   IO_RESET_INPUT (): drops unread input
+#   IO_BAUDRATE (baudrate): switches the local port to the baudrate
+#   IO_SLEEP (seconds)
+#   IO_CALL (function, *args): calls a blocking function (GPIO, DBus, journal file),
+#     which the asyncio processors run in an executor
+IO_EXCHANGE = 'write_to_comm'
+IO_WRITE = 'write_frame'
+IO_READ = 'read_port'
+IO_READ_ACKS = 'read_acks'
+IO_RESET_INPUT = 'reset_input'
+IO_BAUDRATE = 'set_port_baudrate'
+IO_SLEEP = 'sleep'
+IO_CALL = 'call'
+
+def init_processor(type, port, baudrate, ready_timeout=BOOTLOADER_READY_TIMEOUT_SEC,
+		gpio_backend=GPIO_BACKEND_AUTO, reset_pulse=GPIO_RESET_PULSE_SEC, reset_lines=GPIO_LINES):
 	"""
 	Instantiates and returns the requested processor
 	"""
@@ -70,7 +150,15 @@ def init_processor(type, port, baudrate):
 		# Use the generic processor
 		processor = UwfProcessor(port, baudrate)
 
-	processor.enter_bootloader()
+	processor.ready_timeout = ready_timeout
+	processor.gpio_backend = gpio_backend
+	processor.reset_pulse = reset_pulse
+	processor.reset_lines = reset_lines
+	try:
+		processor.enter_bootloader()
+	except Exception:
+		processor.close()
+		raise
 
 	return processor
 
@@ -89,99 +177,615 @@ class UwfProcessor():
 		self.port = port
 		self.enhanced_mode = False
 
-		# Number of bytes of data to write for each write command
-		self.write_block_size = 252
+		# Number of bytes of data to write for each write command, and the write
+		# length setting sent for it (None: the bootloader's default); the write
+		# command carries a two-byte length once the setting is non-zero
+		self.write_block_size = LEGACY_WRITE_BLOCK_SIZE
+		self.write_len_setting = None
 
 		# The number of data blocks writes to perform before verifying
 		self.verify_write_limit = 8
 
+		# Number of write/data pairs allowed in flight before waiting for
+		# their acknowledgements; 0 disables pipelining
+		self.pipeline_window = 0
+
+		# When set, verify_write_limit grows while verify windows succeed and
+		# shrinks after a failure, and failed windows are resent instead of aborting
+		self.adaptive_verify = False
+
+		# Flash plan of the image being processed; needed for differential flashing
+		self.plan = None
+
+		# Precomputed block checksums keyed by write block size (see uwf_cache)
+		self.checksum_tables = None
+
+		# Retries of a section that failed with a retryable error (see uwf_errors)
+		self.section_retries = SECTION_RETRY_LIMIT
+
+		# Verify window sizes of audit_image; audit_window shrinks to the largest
+		# window the bootloader is found to accept
+		self.audit_window = AUDIT_WINDOW_MAX
+		self.audit_min_window = AUDIT_WINDOW_MIN
+		self.audit_verifies = 0
+
+		# Erase size the bootloader is currently set to (None until changed from sectors),
+		# and whether the first erase record already erased the whole image
+		self.erase_unit = None
+		self.erase_batch_done = False
+
+		# When set, sectors that already hold the new image are neither erased nor rewritten
+		self.differential = False
+		self.current_sectors = set()
+
+		# Flash range of the window that failed before it verified and is being
+		# written again without an erase (see rewrite_failed_window)
+		self.unerased_window = None
+
+		# When set, enhanced bootloaders are probed for the fastest stable baudrate
+		# and write length instead of always switching to ENHANCED_BAUDRATE and
+		# ENHANCED_WRITE_BLOCK_SIZE; the choice is kept in link_cache (a
+		# uwf_link.LinkCache) per port and device ID. failed_links holds the
+		# (baudrate, write block size) pairs found unstable, and probed_ranges the
+		# flash the probes wrote erased blocks to, which is always erased again;
+		# verify-only audits clear probe_writes and keep the link as it is
+		self.negotiate = False
+		self.link_cache = None
+		self.device_id = None
+		self.link_turnaround = None
+		self.failed_links = set()
+		self.probed_ranges = []
+		self.probe_writes = True
+
+		# Baudrate the port was opened with; when negotiation finds no stable link,
+		# legacy_link is set and the bootloader is restarted and driven in legacy mode
+		self.initial_baudrate = baudrate
+		self.legacy_link = False
+
+		# Progress journal (uwf_journal.FlashJournal) updated after every verified
+		# window, and written to a file in journal_dir (JOURNAL_DIR with resume
+		# and no journal_dir) at most every JOURNAL_SAVE_WINDOWS windows or
+		# JOURNAL_SAVE_SEC; with resume, completed work is skipped. Without
+		# either, the journal is only kept in memory
+		self.journal_dir = None
+		self.resume = False
+		self.journal = None
+
+		# Reusable command frames
+		self.encoder = uwf_protocol.ProtocolEncoder()
+
+		# ATS response received while waiting for the bootloader, if any
+		self.ready_timeout = BOOTLOADER_READY_TIMEOUT_SEC
+		self.sync_response = None
+
+		# Boot mode and reset lines (see uwf_gpio), opened on the first reset and
+		# held until the reboot; the width of the reset pulse in seconds, and the
+		# names of the (boot mode, reset) lines of this port's module
+		self.gpio_backend = GPIO_BACKEND_AUTO
+		self.reset_pulse = GPIO_RESET_PULSE_SEC
+		self.reset_lines = GPIO_LINES
+		self.gpio = None
+
 		# Open the COM port to the Bluetooth adapter
-		self.ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT_SEC)
+		self.ser = self.open_port(baudrate)
+
+	def open_port(self, baudrate):
+		"""
+		Opens the COM port to the Bluetooth adapter at the given baudrate
+		"""
+		return serial.Serial(self.port, baudrate, timeout=SERIAL_TIMEOUT_SEC)
+
+	def run(self, steps):
+		"""
+		Drives protocol steps (see the IO_* requests) with blocking I/O
+		Returns the result of the steps; I/O errors are raised inside them
+		"""
+		response = None
+		error = None
+		while True:
+			try:
+				if error is not None:
+					request = steps.throw(error)
+				else:
+					request = steps.send(response)
+			except StopIteration as stop:
+				return stop.value
+
+			error = None
+			try:
+				response = getattr(self, request[0])(*request[1:])
+			except Exception as e:
+				error = e
+
+	# The I/O hooks performing the IO_* requests; AsyncUwfProcessor replaces them with coroutines
 
 	def write_to_comm(self, data, resp_size):
 		self.ser.write(data)
 		return self.ser.read(resp_size)
 
+	def write_frame(self, data):
+		self.ser.write(data)
+
+	def read_port(self, size, timeout=None):
+		"""
+		Reads up to 'size' bytes, waiting at most 'timeout' seconds (by default the port's timeout)
+		"""
+		if timeout is None or timeout == self.ser.timeout:
+			return self.ser.read(size)
+
+		saved = self.ser.timeout
+		self.ser.timeout = timeout
+		try:
+			return self.ser.read(size)
+		finally:
+			self.ser.timeout = saved
+
+	def read_acks(self, count):
+		"""
+		Reads the acknowledgements of 'count' commands sent without waiting
+		Returns True only if all of them were acknowledged
+		"""
+		response = self.ser.read(count * RESPONSE_ACKNOWLEDGE_SIZE)
+		return response == bytearray(RESPONSE_ACKNOWLEDGE * count, 'utf-8')
+
+	def reset_input(self):
+		self.ser.reset_input_buffer()
+
+	def set_port_baudrate(self, baudrate):
+		self.port_close()
+		self.ser = self.open_port(baudrate)
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+	def call(self, function, *args):
+		return function(*args)
+
+	def build_write_command(self, offset, bytes_to_write):
+		return self.encoder.write(offset, bytes_to_write, bool(self.write_len_setting))
+
+	def build_data_command(self, data, checksum=None):
+		"""
+		Returns the data command for the given block and the full checksum of the block
+		"""
+		return self.encoder.data(data, checksum)
+
+	def block_checksum(self, address, size):
+		"""
+		Returns the precomputed checksum of the block to write at 'address', or None
+		"""
+		if self.checksum_tables is None:
+			return None
+		table = self.checksum_tables.get(self.write_block_size)
+		if table is None:
+			return None
+		return table.lookup(address, size)
+
+	def build_verify_command(self, start, size, checksum):
+		return self.encoder.verify(start, size, checksum)		# Need the full checksum here
+
 	def port_close(self):
 		self.ser.close()
 
+	def open_gpio(self):
+		"""
+		Returns the GPIO lines of the module
+		"""
+		return uwf_gpio.open_gpio(self.gpio_backend, self.reset_pulse, self.reset_lines)
+
+	def gpio_lines(self):
+		if self.gpio is None:
+			self.gpio = self.open_gpio()
+		return self.gpio
+
+	def close_gpio(self):
+		if self.gpio is not None:
+			self.gpio.close()
+			self.gpio = None
+
+	def close(self):
+		"""
+		Releases the GPIO lines and the port; may be called more than once
+		"""
+		try:
+			self.close_gpio()
+		finally:
+			self.port_close()
+
 	def set_gpio_value(self, gpio_name, value):
-		with open(GPIO_BASE_PATH + gpio_name + '/value', 'w') as f:
-			f.write('%d' % int(value))
+		self.gpio_lines().set({gpio_name: value})
+
+	def reset_into_bootloader(self):
+		"""
+		Resets the module with the boot mode pin selecting the bootloader
+		"""
+		self.gpio_lines().reset(BT_BOOTLOADER_MODE)
+
+	def reset_into_firmware(self):
+		"""
+		Resets the module with the boot mode pin selecting the firmware
+		"""
+		self.gpio_lines().reset(BT_FIRMWARE_MODE)
+
+	# Entry points, including the process_command_* handlers that talk to the
+	# bootloader: each drives its *_steps with run(), so in the asyncio
+	# processors they return awaitables
 
 	def enter_bootloader(self):
-		self.set_gpio_value(GPIO_BT_BOOT_MODE, BT_BOOTLOADER_MODE)
-		self.set_gpio_value(GPIO_CARD_NRESET, 0)
-		self.set_gpio_value(GPIO_CARD_NRESET, 1)
-                # Clear the serial line before starting
-		self.ser.readline()
-		return True
+		"""
+		Resets the module into its bootloader and waits until it answers
+		Returns False if it did not answer within ready_timeout
+		"""
+		return self.run(self.enter_bootloader_steps())
+
+	def wait_for_bootloader(self):
+		return self.run(self.wait_for_bootloader_steps())
+
+	def process_image(self, image):
+		return self.run(self.process_image_steps(image))
+
+	def audit_image(self, image):
+		return self.run(self.audit_image_steps(image))
+
+	def process_reboot(self):
+		return self.run(self.process_reboot_steps())
 
 	def process_setting_set(self, fup_option, set_value):
-		command = bytearray(COMMAND_SETTINGS_SET, 'utf-8')
-		command.append(fup_option & 0xff)
-		command.append((fup_option & 0xff00) >> 8)
-		command.append(set_value & 0xff)
-		command.append(0x00)
-		command.append(0x00)
-		command.append(0x00)
-		response = self.write_to_comm(command, RESPONSE_SET_SIZE)
-		return response
+		return self.run(self.process_setting_set_steps(fup_option, set_value))
 
 	def process_bootloader_version(self):
-		version_command = bytearray(COMMAND_BOOTLOADER_VERSION, 'utf-8')
-		response = self.write_to_comm(version_command, RESPONSE_VERSION_SIZE)
-		return response
+		return self.run(self.process_bootloader_version_steps())
 
 	def enhanced_mode_check(self):
-		version = self.process_bootloader_version()
+		return self.run(self.enhanced_mode_check_steps())
+
+	def process_command_target_platform(self, data):
+		return self.run(self.process_command_target_platform_steps(data))
+
+	def process_command_erase_blocks(self, data):
+		return self.run(self.process_command_erase_blocks_steps(data))
+
+	def process_command_write_blocks(self, data):
+		return self.run(self.process_command_write_blocks_steps(data))
+
+	def enter_bootloader_steps(self):
+		yield (IO_CALL, self.reset_into_bootloader)
+		return (yield from self.wait_for_bootloader_steps())
+
+	def wait_for_bootloader_steps(self):
+		"""
+		Polls with the sync command, each poll waiting BOOTLOADER_POLL_SEC for the
+		first byte of the ATS response. The complete response is kept for the
+		target platform record, which then does not sync again
+		Earlier polls the module answered late are waited for and dropped
+		"""
+		deadline = time.time() + self.ready_timeout
+		polls = 0
+		while time.time() < deadline:
+			# Drop anything the module sent while it was resetting
+			yield (IO_RESET_INPUT,)
+			yield (IO_WRITE, uwf_protocol.SYNC_FRAME)
+			polls += 1
+			response = yield (IO_READ, 1, BOOTLOADER_POLL_SEC)
+			if len(response):
+				response += yield (IO_READ, RESPONSE_ATS_SIZE - 1, None)
+				if len(response) == RESPONSE_ATS_SIZE:
+					if polls > 1:
+						yield from self.drain_input(BOOTLOADER_QUIET_SEC, deadline)
+					self.sync_response = response
+					return True
+		return False
+
+	def drain_input(self, quiet, deadline):
+		"""
+		Reads and drops input until none arrives for 'quiet' seconds, or until the deadline
+		"""
+		while time.time() < deadline:
+			response = yield (IO_READ, RESPONSE_ATS_SIZE, quiet)
+			if not len(response):
+				break
+		yield (IO_RESET_INPUT,)
+
+	def build_setting_command(self, fup_option, set_value):
+		return self.encoder.setting(fup_option, set_value)
+
+	def process_setting_set_steps(self, fup_option, set_value):
+		command = self.build_setting_command(fup_option, set_value)
+		response = yield (IO_EXCHANGE, command, RESPONSE_SET_SIZE)
+		return response
+
+	def process_bootloader_version_steps(self):
+		response = yield (IO_EXCHANGE, uwf_protocol.VERSION_FRAME, RESPONSE_VERSION_SIZE)
+		return response
+
+	def is_enhanced_bootloader(self, version):
+		"""
+		Returns True if the version response comes from an enhanced bootloader
+		"""
 		version = version.decode('utf-8').split('.',1)[0][1:]
-		if int(version) >= FUP_EXTENDED_VERSION_NUMBER:
+		return int(version) >= FUP_EXTENDED_VERSION_NUMBER
+
+	def enhanced_mode_check_steps(self):
+		version = yield from self.process_bootloader_version_steps()
+		if self.legacy_link:
+			# Negotiation found no stable link; stay at the port's baudrate and write size
+			self.enhanced_mode = False
+			self.write_block_size = LEGACY_WRITE_BLOCK_SIZE
+			self.write_len_setting = None
+		elif self.is_enhanced_bootloader(version) and self.negotiate:
 			self.enhanced_mode = True
-			self.write_block_size = 8192
-			self.process_setting_set(FUP_OPTION_CURRENT_BAUDRATE, 0xa)
-			self.port_close()
-			self.ser = serial.Serial(self.port, 1000000, timeout=SERIAL_TIMEOUT_SEC)
-			self.process_setting_set(FUP_OPTION_CURRENT_WRITE_LEN_BYTES, 0x2)
+			yield from self.negotiate_link(version)
+		elif self.is_enhanced_bootloader(version):
+			self.enhanced_mode = True
+			self.write_block_size = ENHANCED_WRITE_BLOCK_SIZE
+			self.write_len_setting = ENHANCED_WRITE_LEN_SETTING
+			yield from self.process_setting_set_steps(FUP_OPTION_CURRENT_BAUDRATE, ENHANCED_BAUDRATE_SETTING)
+			yield (IO_BAUDRATE, ENHANCED_BAUDRATE)
+			yield from self.process_setting_set_steps(FUP_OPTION_CURRENT_WRITE_LEN_BYTES, ENHANCED_WRITE_LEN_SETTING)
 		else:
 			self.enhanced_mode = False
 
-	def process_command_target_platform(self, file, data_length):
+		self.record_link_settings()
+
+	def record_link_settings(self):
+		if self.journal is not None:
+			self.journal.settings = {
+				'baudrate': self.ser.baudrate,
+				'write_block_size': self.write_block_size,
+			}
+
+	def open_journal(self, image):
+		directory = self.journal_dir
+		if directory is None and self.resume:
+			directory = uwf_journal.JOURNAL_DIR
+		if directory is not None:
+			path = uwf_journal.journal_path(directory, self.port)
+			self.journal = uwf_journal.FlashJournal(path, image.digest(), self.resume)
+		else:
+			# In memory only, so a repeated write section resumes at its last verified window
+			self.journal = uwf_journal.FlashJournal(None, None)
+
+	def set_link_baudrate(self, baudrate):
+		"""
+		Switches the bootloader and then the local port to the given baudrate
+		"""
+		yield from self.process_setting_set_steps(FUP_OPTION_CURRENT_BAUDRATE, uwf_link.FUP_BAUDRATE_SETTINGS[baudrate])
+		yield (IO_BAUDRATE, baudrate)
+
+	def probe_address(self, block_size):
+		"""
+		Returns where to write the erased blocks probing a 'block_size' write
+		length: flash the image erases later, not verified yet and not probed
+		before, so no word is written twice between erases. Returns None
+		without such room
+		"""
+		if self.plan is None or not self.probe_writes:
+			return None
+		size = block_size * uwf_link.NEGOTIATION_PROBE_BLOCKS
+		verified = 0
+		if self.journal is not None:
+			verified = self.journal.verified_address or 0
+		for erase in uwf_erase.batch_ranges(self.plan) or self.plan.erase_ranges:
+			start = max(erase.start, verified)
+			for probed in sorted(self.probed_ranges):
+				if probed.start < start + size and start < probed.start + probed.size:
+					start = max(start, probed.start + probed.size)
+			if start + size <= erase.start + erase.size:
+				return start
+		return None
+
+	def probe_link(self, address, block_size):
+		"""
+		Writes NEGOTIATION_PROBE_BLOCKS erased (0xff) blocks of 'block_size' at
+		'address', which programs no bits, then verifies their range: real-sized
+		data frames whose checksum the bootloader checks
+		Returns the average round trip in seconds, or None if any response was wrong
+		"""
+		block = b'\xff' * block_size
+		size = block_size * uwf_link.NEGOTIATION_PROBE_BLOCKS
+		self.probed_ranges.append(uwf_erase.EraseRange(address, size))
+
+		start = time.time()
+		for offset in range(address, address + size, block_size):
+			response = yield (IO_EXCHANGE, self.build_write_command(offset, block_size), RESPONSE_ACKNOWLEDGE_SIZE)
+			if response.decode('utf-8') != RESPONSE_ACKNOWLEDGE:
+				return None
+			data_cmd_bytes, checksum = self.build_data_command(block)
+			response = yield (IO_EXCHANGE, data_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+			if response.decode('utf-8') != RESPONSE_ACKNOWLEDGE:
+				return None
+
+		# Only answered in step; the probed range may still hold programmed data
+		response = yield (IO_EXCHANGE, self.build_verify_command(address, size, 0xff * size), RESPONSE_ACKNOWLEDGE_SIZE)
+		if response.decode('utf-8') not in (RESPONSE_ACKNOWLEDGE, RESPONSE_ERROR):
+			return None
+		return (time.time() - start) / (2 * uwf_link.NEGOTIATION_PROBE_BLOCKS + 1)
+
+	def negotiate_link(self, version):
+		"""
+		Switches to the first (baudrate, write length) candidate of uwf_link,
+		fastest first, that carries a burst of real-sized writes cleanly (see
+		probe_link); a cached choice for this port and device is tried first
+		A failed probe leaves the bootloader out of step, so the candidate is
+		dropped and LinkError restarts the bootloader (see recover) for the next
+		one; once none is left, it is driven in legacy mode
+		"""
+		# The bootloader has just started with its default write length
+		self.write_block_size = LEGACY_WRITE_BLOCK_SIZE
+		self.write_len_setting = None
+
+		key = uwf_link.cache_key(self.port, self.device_id)
+		cached = None
+		if self.link_cache is not None:
+			cached = self.link_cache.get(key)
+
+		candidates = uwf_link.link_candidates(self.initial_baudrate, self.failed_links)
+		if cached is not None and (cached['baudrate'], cached['write_block_size']) in candidates:
+			cached = (cached['baudrate'], cached['write_block_size'])
+			candidates = [cached] + [candidate for candidate in candidates if candidate != cached]
+		else:
+			cached = None
+
+		# Without scratch flash to probe with, nothing is changed
+		candidates = [candidate for candidate in candidates if self.probe_address(candidate[1]) is not None]
+		if not candidates:
+			self.legacy_link = True
+			self.enhanced_mode = False
+			return
+
+		baudrate, block_size = candidates[0]
+		if baudrate != self.ser.baudrate:
+			yield from self.set_link_baudrate(baudrate)
+		setting = uwf_link.FUP_WRITE_LEN_SETTINGS[block_size]
+		response = yield from self.process_setting_set_steps(FUP_OPTION_CURRENT_WRITE_LEN_BYTES, setting)
+		turnaround = None
+		if len(response) == RESPONSE_SET_SIZE:
+			self.write_block_size = block_size
+			self.write_len_setting = setting
+			turnaround = yield from self.probe_link(self.probe_address(block_size), block_size)
+
+		if turnaround is None:
+			if cached is not None:
+				yield (IO_CALL, self.link_cache.remove, key)
+			self.failed_links.add((baudrate, block_size))
+			if block_size == min(uwf_link.FUP_WRITE_LEN_SETTINGS):
+				# Nothing larger gets through at this baudrate either
+				self.failed_links.update((baudrate, size) for size in uwf_link.FUP_WRITE_LEN_SETTINGS)
+			if not uwf_link.link_candidates(self.initial_baudrate, self.failed_links):
+				# The bootloader cannot be switched back without a setting for every
+				# baudrate, but it restarts at its default one
+				self.legacy_link = True
+				raise uwf_errors.LinkError(ERROR_NEGOTIATE.format('No stable link up to {} baud, restarting in legacy mode at {} baud'.format(
+					max([baudrate, self.initial_baudrate]), self.initial_baudrate)))
+			raise uwf_errors.LinkError(ERROR_NEGOTIATE.format('{} baud with {} byte writes is not stable, restarting the bootloader'.format(
+				baudrate, block_size)))
+
+		self.link_turnaround = turnaround
+		if self.link_cache is not None:
+			yield (IO_CALL, self.link_cache.put, key, self.ser.baudrate, self.write_block_size, turnaround)
+
+	def link_retry_free(self, error):
+		"""
+		Returns True for a failed link candidate with untried ones left, whose
+		repeat does not count against the section retries
+		"""
+		return isinstance(error, uwf_errors.LinkError) and not self.legacy_link
+
+	def section_handlers(self):
+		"""
+		Returns the handler for each UWF section command; for the commands that
+		talk to the bootloader, the *_steps of the handler
+		"""
+		return {
+			UWF_COMMAND_TARGET_PLATFORM: self.process_command_target_platform_steps,
+			UWF_COMMAND_REGISTER: self.process_command_register_device,
+			UWF_COMMAND_SELECT: self.process_command_select_device,
+			UWF_COMMAND_SECTOR_MAP: self.process_command_sector_map,
+			UWF_COMMAND_ERASE: self.process_command_erase_blocks_steps,
+			UWF_COMMAND_WRITE: self.process_command_write_blocks_steps,
+			UWF_COMMAND_UNREGISTER: self.process_command_unregister,
+		}
+
+	def process_section(self, handler, data):
+		error = handler(data)
+		if inspect.isgenerator(error):
+			error = yield from error
+		return error
+
+	def process_image_steps(self, image):
+		"""
+		Passes each known section of the UWF image to its handler
+		A section failing with a retryable error is repeated in place, up to
+		'section_retries' times without progress; a repeated write section
+		resumes at its last verified window
+		Raises the FlashError of a section that could not be completed
+		"""
+		handlers = self.section_handlers()
+		yield (IO_CALL, self.open_journal, image)
+
+		try:
+			for section in image.sections:
+				# Unknown sections are skipped, as uwf_plan warns
+				if is_known_section(section):
+					error = yield from self.process_section(handlers[section.command], image.payload(section))
+					retries = 0
+					while error != None and error.retryable and retries < self.section_retries and (yield from self.recover(error)):
+						progress = self.journal.verified_address or 0
+						counted = not self.link_retry_free(error)
+						error = yield from self.process_section(handlers[section.command], image.payload(section))
+						# Only repeats that verified nothing new count against the limit; a repair may rewind
+						if counted and (self.journal.verified_address or 0) <= progress:
+							retries += 1
+					if error != None:
+						raise error
+		except Exception:
+			# Write out the progress not saved yet, for a resume
+			yield (IO_CALL, self.journal.save)
+			raise
+
+		if self.journal is not None:
+			yield (IO_CALL, self.journal.finish)
+
+	def recover(self, error):
+		"""
+		Prepares the repeat of a section that failed with a retryable error:
+		drops late responses, syncs again after a sync failure and restarts the
+		bootloader after a failed link negotiation
+		Returns False if the bootloader no longer answers
+		"""
+		yield (IO_SLEEP, SECTION_RETRY_SETTLE_SEC)
+		if isinstance(error, uwf_errors.LinkError):
+			# Back to the baudrate the bootloader starts at
+			yield (IO_BAUDRATE, self.initial_baudrate)
+			return (yield from self.enter_bootloader_steps())
+		yield (IO_RESET_INPUT,)
+		if isinstance(error, uwf_errors.SyncError):
+			return (yield from self.wait_for_bootloader_steps())
+		return True
+
+	def process_command_target_platform_steps(self, data):
 		error = None
 
-		# Synchronize with the bootloader
-		port_cmd_bytes = bytearray.fromhex(COMMAND_SYNC_WITH_BOOTLOADER)
-		response = self.write_to_comm(port_cmd_bytes, RESPONSE_ATS_SIZE)
+		# Synchronize with the bootloader, unless it already answered while waiting for it
+		response = self.sync_response
+		self.sync_response = None
+		if response is None:
+			response = yield (IO_EXCHANGE, uwf_protocol.SYNC_FRAME, RESPONSE_ATS_SIZE)
 
 		if len(response) == RESPONSE_ATS_SIZE:
+			self.device_id = binascii.hexlify(response).decode('utf-8')
+
 			# Acknowledge the response
-			port_cmd_bytes = bytearray(RESPONSE_ACKNOWLEDGE, 'utf-8')
-			response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+			response = yield (IO_EXCHANGE, uwf_protocol.ACKNOWLEDGE_FRAME, RESPONSE_ACKNOWLEDGE_SIZE)
 
 			if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
 				# Send the target platform data
-				platform_command = bytearray(COMMAND_PLATFORM_CHECK, 'utf-8')
-				platform_id = file.read(data_length)
-				port_cmd_bytes = platform_command + platform_id
-				response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+				port_cmd_bytes = self.encoder.platform(data)
+				response = yield (IO_EXCHANGE, port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
 
 				if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
 					self.synchronized = True
 				elif response.decode('utf-8') == RESPONSE_ERROR:
-					error = ERROR_TARGET_PLATFORM.format('Invalid platform ID')
+					error = uwf_errors.DeviceError(ERROR_TARGET_PLATFORM.format('Invalid platform ID'))
 				else:
-					error = ERROR_TARGET_PLATFORM.format('Non-ack to platform ID')
+					error = uwf_errors.response_error(response, ERROR_TARGET_PLATFORM.format('Non-ack to platform ID'))
 			else:
-				error = ERROR_TARGET_PLATFORM.format('Non-ack or error in ATS acknowledge response')
+				error = uwf_errors.SyncError(ERROR_TARGET_PLATFORM.format('Non-ack or error in ATS acknowledge response'))
 		else:
-			error = ERROR_TARGET_PLATFORM.format('Failed to sync with the bootloader')
+			error = uwf_errors.SyncError(ERROR_TARGET_PLATFORM.format('Failed to sync with the bootloader'))
 
-		self.enhanced_mode_check()
+		# The bootloader version can only be read once synchronized
+		if self.synchronized:
+			try:
+				yield from self.enhanced_mode_check_steps()
+			except uwf_errors.LinkError as f:
+				self.synchronized = False
+				error = f
 
 		return error
 
-	def process_command_register_device(self, file, data_length):
-		register_device_data = file.read(data_length)
+	def process_command_register_device(self, data):
+		register_device_data = data
 		self.handle = struct.unpack('B', register_device_data[:UWF_OFFSET_HANDLE])[0]
 		self.base_address = struct.unpack('<I', register_device_data[UWF_OFFSET_HANDLE:UWF_OFFSET_BASE_ADDRESS])[0]
 		self.num_banks = struct.unpack('B', register_device_data[UWF_OFFSET_BASE_ADDRESS:UWF_OFFSET_NUM_BANKS])[0]
@@ -192,54 +796,245 @@ class UwfProcessor():
 
 		return None
 
-	def process_command_select_device(self, file, data_length):
-		select_device_data = file.read(data_length)
+	def process_command_select_device(self, data):
+		select_device_data = data
 		self.selected_handle = struct.unpack('B', select_device_data[:UWF_OFFSET_HANDLE])[0]
 		self.selected_bank = struct.unpack('B', select_device_data[UWF_OFFSET_HANDLE:UWF_OFFSET_BANK])[0]
 
 		return None
 
-	def process_command_sector_map(self, file, data_length):
-		sector_map_data = file.read(data_length)
+	def process_command_sector_map(self, data):
+		sector_map_data = data
 		self.sectors = struct.unpack('<I', sector_map_data[:UWF_OFFSET_SECTORS])[0]
 		self.sector_size = struct.unpack('<I', sector_map_data[UWF_OFFSET_SECTORS:UWF_OFFSET_SECTOR_SIZE])[0]
 
 		return None
 
-	def process_command_erase_blocks(self, file, data_length):
+	def large_erase_size(self):
+		"""
+		Returns the block size that aligned ranges are erased in, or None for sector erases only
+		"""
+		if self.enhanced_mode:
+			return uwf_erase.ERASE_BLOCK_64K
+		return None
+
+	def build_erase_command(self, start, erase_unit):
+		if erase_unit == uwf_erase.ERASE_BLOCK_64K:
+			return self.encoder.erase(start, uwf_erase.FUP_ERASE_LEN_64K)
+		return self.encoder.erase(start)
+
+	def erase_setting(self, erase_unit):
+		"""
+		Returns the erase length setting to send before erasing in 'erase_unit' steps, or None
+		"""
+		if erase_unit == (self.erase_unit or self.sector_size):
+			return None
+		self.erase_unit = erase_unit
+		if erase_unit == uwf_erase.ERASE_BLOCK_64K:
+			return uwf_erase.FUP_ERASE_LEN_64K
+		return uwf_erase.FUP_ERASE_LEN_SECTOR
+
+	def erase_ranges(self, start, size):
+		"""
+		Returns the ranges to erase for an erase record: all the erase records of
+		the image, merged, for the first record when the flash plan allows it;
+		nothing for the later records; otherwise just this record
+		"""
+		if self.erase_batch_done:
+			return []
+
+		ranges = uwf_erase.batch_ranges(self.plan)
+		if ranges is None:
+			return [uwf_erase.EraseRange(start, size)]
+
+		self.erase_batch_done = True
+		return ranges
+
+	def skip_current_erases(self, commands):
+		"""
+		Drops the erase commands whose flash already holds the new image and
+		records their sectors, so the writes to them are skipped as well
+		"""
+		remaining = []
+		for command in commands:
+			probed = any(probed.start < command.start + command.size and command.start < probed.start + probed.size
+				for probed in self.probed_ranges)
+			if not probed and (yield from self.is_flash_current(command.start, command.size)):
+				for sector in range(command.start, command.start + command.size, self.sector_size):
+					self.current_sectors.add(sector)
+			else:
+				remaining.append(command)
+		return remaining
+
+	def send_erase_commands(self, commands):
+		"""
+		Sends the erase commands, switching the erase length setting when the size changes
+		In enhanced mode up to ERASE_PIPELINE_DEPTH commands are in flight
+		Returns a FlashError or None
+		"""
+		for erase_unit, group in itertools.groupby(commands, lambda command: command.size):
+			setting = self.erase_setting(erase_unit)
+			if setting is not None:
+				yield from self.process_setting_set_steps(FUP_OPTION_CURRENT_ERASE_LEN_BYTES, setting)
+
+			in_flight = []
+			for command in group:
+				port_cmd_bytes = self.build_erase_command(command.start, command.size)
+				if not self.enhanced_mode:
+					response = yield (IO_EXCHANGE, port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+					if response.decode('utf-8') != RESPONSE_ACKNOWLEDGE:
+						return uwf_errors.response_error(response, ERROR_ERASE_BLOCKS.format('Non-ack to erase command'), command.start)
+					continue
+
+				yield (IO_WRITE, port_cmd_bytes)
+				in_flight.append(command.start)
+				if len(in_flight) == ERASE_PIPELINE_DEPTH:
+					error = yield from self.read_erase_ack(in_flight)
+					if error != None:
+						return error
+
+			while in_flight:
+				error = yield from self.read_erase_ack(in_flight)
+				if error != None:
+					return error
+
+		return None
+
+	def read_erase_ack(self, in_flight):
 		"""
-		Erases blocks according to the sector size value from the the UWF file
+		Reads the response to the oldest pipelined erase, removing its address from 'in_flight'
+		After a non-ack or a timeout the responses still due are waited for and
+		dropped, so that none of them answers a command of the repeat
+		Returns a FlashError or None
+		"""
+		address = in_flight.pop(0)
+		# One response at a time: each erase gets the full serial timeout
+		response = yield (IO_READ, RESPONSE_ACKNOWLEDGE_SIZE, None)
+		if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
+			return None
+
+		for pending in in_flight:
+			yield (IO_READ, RESPONSE_ACKNOWLEDGE_SIZE, None)
+		del in_flight[:]
+		yield (IO_RESET_INPUT,)
+		return uwf_errors.response_error(response, ERROR_ERASE_BLOCKS.format('Non-ack to erase command'), address)
+
+	def process_command_erase_blocks_steps(self, data):
+		"""
+		Erases the record's range, or in one batch the merged ranges of every
+		erase record of the image, with 64 KiB erases where aligned in enhanced
+		mode and sector erases (the sector size value from the UWF file) elsewhere
 		"""
 		error = None
 
+		if self.journal is not None and self.journal.begin_erase():
+			# Completed before the interruption being resumed (with every later
+			# record, when the erase records were batched)
+			self.erased = True
+			self.erase_batch_done = uwf_erase.batch_ranges(self.plan) is not None
+			return None
+
 		if self.synchronized and self.registered and self.sectors > 0 and self.sector_size > 0:
 			# Get the UWF erase data
-			erase_data = file.read(data_length)
+			erase_data = data
 			start = self.base_address + struct.unpack('<I', erase_data[:UWF_OFFSET_ERASE_START_ADDR])[0]
 			size = struct.unpack('<I', erase_data[UWF_OFFSET_ERASE_START_ADDR:UWF_OFFSET_ERASE_SIZE])[0]
 
 			if size < self.bank_size:
-				erase_command = bytearray(COMMAND_ERASE_SECTOR, 'utf-8')
-				while size > 0:
-					erase_sector = struct.pack('<I', start)
-					port_cmd_bytes = erase_command + erase_sector
-					response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+				commands = uwf_erase.erase_commands(self.erase_ranges(start, size), self.sector_size, self.large_erase_size())
+				if self.differential:
+					commands = yield from self.skip_current_erases(commands)
 
-					if response.decode('utf-8') != RESPONSE_ACKNOWLEDGE:
-						error = ERROR_ERASE_BLOCKS.format('Non-ack to erase command')
-						break
-					start += self.sector_size
-					size -= self.sector_size
-				else:
+				error = yield from self.send_erase_commands(commands)
+				if error == None:
 					self.erased = True
+					if self.journal is not None:
+						yield (IO_CALL, self.journal.end_erase)
+				else:
+					# A repeat of the section erases the whole batch again
+					self.erase_batch_done = False
 			else:
-				error = ERROR_ERASE_BLOCKS.format('Erase block size > bank size')
+				error = uwf_errors.ImageError(ERROR_ERASE_BLOCKS.format('Erase block size > bank size'))
 		else:
-			error = ERROR_ERASE_BLOCKS.format('Target platform, register device, or sector map commands not yet processed')
+			error = uwf_errors.ImageError(ERROR_ERASE_BLOCKS.format('Target platform, register device, or sector map commands not yet processed'))
 
 		return error
 
-	def process_command_write_blocks(self, file, data_length):
+	def is_flash_current(self, start, size):
+		"""
+		Verifies a flash range against the flash plan
+		Returns True if the range already holds the new image
+		"""
+		checksum = self.plan.checksum(start, size)
+		response = yield (IO_EXCHANGE, self.build_verify_command(start, size, checksum), RESPONSE_ACKNOWLEDGE_SIZE)
+		return response.decode('utf-8') == RESPONSE_ACKNOWLEDGE
+
+	def audit_image_steps(self, image):
+		"""
+		Verify only: syncs with the bootloader and checks every write range of the
+		flash plan with verify commands, without erasing or writing anything
+		Returns the mismatching flash ranges as merged [start, end) pairs
+		Raises the FlashError of a failed sync or of a verify without response
+		"""
+		handler = self.process_command_target_platform_steps
+		self.probe_writes = False
+		for section in image.sections:
+			if section.command == UWF_COMMAND_TARGET_PLATFORM and is_known_section(section):
+				error = yield from handler(image.payload(section))
+				retries = 0
+				while error != None and error.retryable and retries < self.section_retries and (yield from self.recover(error)):
+					if not self.link_retry_free(error):
+						retries += 1
+					error = yield from handler(image.payload(section))
+				if error != None:
+					raise error
+				break
+
+		self.audit_verifies = 0
+		mismatches = []
+		for write in self.plan.write_ranges:
+			start = write.start
+			end = write.start + write.size
+			while start < end:
+				# The window is re-read each time, as a rejected window shrinks it
+				size = min(self.audit_window, end - start)
+				yield from self.audit_range(start, size, mismatches)
+				start += size
+
+		return mismatches
+
+	def audit_range(self, start, size, mismatches):
+		"""
+		Verifies a range in one window, then only the halves of a failed window,
+		down to 'audit_min_window' bytes, adding the failed windows to 'mismatches'
+		Returns True if the range holds the image
+		"""
+		checksum = self.plan.checksum(start, size)
+		response = yield (IO_EXCHANGE, self.build_verify_command(start, size, checksum), RESPONSE_ACKNOWLEDGE_SIZE)
+		self.audit_verifies += 1
+		if len(response) == 0:
+			raise uwf_errors.LinkTimeoutError(ERROR_AUDIT.format('No response to verify at 0x{:x}'.format(start)), start)
+		if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
+			return True
+
+		if size <= self.audit_min_window:
+			if mismatches and mismatches[-1][1] == start:
+				mismatches[-1][1] = start + size
+			else:
+				mismatches.append([start, start + size])
+			return False
+
+		# Split on a multiple of the smallest window, so the map stays aligned to it
+		half = max(self.audit_min_window, size // 2 // self.audit_min_window * self.audit_min_window)
+		first = yield from self.audit_range(start, half, mismatches)
+		second = yield from self.audit_range(start + half, size - half, mismatches)
+		if first and second:
+			# Both halves hold the image: the window was larger than the bootloader verifies
+			self.audit_window = min(self.audit_window, half)
+			return True
+		return False
+
+	def process_command_write_blocks_steps(self, data):
 		"""
 		Sends the write command, then a data block 'X' times, then verifies
 		The size of the data block and the number of data blocks before verification are configurable
@@ -247,109 +1042,314 @@ class UwfProcessor():
 		error = None
 
 		if self.erased:
-			last_write = False
-			verify_checksum = 0
-			verify_count = 1
-			verify_data_block_size = 0
-
 			# Get the UWF write data
-			write_data = file.read(UWF_WRITE_BLOCK_HDR_LENGTH)
+			write_data = data[:UWF_WRITE_BLOCK_HDR_LENGTH]
 			offset = self.base_address + struct.unpack('<I', write_data[:UWF_OFFSET_WRITE_OFFSET])[0]
 			flags = struct.unpack('<I', write_data[UWF_OFFSET_WRITE_OFFSET:UWF_OFFSET_WRITE_FLAGS])[0]
-			remaining_data_size = data_length - UWF_WRITE_BLOCK_HDR_LENGTH
-
-			if remaining_data_size < self.bank_size:
-				verify_start_addr = struct.pack('<I', offset)
-				while remaining_data_size > 0:
-					if remaining_data_size < self.write_block_size:
-						bytes_to_write = remaining_data_size
-						last_write = True
-					else:
-						bytes_to_write = self.write_block_size
-
-					# Send the write command
-					write_command = bytearray(COMMAND_WRITE_SECTOR, 'utf-8')
-					start_addr = struct.pack('<I', offset)
-					if self.enhanced_mode:
-						data_block_size_l = struct.pack('B', bytes_to_write & 0xff)
-						data_block_size_h = struct.pack('B', (bytes_to_write & 0xff00) >> 8)
-						port_cmd_bytes = write_command + start_addr + data_block_size_l + data_block_size_h
+			payload = data[UWF_WRITE_BLOCK_HDR_LENGTH:]
+
+			if len(payload) < self.bank_size:
+				resume_offset = offset
+				if self.journal is not None:
+					resume_offset = self.journal.begin_write(offset, len(payload))
+
+				for start, end in self.dirty_ranges(resume_offset, offset + len(payload) - resume_offset):
+					data = payload[start - offset:end - offset]
+					if self.pipeline_window > 0 or self.adaptive_verify:
+						error = yield from self.write_blocks_windowed(start, data)
 					else:
-						data_block_size = struct.pack('B', bytes_to_write)
-						port_cmd_bytes = write_command + start_addr + data_block_size
-					response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+						error = yield from self.write_blocks(start, data)
 
-					if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-						# Prepare the data
-						data_command = bytearray(COMMAND_DATA_SECTION, 'utf-8')
-						data = file.read(bytes_to_write)
-
-						# Generate the checksum
-						i = 0
-						checksum = 0
-						while i < len(data):
-							checksum += struct.unpack('B', data[i:i+1])[0]
-							i += 1
-						checksum_bytes = struct.pack('<I', checksum)
-
-						# Write the data
-						port_cmd_bytes = data_command + data
-						port_cmd_bytes.append(checksum_bytes[0])	# Only need the LSB of the checksum
-						response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+					if error != None:
+						break
+				else:
+					self.write_complete = True
+			else:
+				error = uwf_errors.ImageError(ERROR_WRITE_BLOCKS.format('Data to write > bank size'))
+		else:
+			error = uwf_errors.ImageError(ERROR_WRITE_BLOCKS.format('Erase command not yet processed'))
+
+		return error
+
+	def dirty_ranges(self, offset, size):
+		"""
+		Splits a write range into the runs that lie outside the sectors the
+		differential erase found already current; returns [start, end] pairs
+		"""
+		ranges = []
+		end = offset + size
+		while offset < end:
+			sector = offset - (offset - self.base_address) % self.sector_size
+			next_offset = min(sector + self.sector_size, end)
+			if sector not in self.current_sectors:
+				if ranges and ranges[-1][1] == offset:
+					ranges[-1][1] = next_offset
+				else:
+					ranges.append([offset, next_offset])
+			offset = next_offset
+		return ranges
+
+	def write_blocks(self, offset, payload, record=True):
+		"""
+		Writes the payload one write/data exchange at a time, verifying every 'verify_write_limit' blocks
+		Verified windows are recorded in the journal unless 'record' is False
+		"""
+		error = None
+		last_write = False
+		verify_checksum = 0
+		verify_count = 1
+		verify_data_block_size = 0
+		verify_start_addr = offset
+		position = 0
+		remaining_data_size = len(payload)
+
+		while remaining_data_size > 0:
+			if remaining_data_size < self.write_block_size:
+				bytes_to_write = remaining_data_size
+				last_write = True
+			else:
+				bytes_to_write = self.write_block_size
+
+			# Send the write command
+			port_cmd_bytes = self.build_write_command(offset, bytes_to_write)
+			response = yield (IO_EXCHANGE, port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+
+			if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
+				# Prepare and write the data
+				data = payload[position:position + bytes_to_write]
+				port_cmd_bytes, checksum = self.build_data_command(data, self.block_checksum(offset, len(data)))
+				response = yield (IO_EXCHANGE, port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+
+				if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
+					# Data write was successful; move on to the next data block
+					offset += len(data)
+					position += len(data)
+					remaining_data_size -= len(data)
+					verify_checksum += checksum
+					verify_data_block_size += len(data)
+
+					# Verify the data after the expected number of data blocks have been written
+					if last_write or verify_count >= self.verify_write_limit:
+						port_cmd_bytes = self.build_verify_command(verify_start_addr, verify_data_block_size, verify_checksum)
+						response = yield (IO_EXCHANGE, port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
 
 						if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-							# Data write was successful; move on to the next data block
-							offset += len(data)
-							remaining_data_size -= len(data)
-
-							# Verify the data after the expected number of data blocks have been written
-							if last_write or verify_count >= self.verify_write_limit:
-								verify_command = bytearray(COMMAND_VERIFY_DATA, 'utf-8')
-								verify_data_block_size_bytes = struct.pack('<I', verify_data_block_size)
-								verify_checksum_bytes = struct.pack('<I', verify_checksum)
-								port_cmd_bytes = verify_command + verify_start_addr + verify_data_block_size_bytes + verify_checksum_bytes		# Need the full checksum here
-								response = self.write_to_comm(port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
-
-								if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
-									# Verification successful; reset for next verification
-									verify_start_addr = struct.pack('<I', offset)
-									verify_count = 1
-									verify_checksum = 0
-									verify_data_block_size = 0
-								else:
-									# Verification failed; abort
-									error = ERROR_WRITE_BLOCKS.format('Non-ack to verify command')
-									break
-							else:
-								verify_count += 1
-								verify_checksum += checksum
-								verify_data_block_size += len(data)
+							if record and self.journal is not None:
+								yield (IO_CALL, self.journal.verified, verify_start_addr + verify_data_block_size)
+
+							# Verification successful; reset for next verification
+							verify_start_addr = offset
+							verify_count = 1
+							verify_checksum = 0
+							verify_data_block_size = 0
 						else:
-							# Failed to write the data; abort
-							error = ERROR_WRITE_BLOCKS.format('Non-ack to data write')
+							# Verification failed; abort, with the window erased for the repeat
+							error = uwf_errors.response_error(response, ERROR_WRITE_BLOCKS.format('Non-ack to verify command'), verify_start_addr, uwf_errors.VerifyError)
+							if response.decode('utf-8') == RESPONSE_ERROR:
+								error = (yield from self.repair_window(verify_start_addr, verify_data_block_size)) or error
+							else:
+								error = (yield from self.rewrite_failed_window(verify_start_addr, offset)) or error
 							break
 					else:
-						# Write command failed; abort
-						error = ERROR_WRITE_BLOCKS.format('Non-ack to write command')
-						break
+						verify_count += 1
 				else:
-					self.write_complete = True
+					# Failed to write the data; abort
+					error = uwf_errors.response_error(response, ERROR_WRITE_BLOCKS.format('Non-ack to data write'), offset)
+					error = (yield from self.rewrite_failed_window(verify_start_addr, offset + bytes_to_write)) or error
+					break
 			else:
-				error = ERROR_WRITE_BLOCKS.format('Data to write > bank size')
-		else:
-			error = ERROR_WRITE_BLOCKS.format('Erase command not yet processed')
+				# Write command failed; abort
+				error = uwf_errors.response_error(response, ERROR_WRITE_BLOCKS.format('Non-ack to write command'), offset)
+				error = (yield from self.rewrite_failed_window(verify_start_addr, offset)) or error
+				break
+
+		return error
+
+	def repair_window(self, start, size):
+		"""
+		Erases the sectors of a window that failed to verify, as programmed flash
+		cannot be corrected by writing it again, and rewrites the flash plan's
+		data that they held apart from the window and the data not yet written
+		The window itself is left erased for the caller to write
+		Returns a FlashError or None
+		"""
+		end = start + size
+		first = start - (start - self.base_address) % self.sector_size
+		last = end + (self.base_address - end) % self.sector_size
+		self.unerased_window = None
+
+		if self.journal is not None:
+			# A repeat of the section must not resume past the erased sectors
+			yield (IO_CALL, self.journal.rewind, first)
 
+		commands = uwf_erase.erase_commands([uwf_erase.EraseRange(first, last - first)], self.sector_size)
+		error = yield from self.send_erase_commands(commands)
+		if error == None and self.plan is not None:
+			error = yield from self.rewrite_sectors(first, last, start)
+			if error == None and self.journal is not None and self.journal.write_start is not None and self.journal.write_start <= start:
+				# Restored and verified up to the window; a repeat must not write it again
+				yield (IO_CALL, self.journal.verified, start)
+			elif error != None:
+				# Part of the sectors may have been written twice already; leave them erased for the repeat
+				self.unerased_window = None
+				yield from self.send_erase_commands(commands)
+
+		if error != None and self.journal is not None and self.journal.write_start is not None and first < self.journal.write_start:
+			# Data of an earlier write section was erased; repeating this one cannot restore it
+			error.retryable = False
 		return error
 
-	def process_command_unregister(self, file, data_length):
-		unregister_device_data = file.read(data_length)
+	def rewrite_failed_window(self, start, end):
+		"""
+		Handles a window that failed before its verify passed: its blocks up to
+		'end' may be programmed already and are written again by the retry.
+		nRF52 flash takes at most two writes to a word between erases (nWRITE),
+		so the window is only written once more as it is; when a window over the
+		same flash fails again, its sectors are erased first (see repair_window)
+		Returns a FlashError or None
+		"""
+		if end <= start:
+			return None
+		window = self.unerased_window
+		if window is None or end <= window.start or window.start + window.size <= start:
+			self.unerased_window = uwf_erase.EraseRange(start, end - start)
+			return None
+		# Everything before 'start' is rewritten from the flash plan
+		return (yield from self.repair_window(start, max(end, window.start + window.size) - start))
+
+	def rewrite_sectors(self, first, last, start):
+		"""
+		Rewrites the flash plan's data between 'first' and 'last': the write ranges
+		before the one holding 'start' in image order, and that one up to 'start'
+		Returns a FlashError or None
+		"""
+		for write in self.plan.write_ranges:
+			current = write.start <= start < write.start + write.size
+			low = max(first, write.start)
+			high = min(start if current else last, write.start + write.size)
+			retries = 0
+			while low < high:
+				error = yield from self.write_blocks(low, write.payload[low - write.start:high - write.start], False)
+				if error == None:
+					break
+				# A failed verify here was repaired in turn, or may be written once more; go on from its window
+				if not isinstance(error, uwf_errors.VerifyError) or retries >= WRITE_RETRY_LIMIT:
+					return error
+				low = error.address
+				retries += 1
+			if current:
+				break
 
 		return None
 
-	def process_reboot(self):
-		self.set_gpio_value(GPIO_BT_BOOT_MODE, BT_FIRMWARE_MODE)
-		self.set_gpio_value(GPIO_CARD_NRESET, 0)
-		self.set_gpio_value(GPIO_CARD_NRESET, 1)
+	def read_pipeline_acks(self, pairs):
+		"""
+		Reads the acknowledgements for the given number of in flight write/data pairs
+		Returns True only if every write and data command was acknowledged
+		"""
+		return (yield (IO_READ_ACKS, pairs * 2))
 
-		# Cleanup
-		self.ser.close()
+	def write_blocks_windowed(self, offset, payload):
+		"""
+		Writes the payload in verify windows of 'verify_write_limit' blocks
+		With a 'pipeline_window', write/data pairs are streamed without waiting for each
+		acknowledgement, keeping up to 'pipeline_window' pairs in flight; acks are matched in order
+		A window with a non-ack or a failed verify is rewound to the last verified address
+		and resent; after a failed verify, or a second non-ack, its sectors are erased
+		first (see repair_window and rewrite_failed_window).
+		With 'adaptive_verify' the window grows while windows verify cleanly and shrinks
+		after a failure
+		"""
+		error = None
+		retries = 0
+		position = 0
+		data_size = len(payload)
+
+		while data_size > 0:
+			# Start a new verify window at the last verified address
+			verify_start_addr = offset
+			verify_checksum = 0
+			verify_data_block_size = 0
+			verify_count = 0
+			verify_failed = False
+			in_flight = 0
+			success = True
+
+			while success and verify_count < self.verify_write_limit and verify_data_block_size < data_size:
+				bytes_to_write = min(self.write_block_size, data_size - verify_data_block_size)
+				data = payload[position + verify_data_block_size:position + verify_data_block_size + bytes_to_write]
+				write_cmd_bytes = self.build_write_command(offset + verify_data_block_size, len(data))
+				data_cmd_bytes, checksum = self.build_data_command(data, self.block_checksum(offset + verify_data_block_size, len(data)))
+
+				if self.pipeline_window > 0:
+					# Send the write and data commands back to back
+					yield (IO_WRITE, write_cmd_bytes)
+					yield (IO_WRITE, data_cmd_bytes)
+					in_flight += 1
+
+					# Wait for the oldest pair once the window is full
+					if in_flight >= self.pipeline_window:
+						in_flight -= 1
+						success = yield from self.read_pipeline_acks(1)
+				else:
+					response = yield (IO_EXCHANGE, write_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+					if response.decode('utf-8') == RESPONSE_ACKNOWLEDGE:
+						response = yield (IO_EXCHANGE, data_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+					success = response.decode('utf-8') == RESPONSE_ACKNOWLEDGE
+
+				verify_count += 1
+				verify_checksum += checksum
+				verify_data_block_size += len(data)
+
+			if success:
+				# Collect the remaining acks, then verify the whole window
+				success = yield from self.read_pipeline_acks(in_flight)
+				in_flight = 0
+				if success:
+					port_cmd_bytes = self.build_verify_command(verify_start_addr, verify_data_block_size, verify_checksum)
+					response = yield (IO_EXCHANGE, port_cmd_bytes, RESPONSE_ACKNOWLEDGE_SIZE)
+					success = response.decode('utf-8') == RESPONSE_ACKNOWLEDGE
+					verify_failed = response.decode('utf-8') == RESPONSE_ERROR
+
+			if success:
+				if self.journal is not None:
+					yield (IO_CALL, self.journal.verified, verify_start_addr + verify_data_block_size)
+
+				# Verification successful; move on to the next window
+				offset += verify_data_block_size
+				position += verify_data_block_size
+				data_size -= verify_data_block_size
+				retries = 0
+				if self.adaptive_verify:
+					self.verify_write_limit = min(VERIFY_WRITE_LIMIT_MAX, self.verify_write_limit * 2)
+			else:
+				retries += 1
+				if self.adaptive_verify:
+					self.verify_write_limit = max(VERIFY_WRITE_LIMIT_MIN, self.verify_write_limit // 4)
+
+				# Let the bootloader finish with the in flight pairs, drop their acks and rewind
+				yield (IO_READ, in_flight * 2 * RESPONSE_ACKNOWLEDGE_SIZE, None)
+				yield (IO_RESET_INPUT,)
+
+				# Erased also when giving up, for the repeat of the section
+				if verify_failed:
+					error = yield from self.repair_window(verify_start_addr, verify_data_block_size)
+				else:
+					error = yield from self.rewrite_failed_window(verify_start_addr, verify_start_addr + verify_data_block_size)
+				if error != None:
+					break
+				if retries > WRITE_RETRY_LIMIT:
+					error = uwf_errors.VerifyError(ERROR_WRITE_BLOCKS.format('Window at 0x{:08x} failed {} times'.format(verify_start_addr, retries)), verify_start_addr)
+					break
+
+		return error
+
+	def process_command_unregister(self, data):
+		return None
+
+	def process_reboot_steps(self):
+		try:
+			yield (IO_CALL, self.reset_into_firmware)
+		finally:
+			# Cleanup
+			self.close()
@@ -0,0 +1,100 @@
+import struct
+import uwf_checksum
+
+COMMAND_SYNC_WITH_BOOTLOADER = '80'
+COMMAND_PLATFORM_CHECK = 'p'
+COMMAND_ERASE_SECTOR = 'e'
+COMMAND_WRITE_SECTOR = 'w'
+COMMAND_DATA_SECTION = 'd'
+COMMAND_VERIFY_DATA = 'v'
+COMMAND_SETTINGS_SET = 's'
+COMMAND_BOOTLOADER_VERSION = 'V'
+
+# Single byte frames, shared by every processor
+SYNC_FRAME = bytes.fromhex(COMMAND_SYNC_WITH_BOOTLOADER)
+ACKNOWLEDGE_FRAME = b'a'
+VERSION_FRAME = COMMAND_BOOTLOADER_VERSION.encode('utf-8')
+
+# Little-endian fields following the command byte of each frame
+WRITE_STRUCT = struct.Struct('<IB')
+WRITE_STRUCT_ENHANCED = struct.Struct('<IH')
+VERIFY_STRUCT = struct.Struct('<III')
+ERASE_STRUCT = struct.Struct('<I')
+ERASE_STRUCT_LENGTH = struct.Struct('<II')
+SETTING_STRUCT = struct.Struct('<HB3x')
+
+# Data frames grow to the largest block seen; this covers the enhanced write length
+DATA_FRAME_SIZE = 8192 + 2
+
+def command_frame(command, layout):
+	"""
+	Returns a frame for the command with its command byte already in place
+	"""
+	frame = bytearray(1 + layout.size)
+	frame[0] = ord(command)
+	return frame
+
+class ProtocolEncoder():
+	"""
+	Encodes bootloader commands into preallocated frames, one per command type,
+	with precompiled struct layouts. A returned frame is only valid until the
+	next command of the same type is encoded, which is always after it was sent
+	"""
+	def __init__(self):
+		self.write_frame = command_frame(COMMAND_WRITE_SECTOR, WRITE_STRUCT)
+		self.write_frame_enhanced = command_frame(COMMAND_WRITE_SECTOR, WRITE_STRUCT_ENHANCED)
+		self.verify_frame = command_frame(COMMAND_VERIFY_DATA, VERIFY_STRUCT)
+		self.erase_frame = command_frame(COMMAND_ERASE_SECTOR, ERASE_STRUCT)
+		self.erase_frame_length = command_frame(COMMAND_ERASE_SECTOR, ERASE_STRUCT_LENGTH)
+		self.setting_frame = command_frame(COMMAND_SETTINGS_SET, SETTING_STRUCT)
+		self.data_frame = bytearray(DATA_FRAME_SIZE)
+		self.data_frame[0] = ord(COMMAND_DATA_SECTION)
+		self.data_view = memoryview(self.data_frame)
+
+	def platform(self, platform_id):
+		return COMMAND_PLATFORM_CHECK.encode('utf-8') + bytes(platform_id)
+
+	def write(self, offset, size, enhanced):
+		"""
+		Write command; the enhanced bootloader takes a 2 byte length
+		"""
+		if enhanced:
+			WRITE_STRUCT_ENHANCED.pack_into(self.write_frame_enhanced, 1, offset, size)
+			return self.write_frame_enhanced
+		WRITE_STRUCT.pack_into(self.write_frame, 1, offset, size)
+		return self.write_frame
+
+	def data(self, data, checksum=None):
+		"""
+		Returns the data command for the block and the full checksum of the block,
+		computed unless it is given. Only the LSB of the checksum is sent with the data
+		"""
+		size = len(data)
+		if size + 2 > len(self.data_frame):
+			self.data_frame = bytearray(size + 2)
+			self.data_frame[0] = ord(COMMAND_DATA_SECTION)
+			self.data_view = memoryview(self.data_frame)
+
+		if checksum is None:
+			checksum = uwf_checksum.checksum(data)
+		self.data_frame[1:size + 1] = data
+		self.data_frame[size + 1] = checksum & 0xff
+		return self.data_view[:size + 2], checksum
+
+	def verify(self, start, size, checksum):
+		VERIFY_STRUCT.pack_into(self.verify_frame, 1, start, size, checksum)
+		return self.verify_frame
+
+	def erase(self, start, length_setting=None):
+		"""
+		Erase command; with a length setting, the erase length field is appended
+		"""
+		if length_setting is None:
+			ERASE_STRUCT.pack_into(self.erase_frame, 1, start)
+			return self.erase_frame
+		ERASE_STRUCT_LENGTH.pack_into(self.erase_frame_length, 1, start, length_setting)
+		return self.erase_frame_length
+
+	def setting(self, fup_option, set_value):
+		SETTING_STRUCT.pack_into(self.setting_frame, 1, fup_option, set_value & 0xff)
+		return self.setting_frame
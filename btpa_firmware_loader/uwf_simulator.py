@@ -0,0 +1,537 @@
+"""
+Software stand-in for a BL654 bootloader, used to measure and regression-test
+the processors without hardware
+
+SimulatedBootloader implements the 80/a/p/V/s/e/w/d/v protocol on top of a
+NOR-like flash array, with a latency model (byte time from the baudrate plus
+a fixed turnaround per message and an erase time per sector) and error
+injection. It is attached either in-process through SimulatedSerial (a
+pyserial look-alike, like a loop:// URL) or through a pty (SimulatedPty),
+which also works with the asyncio processors. The GPIO and DBus boot-mode
+hooks of the processors are redirected to the simulated module
+"""
+import os
+import pty
+import tty
+import time
+import errno
+import struct
+import random
+import select
+import threading
+import uwf_link
+import uwf_erase
+import uwf_gpio
+from uwf_processor import UwfProcessor
+from uwf_processor import DEVICE_TYPE_IG60
+from uwf_processor import SERIAL_TIMEOUT_SEC
+from uwf_processor import GPIO_CARD_NRESET
+from uwf_processor import GPIO_BT_BOOT_MODE
+from uwf_processor import BT_BOOTLOADER_MODE
+from uwf_processor import FUP_OPTION_CURRENT_ERASE_LEN_BYTES
+from uwf_processor import FUP_OPTION_CURRENT_WRITE_LEN_BYTES
+from uwf_processor import FUP_OPTION_CURRENT_BAUDRATE
+from uwf_image import UWF_COMMAND_TARGET_PLATFORM
+from uwf_image import UWF_COMMAND_REGISTER
+from uwf_image import UWF_COMMAND_SELECT
+from uwf_image import UWF_COMMAND_SECTOR_MAP
+from uwf_image import UWF_COMMAND_ERASE
+from uwf_image import UWF_COMMAND_WRITE
+from uwf_image import UWF_COMMAND_UNREGISTER
+
+SIMULATED_FLASH_SIZE = 0x100000
+SIMULATED_SECTOR_SIZE = 0x1000
+
+# nRF52 flash: a word may be written at most NWRITE times between erases
+SIMULATED_WORD_SIZE = 4
+SIMULATED_NWRITE = 2
+SIMULATED_PLATFORM_ID = b'BL65'
+SIMULATED_ATS = b'ATS\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a'
+
+VERSION_LEGACY = b'V5.0.0'
+VERSION_ENHANCED = b'V6.1.0'
+
+# Latency model defaults: 8N1 framing, command turnaround and nRF52 page erase time
+BITS_PER_BYTE = 10
+MESSAGE_LATENCY_SEC = 0.0005
+SECTOR_ERASE_SEC = 0.085
+
+# Time from the release of reset until the bootloader listens; bytes sent earlier are lost
+BOOT_TIME_SEC = 0.02
+
+RESPONSE_ACK = b'a'
+RESPONSE_ERROR = b'f'
+RESPONSE_SET = b'aaaa'
+
+# Bytes each command needs before it can be decoded, excluding data payloads
+COMMAND_LENGTHS = {
+	ord('p'): 5,
+	ord('s'): 7,
+	ord('w'): 6,
+	ord('e'): 5,
+	ord('v'): 13,
+}
+
+class SimulatedBootloader():
+	"""
+	Protocol engine and timing model of one BL654 in bootloader mode
+	receive() consumes host bytes and returns the responses together with
+	the time each one has fully arrived back at the host
+	"""
+	def __init__(self, version=VERSION_LEGACY, baudrate=115200, flash_size=SIMULATED_FLASH_SIZE,
+			message_latency=MESSAGE_LATENCY_SEC, sector_erase_time=SECTOR_ERASE_SEC,
+			data_error_rate=0.0, verify_error_rate=0.0, seed=None, time_scale=1.0, boot_time=BOOT_TIME_SEC,
+			verify_limit=None, max_baudrate=None, frame_limit=None):
+		self.version = version
+		self.initial_baudrate = baudrate
+		self.baudrate = baudrate
+		self.flash = bytearray(b'\xff' * flash_size)
+		self.word_writes = bytearray(flash_size // SIMULATED_WORD_SIZE)
+		self.message_latency = message_latency
+		self.sector_erase_time = sector_erase_time
+		self.boot_time = boot_time
+		self.boot_ready = 0.0
+		self.time_scale = time_scale
+
+		# Error injection: probability of refusing a data block, and of programming
+		# an accepted block with a wrong bit, which only an erase clears
+		self.data_error_rate = data_error_rate
+		self.verify_error_rate = verify_error_rate
+		self.random = random.Random(seed)
+
+		# Largest verify window the bootloader accepts; larger ones fail (None: no limit)
+		self.verify_limit = verify_limit
+
+		# Fastest baudrate the line carries; bytes sent faster are lost (None: no limit)
+		self.max_baudrate = max_baudrate
+
+		# Longest data frame the line carries intact; longer ones arrive corrupted (None: no limit)
+		self.frame_limit = frame_limit
+
+		self.lock = threading.Lock()
+		self.in_bootloader = True
+		self.boot_mode = BT_BOOTLOADER_MODE
+		self.clock = 0.0
+		self.reset_stats()
+		self.reset()
+
+	def reset(self):
+		"""
+		Returns the protocol state to the power-on defaults
+		"""
+		self.baudrate = self.initial_baudrate
+		self.buffer = bytearray()
+		self.pending_write = None
+		self.next_baudrate = None
+		self.long_write_len = False
+		self.erase_unit = SIMULATED_SECTOR_SIZE
+
+	def reset_stats(self):
+		self.round_trips = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.erases = 0
+		self.writes = 0
+		self.verifies = 0
+		self.errors = 0
+		self.overwrites = 0
+
+	def stats(self):
+		return {
+			'round_trips': self.round_trips,
+			'bytes_in': self.bytes_in,
+			'bytes_out': self.bytes_out,
+			'erases': self.erases,
+			'writes': self.writes,
+			'verifies': self.verifies,
+			'errors': self.errors,
+			'overwrites': self.overwrites,
+		}
+
+	def byte_time(self):
+		return BITS_PER_BYTE * self.time_scale / self.baudrate
+
+	def set_gpio(self, gpio_name, value):
+		"""
+		GPIO stand-in: the module restarts in the selected mode when reset is released
+		"""
+		if gpio_name == GPIO_BT_BOOT_MODE:
+			self.boot_mode = int(value)
+			return None
+		elif gpio_name == GPIO_CARD_NRESET and int(value) == 1:
+			return self.restart()
+		return None
+
+	def set_boot_mode(self, mode):
+		"""
+		Device service stand-in (SetBtBootMode): selects the mode and resets the module
+		"""
+		self.boot_mode = int(mode)
+		return self.restart()
+
+	def restart(self):
+		with self.lock:
+			self.reset()
+			self.in_bootloader = self.boot_mode == BT_BOOTLOADER_MODE
+			self.boot_ready = time.monotonic() + self.boot_time * self.time_scale
+			return []
+
+	def receive(self, data, now):
+		"""
+		Consumes bytes written by the host at time 'now'
+		Returns a list of (ready time, response bytes)
+		"""
+		with self.lock:
+			self.bytes_in += len(data)
+			if not self.in_bootloader or now < self.boot_ready:
+				return []
+			if self.max_baudrate is not None and self.baudrate > self.max_baudrate:
+				return []
+
+			# The last byte is in once the line has carried all of them
+			self.clock = max(self.clock, now) + len(data) * self.byte_time()
+			self.buffer += data
+
+			responses = []
+			while self.buffer:
+				response, busy = self.decode()
+				if response is None:
+					break
+
+				self.clock += (self.message_latency + busy) * self.time_scale
+				self.round_trips += 1
+				self.bytes_out += len(response)
+				responses.append((self.clock + len(response) * self.byte_time(), response))
+
+				# A new baudrate only applies after the acknowledgement was sent
+				if self.next_baudrate is not None:
+					self.clock += len(response) * self.byte_time()
+					self.baudrate = self.next_baudrate
+
+			return responses
+
+	def decode(self):
+		"""
+		Executes the first complete command in the buffer
+		Returns its response and the extra busy time, or (None, 0) if more bytes are needed
+		"""
+		b = self.buffer
+		self.next_baudrate = None
+
+		if self.pending_write is not None:
+			address, size = self.pending_write
+			if len(b) < size + 2:
+				return None, 0
+			if b[0] != ord('d'):
+				self.pending_write = None
+				return self.fail(1)
+
+			data = b[1:size + 1]
+			valid = (sum(data) & 0xff) == b[size + 1]
+			if self.frame_limit is not None and size + 2 > self.frame_limit:
+				valid = False
+			if valid and self.random.random() >= self.data_error_rate:
+				# NOR flash: programming can only clear bits
+				current = int.from_bytes(self.flash[address:address + size], 'little')
+				programmed = current & int.from_bytes(data, 'little')
+				if programmed and self.random.random() < self.verify_error_rate:
+					# A weak cell: one bit that should stay set is programmed
+					bits = [bit for bit in range(size * 8) if programmed >> bit & 1]
+					programmed &= ~(1 << self.random.choice(bits))
+				self.flash[address:address + size] = programmed.to_bytes(size, 'little')
+				self.count_word_writes(address, size)
+				self.writes += 1
+				response = RESPONSE_ACK
+			else:
+				self.errors += 1
+				response = RESPONSE_ERROR
+			del b[:size + 2]
+			self.pending_write = None
+			return response, 0
+
+		command = b[0]
+		if command == 0x80:
+			del b[:1]
+			return SIMULATED_ATS, 0
+		elif command == ord('a'):
+			del b[:1]
+			return RESPONSE_ACK, 0
+		elif command == ord('V'):
+			del b[:1]
+			return self.version, 0
+
+		length = COMMAND_LENGTHS.get(command)
+		if length is None:
+			return self.fail(1)
+		if command == ord('w') and self.long_write_len:
+			length += 1
+		if command == ord('e') and self.erase_unit != SIMULATED_SECTOR_SIZE:
+			length += 4
+		if len(b) < length:
+			return None, 0
+
+		if command == ord('p'):
+			del b[:length]
+			return RESPONSE_ACK, 0
+		elif command == ord('s'):
+			option = b[1] | (b[2] << 8)
+			value = b[3]
+			del b[:length]
+			return self.setting(option, value)
+		elif command == ord('e'):
+			address = struct.unpack('<I', b[1:5])[0]
+			del b[:length]
+			if address + self.erase_unit > len(self.flash):
+				return self.fail(0)
+			self.flash[address:address + self.erase_unit] = b'\xff' * self.erase_unit
+			words = address // SIMULATED_WORD_SIZE
+			self.word_writes[words:words + self.erase_unit // SIMULATED_WORD_SIZE] = bytes(self.erase_unit // SIMULATED_WORD_SIZE)
+			self.erases += 1
+			return RESPONSE_ACK, self.sector_erase_time * self.erase_unit // SIMULATED_SECTOR_SIZE
+		elif command == ord('w'):
+			address = struct.unpack('<I', b[1:5])[0]
+			size = b[5]
+			if self.long_write_len:
+				size |= b[6] << 8
+			del b[:length]
+			if address + size > len(self.flash):
+				return self.fail(0)
+			self.pending_write = (address, size)
+			return RESPONSE_ACK, 0
+		else:
+			address, size, checksum = struct.unpack('<III', b[1:13])
+			del b[:length]
+			self.verifies += 1
+			if self.verify_limit is not None and size > self.verify_limit:
+				return self.fail(0)
+			if (sum(self.flash[address:address + size]) & 0xffffffff) == checksum:
+				return RESPONSE_ACK, 0
+			self.errors += 1
+			return RESPONSE_ERROR, 0
+
+	def count_word_writes(self, address, size):
+		"""
+		Counts the writes to each word since its erase; 'overwrites' counts the
+		words written more than SIMULATED_NWRITE times, which real flash does not allow
+		"""
+		for word in range(address // SIMULATED_WORD_SIZE, (address + size - 1) // SIMULATED_WORD_SIZE + 1):
+			self.word_writes[word] = min(0xff, self.word_writes[word] + 1)
+			if self.word_writes[word] > SIMULATED_NWRITE:
+				self.overwrites += 1
+
+	def setting(self, option, value):
+		if option == FUP_OPTION_CURRENT_BAUDRATE:
+			for baudrate, setting in uwf_link.FUP_BAUDRATE_SETTINGS.items():
+				if setting == value:
+					self.next_baudrate = baudrate
+		elif option == FUP_OPTION_CURRENT_WRITE_LEN_BYTES:
+			self.long_write_len = value != 0
+		elif option == FUP_OPTION_CURRENT_ERASE_LEN_BYTES:
+			if value == uwf_erase.FUP_ERASE_LEN_64K:
+				self.erase_unit = uwf_erase.ERASE_BLOCK_64K
+			else:
+				self.erase_unit = SIMULATED_SECTOR_SIZE
+		return RESPONSE_SET, 0
+
+	def fail(self, drop):
+		del self.buffer[:drop]
+		self.errors += 1
+		return RESPONSE_ERROR, 0
+
+class SimulatedSerial():
+	"""
+	In-process pyserial look-alike connected to a SimulatedBootloader
+	Reads block until the modelled responses have arrived; bytes sent at a
+	baudrate the module is not using are lost, as on a real line
+	"""
+	def __init__(self, simulator, port, baudrate, timeout=SERIAL_TIMEOUT_SEC):
+		self.simulator = simulator
+		self.port = port
+		self.baudrate = baudrate
+		self.timeout = timeout
+		self.is_open = True
+		self.responses = []
+		self.buffer = bytearray()
+
+	def deliver(self, responses):
+		self.responses.extend(responses)
+
+	def collect(self):
+		now = time.monotonic()
+		while self.responses and self.responses[0][0] <= now:
+			self.buffer += self.responses.pop(0)[1]
+
+	def write(self, data):
+		if not self.is_open:
+			raise IOError(errno.EBADF, 'Port closed')
+		if self.baudrate == self.simulator.baudrate:
+			self.deliver(self.simulator.receive(bytes(data), time.monotonic()))
+		return len(data)
+
+	def read(self, size=1):
+		deadline = time.monotonic() + (self.timeout or 0)
+		self.collect()
+		while len(self.buffer) < size and self.responses:
+			ready = self.responses[0][0]
+			if ready > deadline:
+				# Still busy: the read times out like on a real port
+				time.sleep(max(0, deadline - time.monotonic()))
+				break
+			time.sleep(max(0, ready - time.monotonic()))
+			self.collect()
+
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return data
+
+	def readline(self):
+		deadline = time.monotonic() + (self.timeout or 0)
+		self.collect()
+		while b'\n' not in self.buffer and self.responses and self.responses[0][0] <= deadline:
+			time.sleep(max(0, self.responses[0][0] - time.monotonic()))
+			self.collect()
+
+		end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+		data = bytes(self.buffer[:end])
+		del self.buffer[:end]
+		return data
+
+	@property
+	def in_waiting(self):
+		self.collect()
+		return len(self.buffer)
+
+	def reset_input_buffer(self):
+		self.collect()
+		self.buffer = bytearray()
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.is_open = False
+
+class SimulatedPty():
+	"""
+	Serves a SimulatedBootloader on the master side of a pty; 'port' is the
+	slave device to open with pyserial (or the asyncio processors)
+	"""
+	def __init__(self, simulator):
+		self.simulator = simulator
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.master)
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+		self.responses = []
+		self.running = True
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def deliver(self, responses):
+		self.responses.extend(responses)
+
+	def run(self):
+		while self.running:
+			timeout = 0.05
+			if self.responses:
+				timeout = max(0, self.responses[0][0] - time.monotonic())
+
+			readable = select.select([self.master], [], [], timeout)[0]
+			if readable:
+				try:
+					data = os.read(self.master, 65536)
+				except OSError:
+					return
+				self.deliver(self.simulator.receive(data, time.monotonic()))
+
+			now = time.monotonic()
+			while self.responses and self.responses[0][0] <= now:
+				os.write(self.master, self.responses.pop(0)[1])
+
+	def close(self):
+		self.running = False
+		self.thread.join()
+		os.close(self.master)
+		os.close(self.slave)
+
+class SimulatedDeviceService():
+	"""
+	Stand-in for the IG60 device service DBus interface
+	"""
+	def __init__(self, simulator, link):
+		self.simulator = simulator
+		self.link = link
+
+	def SetBtBootMode(self, mode):
+		self.link.deliver(self.simulator.set_boot_mode(mode))
+		return 0
+
+def simulated_processor_class(base, simulator, link):
+	"""
+	Returns a subclass of the given processor class whose GPIO, DBus and
+	(for in-process links) port hooks drive the simulator
+	"""
+	class SimulatedProcessor(base):
+		def open_gpio(self):
+			def listener(gpio_name, value):
+				self.link.deliver(simulator.set_gpio(gpio_name, value) or [])
+			return uwf_gpio.FakeGpio(self.reset_pulse, listener, self.reset_lines)
+
+		def connect_device_service(self):
+			return SimulatedDeviceService(simulator, self.link)
+
+		def open_port(self, baudrate):
+			if isinstance(link, SimulatedPty):
+				self.link = link
+				return base.open_port(self, baudrate)
+			self.link = SimulatedSerial(simulator, self.port, baudrate)
+			return self.link
+
+	return SimulatedProcessor
+
+def processor_base(type, asynchronous=False):
+	if type == DEVICE_TYPE_IG60:
+		from ig60_bl654_uwf_processor import Ig60Bl654UwfProcessor
+		from ig60_bl654_uwf_processor import AsyncIg60Bl654UwfProcessor
+		return AsyncIg60Bl654UwfProcessor if asynchronous else Ig60Bl654UwfProcessor
+	elif asynchronous:
+		from uwf_async_processor import AsyncUwfProcessor
+		return AsyncUwfProcessor
+	return UwfProcessor
+
+def init_simulated_processor(simulator, type=None, baudrate=115200, link=None):
+	"""
+	Instantiates a processor attached to the simulator and enters its bootloader
+	'link' is a SimulatedPty; by default the port is an in-process SimulatedSerial
+	"""
+	processor_class = simulated_processor_class(processor_base(type), simulator, link)
+	port = link.port if link is not None else 'sim://{}'.format(id(simulator))
+	processor = processor_class(port, baudrate)
+	processor.enter_bootloader()
+	return processor
+
+async def init_simulated_async_processor(simulator, link, type=None, baudrate=115200):
+	"""
+	asyncio version of init_simulated_processor; needs a SimulatedPty link
+	"""
+	processor_class = simulated_processor_class(processor_base(type, True), simulator, link)
+	processor = processor_class(link.port, baudrate)
+	await processor.enter_bootloader()
+	return processor
+
+def build_image(payload, base_address=0, sector_size=SIMULATED_SECTOR_SIZE, sectors=SIMULATED_FLASH_SIZE // SIMULATED_SECTOR_SIZE):
+	"""
+	Returns the bytes of a UWF image that erases and writes 'payload' at 'base_address'
+	"""
+	def section(command, data):
+		return command.encode('utf-8') + b'\x00' + struct.pack('<I', len(data)) + data
+
+	erase_size = (len(payload) + sector_size - 1) // sector_size * sector_size
+	image = section(UWF_COMMAND_TARGET_PLATFORM, SIMULATED_PLATFORM_ID)
+	image += section(UWF_COMMAND_REGISTER, struct.pack('<BIBIB', 0, base_address, 1, sector_size * sectors, 1))
+	image += section(UWF_COMMAND_SELECT, b'\x00\x00')
+	image += section(UWF_COMMAND_SECTOR_MAP, struct.pack('<II', sectors, sector_size))
+	image += section(UWF_COMMAND_ERASE, struct.pack('<II', 0, erase_size))
+	image += section(UWF_COMMAND_WRITE, struct.pack('<II', 0, 0) + bytes(payload))
+	image += section(UWF_COMMAND_UNREGISTER, b'\x00')
+	return image
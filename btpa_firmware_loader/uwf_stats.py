@@ -0,0 +1,307 @@
+import sys
+import json
+import time
+import asyncio
+import inspect
+import threading
+
+# Upper bounds (ms) of the latency histogram buckets; one more bucket counts the rest
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+RESPONSE_ERROR = b'f'
+
+# Minimum time between two updates of the live progress line
+PROGRESS_INTERVAL_SEC = 0.5
+
+# Command names keyed by the first byte sent to the bootloader
+COMMAND_NAMES = {
+	0x80: 'sync',
+	ord('a'): 'ack',
+	ord('p'): 'platform',
+	ord('V'): 'version',
+	ord('s'): 'setting',
+	ord('e'): 'erase',
+	ord('w'): 'write',
+	ord('d'): 'data',
+	ord('v'): 'verify',
+}
+
+# Phase names of the processor methods that are timed
+PHASE_HANDLERS = {
+	'process_command_target_platform_steps': 'sync',
+	'process_command_register_device': 'register',
+	'process_command_select_device': 'select',
+	'process_command_sector_map': 'sector_map',
+	'process_command_erase_blocks_steps': 'erase',
+	'process_command_write_blocks_steps': 'write',
+	'process_command_unregister': 'unregister',
+	'process_reboot_steps': 'reboot',
+}
+
+class Counter():
+	"""
+	Count, bytes, total time, timeouts, error responses and latency histogram
+	of one command or phase
+	"""
+	def __init__(self):
+		self.count = 0
+		self.bytes_out = 0
+		self.bytes_in = 0
+		self.seconds = 0.0
+		self.max_seconds = 0.0
+		self.timeouts = 0
+		self.errors = 0
+		self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+	def add(self, seconds, bytes_out=0, bytes_in=0, timeout=False, error=False):
+		self.count += 1
+		self.bytes_out += bytes_out
+		self.bytes_in += bytes_in
+		self.seconds += seconds
+		self.max_seconds = max(self.max_seconds, seconds)
+		if timeout:
+			self.timeouts += 1
+		if error:
+			self.errors += 1
+
+		milliseconds = seconds * 1000
+		bucket = 0
+		while bucket < len(LATENCY_BUCKETS_MS) and milliseconds > LATENCY_BUCKETS_MS[bucket]:
+			bucket += 1
+		self.histogram[bucket] += 1
+
+	def report(self):
+		return {
+			'count': self.count,
+			'bytes_out': self.bytes_out,
+			'bytes_in': self.bytes_in,
+			'seconds': round(self.seconds, 6),
+			'max_seconds': round(self.max_seconds, 6),
+			'timeouts': self.timeouts,
+			'errors': self.errors,
+			'histogram': self.histogram,
+		}
+
+class FlashStats():
+	"""
+	Instrumentation of one processor. attach() replaces write_to_comm,
+	write_frame, the pipelined ack reader, the section handlers and the reboot
+	steps of that processor instance with timed wrappers; a processor that is
+	never attached runs unchanged
+	"""
+	def __init__(self, port, total_bytes, progress=None):
+		self.port = port
+		self.total_bytes = total_bytes
+		self.progress = progress
+		self.commands = {}
+		self.phases = {}
+		self.payload_bytes = 0
+		self.phase = None
+		self.start = time.time()
+		self.seconds = None
+		self.error = None
+		self.processor = None
+
+	def counter(self, table, name):
+		counter = table.get(name)
+		if counter is None:
+			counter = table[name] = Counter()
+		return counter
+
+	def record_command(self, data, response, resp_size, seconds):
+		name = COMMAND_NAMES.get(data[0], 'unknown') if len(data) else 'unknown'
+		self.counter(self.commands, name).add(seconds, len(data), len(response), len(response) < resp_size, response == RESPONSE_ERROR)
+		if name == 'data':
+			self.add_payload(len(data) - 2)
+
+	def record_pipeline(self, count, ok, seconds):
+		self.counter(self.commands, 'pipelined_acks').add(seconds, 0, count, error=not ok)
+
+	def add_payload(self, size):
+		self.payload_bytes += size
+		if self.progress is not None:
+			self.progress.update(self)
+
+	def time_phase(self, name, seconds):
+		self.counter(self.phases, name).add(seconds)
+
+	def attach(self, processor):
+		"""
+		Instruments the processor (synchronous or asyncio)
+		"""
+		self.processor = processor
+		self.wrap_exchange(processor)
+		self.wrap_pipeline(processor)
+		for method, phase in PHASE_HANDLERS.items():
+			if hasattr(processor, method):
+				self.wrap_phase(processor, method, phase)
+
+	def wrap_exchange(self, processor):
+		write_to_comm = processor.write_to_comm
+		if asyncio.iscoroutinefunction(write_to_comm):
+			async def timed(data, resp_size):
+				start = time.perf_counter()
+				response = await write_to_comm(data, resp_size)
+				self.record_command(data, response, resp_size, time.perf_counter() - start)
+				return response
+		else:
+			def timed(data, resp_size):
+				start = time.perf_counter()
+				response = write_to_comm(data, resp_size)
+				self.record_command(data, response, resp_size, time.perf_counter() - start)
+				return response
+		processor.write_to_comm = timed
+
+	def wrap_pipeline(self, processor):
+		read_acks = processor.read_acks
+		# Frames sent without waiting for their response: pipelined commands and sync polls
+		write_frame = processor.write_frame
+
+		if asyncio.iscoroutinefunction(read_acks):
+			async def timed(count):
+				start = time.perf_counter()
+				ok = await read_acks(count)
+				self.record_pipeline(count, ok, time.perf_counter() - start)
+				return ok
+
+			async def sent(data):
+				start = time.perf_counter()
+				await write_frame(data)
+				self.record_command(data, b'', 0, time.perf_counter() - start)
+		else:
+			def timed(count):
+				start = time.perf_counter()
+				ok = read_acks(count)
+				self.record_pipeline(count, ok, time.perf_counter() - start)
+				return ok
+
+			def sent(data):
+				start = time.perf_counter()
+				write_frame(data)
+				self.record_command(data, b'', 0, time.perf_counter() - start)
+		processor.read_acks = timed
+		processor.write_frame = sent
+
+	def wrap_phase(self, processor, method, phase):
+		handler = getattr(processor, method)
+		if inspect.isgeneratorfunction(handler):
+			# Protocol steps (see UwfProcessor.run): time them until they finish
+			def timed(*args):
+				self.phase = phase
+				start = time.perf_counter()
+				try:
+					return (yield from handler(*args))
+				finally:
+					self.time_phase(phase, time.perf_counter() - start)
+		elif asyncio.iscoroutinefunction(handler):
+			async def timed(*args):
+				self.phase = phase
+				start = time.perf_counter()
+				try:
+					return await handler(*args)
+				finally:
+					self.time_phase(phase, time.perf_counter() - start)
+		else:
+			def timed(*args):
+				self.phase = phase
+				start = time.perf_counter()
+				try:
+					return handler(*args)
+				finally:
+					self.time_phase(phase, time.perf_counter() - start)
+		setattr(processor, method, timed)
+
+	def finish(self, error):
+		self.seconds = time.time() - self.start
+		self.error = error
+		if self.progress is not None:
+			self.progress.update(self, True)
+
+	def report(self):
+		seconds = self.seconds if self.seconds is not None else time.time() - self.start
+		report = {
+			'port': self.port,
+			'result': 'ok' if self.error == None else 'failed',
+			'error': self.error.strip() if self.error != None else None,
+			'seconds': round(seconds, 6),
+			'image_bytes': self.total_bytes,
+			'payload_bytes': self.payload_bytes,
+			'bytes_per_second': round(self.payload_bytes / seconds, 1) if seconds else 0,
+			'timeouts': sum(counter.timeouts for counter in self.commands.values()),
+			'latency_buckets_ms': LATENCY_BUCKETS_MS,
+			'phases': dict((name, counter.report()) for name, counter in self.phases.items()),
+			'commands': dict((name, counter.report()) for name, counter in self.commands.items()),
+		}
+		if self.processor is not None:
+			report['baudrate'] = self.processor.ser.baudrate
+			report['enhanced_mode'] = self.processor.enhanced_mode
+			report['write_block_size'] = self.processor.write_block_size
+		return report
+
+class StatsCollector():
+	"""
+	Creates the FlashStats of every flashed port and writes the combined JSON report
+	"""
+	def __init__(self, progress=False, stream=sys.stderr):
+		self.devices = []
+		self.lock = threading.Lock()
+		self.progress = ProgressLine(stream) if progress else None
+
+	def device(self, port, total_bytes):
+		stats = FlashStats(port, total_bytes, self.progress)
+		with self.lock:
+			self.devices.append(stats)
+		return stats
+
+	def report(self):
+		with self.lock:
+			return {'devices': [stats.report() for stats in self.devices]}
+
+	def write_json(self, path):
+		"""
+		Writes the report to a file, or to stdout when the path is '-'
+		"""
+		text = json.dumps(self.report(), indent=1, sort_keys=True) + '\n'
+		if path == '-':
+			sys.stdout.write(text)
+		else:
+			with open(path, 'w') as f:
+				f.write(text)
+
+class ProgressLine():
+	"""
+	Single status line, redrawn in place, with the progress of every port
+	and the combined throughput
+	"""
+	def __init__(self, stream):
+		self.stream = stream
+		self.devices = []
+		self.lock = threading.Lock()
+		self.last_update = 0.0
+		self.start = time.time()
+
+	def update(self, stats, force=False):
+		now = time.time()
+		with self.lock:
+			if stats not in self.devices:
+				self.devices.append(stats)
+			if not force and now - self.last_update < PROGRESS_INTERVAL_SEC:
+				return
+			self.last_update = now
+
+			parts = []
+			total = 0
+			for device in self.devices:
+				total += device.payload_bytes
+				if device.seconds is not None:
+					state = 'done' if device.error == None else 'failed'
+				else:
+					state = '{} {:3.0f}%'.format(device.phase or '', 100.0 * min(device.payload_bytes, device.total_bytes) / device.total_bytes if device.total_bytes else 0)
+				parts.append('{} {}'.format(device.port, state))
+
+			elapsed = now - self.start
+			line = '{} | {:.0f} bytes/s'.format(' | '.join(parts), total / elapsed if elapsed else 0)
+			self.stream.write('\r' + line + '\x1b[K')
+			if all(device.seconds is not None for device in self.devices):
+				self.stream.write('\n')
+			self.stream.flush()
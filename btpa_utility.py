@@ -1,28 +1,153 @@
 #!/usr/bin/python3
+import os
 import sys
 import serial
 import binascii
 import errno
 import time
+import shlex
+import collections
 
 SERIAL_TIMEOUT = 1
 MAX_UPLOAD_SIZE = 32
 
+# Chunk sizes tried for AT+FWRH, largest first; the first one the module
+# accepts is used for the rest of the upload
+UPLOAD_SIZE_CANDIDATES = [128, 64, MAX_UPLOAD_SIZE]
+
+# Number of AT+FWRH commands sent ahead of their responses, and the bound
+# on the bytes they may occupy in the module's receive buffer
+UPLOAD_WINDOW = 4
+UPLOAD_WINDOW_BYTES = 1024
+
+# The module is polled with AT after the break until it answers, for at most
+# READY_TIMEOUT_SEC; each poll waits READY_POLL_SEC for the response
+READY_TIMEOUT_SEC = 3
+READY_POLL_SEC = 0.1
+
+# Late responses (to earlier polls or rejected lines) are dropped once none
+# arrived for QUIET_SEC
+QUIET_SEC = 0.3
+
 EXIT_CODE_SUCCESS = 0
 
+# Status of BtpaSession.upload() when skip_existing found the file on the module
+UPLOAD_SKIPPED = -1
+
 RETURN_CODE_SIZE = 2
 RETURN_CODE_SUCCESS = '00'
 RETURN_CODE_SCRIPT_FOUND = '06'
 
 UPLOAD_OPEN_FILE_CMD = 'AT+FOW "{}"\r\n'
-UPLOAD_WRITE_DATA_CMD = 'AT+FWRH "{}"\r\n'
+UPLOAD_WRITE_DATA_PREFIX = b'AT+FWRH "'
+UPLOAD_WRITE_DATA_SUFFIX = b'"\r\n'
 UPLOAD_CLOSE_FILE_CMD = 'AT+FCL\r\n'
+READY_CMD = 'AT\r\n'
 LIST_FILES_CMD = 'AT+DIR\r\n'
 DELETE_FILE_CMD = 'AT+DEL "{}"\r\n'
 DELETE_FILE_FORCE_CMD = 'AT+DEL "{}" +\r\n'
 RENAME_FILE_CMD = 'AT+REN "{}" "{}"\r\n'
 
-PYTHON3 = sys.version_info >= (3, 0)
+class AtPort():
+	"""
+	The serial port to the module with a buffered response framer. Whatever
+	bytes are available are read into one buffer, which is split into
+	response records ('\\n' <return code> [<tab> <text>] '\\r') as they complete
+	"""
+	def __init__(self, serial):
+		self.serial = serial
+		self.buffer = bytearray()
+
+	@property
+	def timeout(self):
+		return self.serial.timeout
+
+	@timeout.setter
+	def timeout(self, timeout):
+		self.serial.timeout = timeout
+
+	def write(self, data):
+		return self.serial.write(data)
+
+	def reset_input_buffer(self):
+		del self.buffer[:]
+		self.serial.reset_input_buffer()
+
+	def read_record(self):
+		"""
+		Returns the next complete record without its framing, or None if the
+		serial timeout expired first
+		"""
+		while True:
+			end = self.buffer.find(b'\r')
+			while end >= 0:
+				record = bytes(self.buffer[:end]).lstrip(b'\n')
+				del self.buffer[:end + 1]
+				if record:
+					return record
+				end = self.buffer.find(b'\r')
+
+			# Blocks for the first byte only, then takes everything that is waiting
+			data = self.serial.read(max(1, self.serial.in_waiting))
+			if not data:
+				return None
+			self.buffer += data
+
+def read_response(serial):
+	"""
+	Reads one command response
+	Returns the return code ('' on timeout) and, on failure, the error code
+	"""
+	record = serial.read_record()
+	if record is None:
+		return '', ''
+
+	return_code = record[:RETURN_CODE_SIZE].decode('utf-8')
+	error_code = ''
+	if return_code != RETURN_CODE_SUCCESS:
+		# Get the error code
+		error_code = record[RETURN_CODE_SIZE:].strip().decode('utf-8')
+
+	return return_code, error_code
+
+def drain_responses(serial, quiet=QUIET_SEC):
+	"""
+	Reads and drops responses until none arrives for 'quiet' seconds
+	"""
+	serial_timeout = serial.timeout
+	serial.timeout = quiet
+	try:
+		while serial.read_record() is not None:
+			pass
+	finally:
+		serial.timeout = serial_timeout
+	serial.reset_input_buffer()
+
+def wait_ready(serial, timeout=READY_TIMEOUT_SEC):
+	"""
+	Polls the module with AT until it answers or the timeout expires
+	Returns True once the module answered; the answers to earlier polls that
+	arrive late are dropped, so that they are not taken for the next response
+	"""
+	port_cmd_bytes = bytearray(READY_CMD, 'utf-8')
+	serial_timeout = serial.timeout
+	serial.timeout = READY_POLL_SEC
+	try:
+		deadline = time.time() + timeout
+		polls = 0
+		while time.time() < deadline:
+			# Drop anything left from the reset or an earlier poll
+			serial.reset_input_buffer()
+			serial.write(port_cmd_bytes)
+			polls += 1
+			return_code, error_code = read_response(serial)
+			if return_code == RETURN_CODE_SUCCESS:
+				if polls > 1:
+					drain_responses(serial)
+				return True
+	finally:
+		serial.timeout = serial_timeout
+	return False
 
 def write_to_comm(serial, bytes):
 	ecode = EXIT_CODE_SUCCESS
@@ -30,138 +155,311 @@ def write_to_comm(serial, bytes):
 	# Write the provided bytes to the serial port
 	serial.write(bytes)
 
-	# Clear the first newline
-	serial.readline()
-
-	# Get the return code
-	return_code = serial.read(RETURN_CODE_SIZE).strip().decode('utf-8')
+	return_code, error_code = read_response(serial)
 	if return_code != RETURN_CODE_SUCCESS:
-		# Get the error code
-		error_code = serial.readline().strip().decode('utf-8')
 		sys.stderr.write('{} {}'.format(return_code, error_code))
 		ecode = errno.EPERM
 
 	return ecode
 
-exit_code = EXIT_CODE_SUCCESS	# Success (for now)
-if len(sys.argv) >= 4:
-	port = sys.argv[1]
-	baudrate = int(sys.argv[2])
-	cmd = sys.argv[3]
+def list_files(serial):
+	"""
+	Returns the directory entries reported by AT+DIR, or None on failure
+	"""
+	port_cmd_bytes = bytearray(LIST_FILES_CMD, 'utf-8')
+	serial.write(port_cmd_bytes)
 
-	# Open the COM port to the Bluetooth adapter
-	ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT)
+	# One record per script, then the return code ends the listing
+	entries = []
+	while True:
+		record = serial.read_record()
+		if record is None:
+			sys.stderr.write('Timeout reading the script list')
+			return None
 
-	# Send break, flush the input, delay for BL654 reset
-	ser.send_break()
-	ser.reset_input_buffer()
-	time.sleep(3)
+		return_code = record[:RETURN_CODE_SIZE].decode('utf-8')
+		if return_code == RETURN_CODE_SUCCESS:
+			return entries
+		elif return_code == RETURN_CODE_SCRIPT_FOUND:
+			entries.append(record[RETURN_CODE_SIZE:].strip().decode('utf-8'))
+		else:
+			# Failed to get the script list
+			sys.stderr.write(return_code)
+			return None
 
-	# Execute the given command
-	if cmd == 'upload':
-		if len(sys.argv) == 6:
-			file_name = sys.argv[4]
-			file_path = sys.argv[5]
-
-			try:
-				f = open(file_path,'rb')
-			except IOError as i:
-				# Failed to open the file
-				sys.stderr.write('{}'.format(i))
-				exit_code = errno.ENOENT
-			else:
-				if f.mode == 'rb':
-					# Open the file at the device
-					port_cmd = UPLOAD_OPEN_FILE_CMD.format(file_name)
-					port_cmd_bytes = bytearray(port_cmd, 'utf-8')
-					exit_code = write_to_comm(ser, port_cmd_bytes)
-					if exit_code == EXIT_CODE_SUCCESS:
-						# Read the file (in bytes)
-						bytes = f.read(MAX_UPLOAD_SIZE)
-						while bytes:
-							# Convert bytes to hex
-							if PYTHON3:
-								bytes_hex = bytes.hex()
-							else:
-								bytes_hex = binascii.hexlify(bytes)
-
-							# Write this chunk of bytes to the BT module
-							port_cmd = UPLOAD_WRITE_DATA_CMD.format(bytes_hex)
-							port_cmd_bytes = bytearray(port_cmd, 'utf-8')
-							exit_code = write_to_comm(ser, port_cmd_bytes)
-							if exit_code == EXIT_CODE_SUCCESS:
-								# Get the next chunk of bytes
-								bytes = f.read(MAX_UPLOAD_SIZE)
-							else:
-								bytes = None
-
-						if exit_code == EXIT_CODE_SUCCESS:
-							# Close the file at the device
-							port_cmd_bytes = bytearray(UPLOAD_CLOSE_FILE_CMD, 'utf-8')
-							exit_code = write_to_comm(ser, port_cmd_bytes)
-
-				# Close the local file
-				f.close()
+def is_uploaded(serial, file_name, size):
+	"""
+	Returns True if the module lists a file with this name and size. A name
+	alone does not tell whether the contents changed, so a file listed
+	without its size (as AT+DIR does on most firmware) is not uploaded yet
+	"""
+	for entry in list_files(serial) or []:
+		fields = entry.split('\t')
+		if fields[0] == file_name and len(fields) > 1 and fields[1].strip() == str(size):
+			return True
+	return False
+
+class UploadEncoder():
+	"""
+	Builds AT+FWRH lines in one reusable buffer, and reads the file into
+	another, for chunks of up to 'chunk_size' bytes
+	"""
+	def __init__(self, chunk_size):
+		self.chunk_size = chunk_size
+		self.chunk = bytearray(chunk_size)
+		self.line = bytearray(len(UPLOAD_WRITE_DATA_PREFIX) + 2 * chunk_size + len(UPLOAD_WRITE_DATA_SUFFIX))
+		self.line[:len(UPLOAD_WRITE_DATA_PREFIX)] = UPLOAD_WRITE_DATA_PREFIX
+
+	def encode(self, data):
+		"""
+		Returns the AT+FWRH line for the data; valid until the next call
+		"""
+		start = len(UPLOAD_WRITE_DATA_PREFIX)
+		end = start + 2 * len(data)
+		self.line[start:end] = binascii.hexlify(data)
+		self.line[end:end + len(UPLOAD_WRITE_DATA_SUFFIX)] = UPLOAD_WRITE_DATA_SUFFIX
+		return memoryview(self.line)[:end + len(UPLOAD_WRITE_DATA_SUFFIX)]
+
+	def read(self, f, size=None):
+		"""
+		Reads the next chunk of the file; returns an empty view at the end
+		"""
+		view = memoryview(self.chunk)[:size or self.chunk_size]
+		return view[:f.readinto(view) or 0]
+
+def probe_upload_size(serial, f):
+	"""
+	Writes the first chunk with the largest accepted AT+FWRH line, trying
+	UPLOAD_SIZE_CANDIDATES in turn; a rejected line writes nothing
+	Returns the encoder for the accepted size and the bytes written, or (None, 0)
+	"""
+	for chunk_size in UPLOAD_SIZE_CANDIDATES:
+		encoder = UploadEncoder(chunk_size)
+		data = encoder.read(f)
+		if not data:
+			return encoder, 0
+
+		serial.write(encoder.encode(data))
+		return_code, error_code = read_response(serial)
+		if return_code == RETURN_CODE_SUCCESS:
+			return encoder, len(data)
+
+		# Too long (or not understood); wait until the module has answered all
+		# of the line, dropping the rest of its responses, and retry smaller
+		drain_responses(serial)
+		f.seek(-len(data), 1)
+
+	sys.stderr.write('{} {}'.format(return_code, error_code))
+	return None, 0
+
+def upload_data(serial, f, window=UPLOAD_WINDOW):
+	"""
+	Streams the file to the open file at the module with AT+FWRH. Up to 'window'
+	lines (and UPLOAD_WINDOW_BYTES) are sent ahead; responses arrive in order
+	and are matched to the chunk offsets waiting for them
+	Returns an exit code
+	"""
+	encoder, offset = probe_upload_size(serial, f)
+	if encoder is None:
+		return errno.EPERM
+
+	pending = collections.deque()
+	pending_bytes = 0
+	data = encoder.read(f)
+	while data or pending:
+		if data and len(pending) < window and pending_bytes + len(encoder.line) <= UPLOAD_WINDOW_BYTES:
+			line = encoder.encode(data)
+			serial.write(line)
+			pending.append((offset, len(line)))
+			pending_bytes += len(line)
+			offset += len(data)
+			data = encoder.read(f)
+			continue
+
+		chunk_offset, line_size = pending.popleft()
+		pending_bytes -= line_size
+		return_code, error_code = read_response(serial)
+		if return_code != RETURN_CODE_SUCCESS:
+			sys.stderr.write('{} {} (chunk at offset {})'.format(return_code, error_code, chunk_offset))
+			return errno.EPERM
+
+	return EXIT_CODE_SUCCESS
+
+class BtpaSession():
+	"""
+	One open port to the BT module; the module is reset and polled until it
+	is ready once, and any number of commands then run on the same port
+	Methods return an exit code, except list() which returns the entries and
+	upload() which returns UPLOAD_SKIPPED for a file the module already has
+	"""
+	def __init__(self, port, baudrate, ready_timeout=READY_TIMEOUT_SEC):
+		# Open the COM port to the Bluetooth adapter
+		self.ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT)
+		self.port = AtPort(self.ser)
+		self.ready = self.reset(ready_timeout)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def reset(self, ready_timeout=READY_TIMEOUT_SEC):
+		"""
+		Sends a break and waits for the BL654 to answer after its reset
+		"""
+		self.ser.send_break()
+		self.port.reset_input_buffer()
+		return wait_ready(self.port, ready_timeout)
+
+	def close(self):
+		self.ser.close()
+
+	def list(self):
+		"""
+		Returns the directory entries, or None on failure
+		"""
+		return list_files(self.port)
+
+	def upload(self, file_name, file_path, window=UPLOAD_WINDOW, skip_existing=False):
+		exit_code = EXIT_CODE_SUCCESS
+		try:
+			f = open(file_path,'rb')
+		except IOError as i:
+			# Failed to open the file
+			sys.stderr.write('{}'.format(i))
+			return errno.ENOENT
+
+		if skip_existing and is_uploaded(self.port, file_name, os.fstat(f.fileno()).st_size):
+			# The module already has this file
+			exit_code = UPLOAD_SKIPPED
 		else:
-			print('usage: btpa_utility <port> <baudrate> upload <new name> <path to file>')
-	elif cmd == 'list':
-		port_cmd_bytes = bytearray(LIST_FILES_CMD, 'utf-8')
-		ser.write(port_cmd_bytes)
+			# Open the file at the device
+			port_cmd = UPLOAD_OPEN_FILE_CMD.format(file_name)
+			port_cmd_bytes = bytearray(port_cmd, 'utf-8')
+			exit_code = write_to_comm(self.port, port_cmd_bytes)
+			if exit_code == EXIT_CODE_SUCCESS:
+				# Stream the file to the BT module
+				exit_code = upload_data(self.port, f, window)
 
-		# Clear the first newline
-		ser.readline()
+				if exit_code == EXIT_CODE_SUCCESS:
+					# Close the file at the device
+					port_cmd_bytes = bytearray(UPLOAD_CLOSE_FILE_CMD, 'utf-8')
+					exit_code = write_to_comm(self.port, port_cmd_bytes)
 
-		# Get the return code
-		return_code = ser.read(RETURN_CODE_SIZE).strip().decode('utf-8')
-		while return_code != '':
-			if return_code == RETURN_CODE_SUCCESS:
-				# Clear the serial line to look for more scripts
-				ser.readline()
-			elif return_code == RETURN_CODE_SCRIPT_FOUND:
+		# Close the local file
+		f.close()
+		return exit_code
+
+	def delete(self, file, force=False):
+		if force:
+			port_cmd = DELETE_FILE_FORCE_CMD.format(file)
+		else:
+			port_cmd = DELETE_FILE_CMD.format(file)
+		return write_to_comm(self.port, bytearray(port_cmd, 'utf-8'))
+
+	def rename(self, old, new):
+		port_cmd = RENAME_FILE_CMD.format(old, new)
+		return write_to_comm(self.port, bytearray(port_cmd, 'utf-8'))
+
+	def command(self, at_cmd):
+		return write_to_comm(self.port, bytearray('{}\r\n'.format(at_cmd), 'utf-8'))
+
+def run_command(session, cmd, args):
+	"""
+	Runs one command of the command line (or of a batch script) on the session
+	Returns an exit code
+	"""
+	exit_code = EXIT_CODE_SUCCESS
+	if cmd == 'upload':
+		if len(args) >= 2:
+			# Collect any upload options that are on the command line
+			options = args[2:]
+			window = UPLOAD_WINDOW
+			if '--window' in options and options.index('--window') + 1 < len(options):
+				window = max(1, int(options[options.index('--window') + 1]))
+			exit_code = session.upload(args[0], args[1], window, '--skip-existing' in options)
+			if exit_code == UPLOAD_SKIPPED:
+				print('{} already uploaded'.format(args[0]))
+				exit_code = EXIT_CODE_SUCCESS
+		else:
+			print('usage: btpa_utility <port> <baudrate> upload <new name> <path to file> [--window <lines>] [--skip-existing]')
+			exit_code = errno.EINVAL
+	elif cmd == 'list':
+		entries = session.list()
+		if entries is None:
+			exit_code = errno.EPERM
+		else:
+			for script in entries:
 				# Print the script name that was found
-				script = ser.readline().strip().decode('utf-8')
 				print(script)
-			else:
-				# Failed to get the script list
-				sys.stderr.write(return_code)
-				exit_code = errno.EPERM
-				break
-
-			return_code = ser.read(RETURN_CODE_SIZE).strip().decode('utf-8')
 	elif cmd == 'delete':
-		if len(sys.argv) >= 5:
-			file = sys.argv[4]
-
+		if len(args) >= 1:
 			# Collect any delete options that are on the command line
-			option = ''
-			if len(sys.argv) == 6:
-				option = sys.argv[5]
-
-			if option == '--force':
-				port_cmd = DELETE_FILE_FORCE_CMD.format(file)
-			else:
-				port_cmd = DELETE_FILE_CMD.format(file)
-			port_cmd_bytes = bytearray(port_cmd, 'utf-8')
-			exit_code = write_to_comm(ser, port_cmd_bytes)
+			exit_code = session.delete(args[0], args[1:2] == ['--force'])
 		else:
 			print('usage: btpa_utility <port> <baudrate> delete <filename> [--force]')
+			exit_code = errno.EINVAL
 	elif cmd == 'rename':
-		if len(sys.argv) == 6:
-			old = sys.argv[4]
-			new = sys.argv[5]
-			port_cmd = RENAME_FILE_CMD.format(old, new)
-			port_cmd_bytes = bytearray(port_cmd, 'utf-8')
-			exit_code = write_to_comm(ser, port_cmd_bytes)
+		if len(args) == 2:
+			exit_code = session.rename(args[0], args[1])
 		else:
 			print('usage: btpa_utility <port> <baudrate> rename <current filename> <new filename>')
+			exit_code = errno.EINVAL
 	elif cmd == 'cmd':
-		if len(sys.argv) == 5:
-			at_cmd = '{}\r\n'.format(sys.argv[4])
-			at_cmd_bytes = bytearray(at_cmd, 'utf-8')
-			exit_code = write_to_comm(ser, at_cmd_bytes)
+		if len(args) == 1:
+			exit_code = session.command(args[0])
+		else:
+			exit_code = errno.EINVAL
 	else:
 		print('Invalid command: {}'.format(cmd))
-else:
-	print('usage: btpa_utility <port> <baudrate> <command>')
+		exit_code = errno.EINVAL
+
+	return exit_code
+
+def run_batch(session, script_path):
+	"""
+	Runs the commands of a batch script, one per line as on the command line
+	(e.g. 'upload $autorun$ autorun.sb'); blank lines and lines starting with
+	# are skipped. Stops at the first command that fails
+	"""
+	try:
+		f = open(script_path, 'r')
+	except IOError as i:
+		sys.stderr.write('{}'.format(i))
+		return errno.ENOENT
+
+	exit_code = EXIT_CODE_SUCCESS
+	with f:
+		for line_number, line in enumerate(f, 1):
+			args = shlex.split(line, comments=True)
+			if not args:
+				continue
+			exit_code = run_command(session, args[0], args[1:])
+			if exit_code != EXIT_CODE_SUCCESS:
+				sys.stderr.write('\n{}:{}: {} failed\n'.format(script_path, line_number, args[0]))
+				break
+
+	return exit_code
+
+if __name__ == '__main__':
+	exit_code = EXIT_CODE_SUCCESS	# Success (for now)
+	if len(sys.argv) >= 4:
+		port = sys.argv[1]
+		baudrate = int(sys.argv[2])
+		cmd = sys.argv[3]
+
+		# Open the port and wait for the BL654 to come out of reset
+		with BtpaSession(port, baudrate) as session:
+			# Execute the given command
+			if cmd == 'batch':
+				if len(sys.argv) == 5:
+					exit_code = run_batch(session, sys.argv[4])
+				else:
+					print('usage: btpa_utility <port> <baudrate> batch <path to script>')
+			else:
+				exit_code = run_command(session, cmd, sys.argv[4:])
+	else:
+		print('usage: btpa_utility <port> <baudrate> <command>')
 
-sys.exit(exit_code)
+	sys.exit(exit_code)
@@ -6,5 +6,14 @@ setup(name='lrd-bt-utils',
       version='1.0',
       description='BTPA Firmware Loading Utilities',
       scripts=['btpa_utility.py', 'btpa_firmware_loader/btpa_firmware_loader.py'],
-      py_modules=['btpa_firmware_loader/uwf_processor', 'btpa_firmware_loader/ig60_bl654_uwf_processor'],
+      py_modules=['btpa_firmware_loader/uwf_processor', 'btpa_firmware_loader/ig60_bl654_uwf_processor',
+                  'btpa_firmware_loader/uwf_checksum', 'btpa_firmware_loader/uwf_image',
+                  'btpa_firmware_loader/uwf_plan', 'btpa_firmware_loader/uwf_flash',
+                  'btpa_firmware_loader/uwf_async_processor', 'btpa_firmware_loader/uwf_link',
+                  'btpa_firmware_loader/uwf_journal', 'btpa_firmware_loader/uwf_simulator',
+                  'btpa_firmware_loader/uwf_stats', 'btpa_firmware_loader/uwf_erase',
+                  'btpa_firmware_loader/uwf_protocol', 'btpa_firmware_loader/uwf_delta',
+                  'btpa_firmware_loader/uwf_cache', 'btpa_firmware_loader/uwf_errors',
+                  'btpa_firmware_loader/uwf_daemon', 'btpa_firmware_loader/uwf_gpio',
+                  'btpa_utility'],
      )
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The loader modules import each other by their flat names; btpa_utility sits at the top
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'btpa_firmware_loader'))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,246 @@
+"""
+Drives btpa_utility against an in-process stand-in for the smartBASIC AT interface
+"""
+import re
+import binascii
+import pytest
+
+pytest.importorskip('serial')
+
+import btpa_utility
+
+class FakeAtModule():
+	"""
+	pyserial look-alike answering AT commands with '\\n' <code> [<tab> <text>] '\\r'
+	records. Responses are available as soon as the command is written; the
+	most AT+FWRH lines ever written ahead of reading their responses is kept in
+	'max_unread'. AT+FWRH lines longer than 'max_chunk' bytes are rejected
+	with two error records, as the module answers each part of a split line
+	"""
+	def __init__(self, files=None, max_chunk=128, list_sizes=False):
+		self.files = dict(files or {})
+		self.max_chunk = max_chunk
+		self.list_sizes = list_sizes
+		self.timeout = btpa_utility.SERIAL_TIMEOUT
+		self.baudrate = 115200
+		self.buffer = bytearray()
+		self.line = bytearray()
+		self.open_name = None
+		self.open_data = None
+		self.writes = []
+		self.unread = 0
+		self.max_unread = 0
+		self.closed = False
+
+	def respond(self, code, text=None):
+		record = '\n' + code + ('\t' + text if text is not None else '') + '\r'
+		self.buffer += record.encode('utf-8')
+
+	def write(self, data):
+		self.line += bytes(data)
+		while b'\r\n' in self.line:
+			line, self.line = self.line.split(b'\r\n', 1)
+			self.command(line.decode('utf-8'))
+		return len(data)
+
+	def command(self, line):
+		self.writes.append(line)
+		write = re.match(r'AT\+FWRH "([0-9a-f]*)"$', line)
+		if write:
+			data = binascii.unhexlify(write.group(1))
+			if len(data) > self.max_chunk or self.open_data is None:
+				self.respond('01', 'E00F')
+				self.respond('01', 'E00F')
+				return
+			self.open_data += data
+			self.unread += 1
+			self.max_unread = max(self.max_unread, self.unread)
+			self.respond('00')
+			return
+
+		match = re.match(r'AT\+FOW "(.*)"$', line)
+		delete = re.match(r'AT\+DEL "(.*)"( \+)?$', line)
+		rename = re.match(r'AT\+REN "(.*)" "(.*)"$', line)
+		if line == 'AT':
+			self.respond('00')
+		elif match:
+			self.open_name = match.group(1)
+			self.open_data = b''
+			self.respond('00')
+		elif line == 'AT+FCL' and self.open_data is not None:
+			self.files[self.open_name] = self.open_data
+			self.open_data = None
+			self.respond('00')
+		elif delete and delete.group(1) in self.files:
+			del self.files[delete.group(1)]
+			self.respond('00')
+		elif rename and rename.group(1) in self.files:
+			self.files[rename.group(2)] = self.files.pop(rename.group(1))
+			self.respond('00')
+		elif line == 'AT+DIR':
+			for name, data in self.files.items():
+				self.respond('06', '{}\t{}'.format(name, len(data)) if self.list_sizes else name)
+			self.respond('00')
+		else:
+			self.respond('01', 'E007')
+
+	@property
+	def in_waiting(self):
+		return len(self.buffer)
+
+	def read(self, size=1):
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		self.unread = 0
+		return data
+
+	def reset_input_buffer(self):
+		self.buffer = bytearray()
+
+	def send_break(self):
+		pass
+
+	def close(self):
+		self.closed = True
+
+@pytest.fixture
+def contents():
+	return bytes(range(256)) * 5 + b'tail'
+
+@pytest.fixture
+def script(tmp_path, contents):
+	path = tmp_path / 'autorun.sb'
+	path.write_bytes(contents)
+	return str(path)
+
+def session(monkeypatch, module):
+	monkeypatch.setattr(btpa_utility.serial, 'Serial', lambda *args, **keywords: module)
+	return btpa_utility.BtpaSession('/dev/ttyS2', 115200)
+
+def test_upload(monkeypatch, script, contents):
+	module = FakeAtModule()
+	assert session(monkeypatch, module).upload('$autorun$', script) == btpa_utility.EXIT_CODE_SUCCESS
+	assert module.files['$autorun$'] == contents
+
+@pytest.mark.parametrize('window', [1, 2, btpa_utility.UPLOAD_WINDOW])
+def test_upload_window(monkeypatch, script, contents, window):
+	module = FakeAtModule()
+	assert session(monkeypatch, module).upload('$autorun$', script, window) == btpa_utility.EXIT_CODE_SUCCESS
+	assert module.files['$autorun$'] == contents
+
+	# Lines ahead of their responses: the window, bounded by UPLOAD_WINDOW_BYTES
+	line_size = btpa_utility.UploadEncoder(btpa_utility.UPLOAD_SIZE_CANDIDATES[0]).line
+	assert module.max_unread == min(window, btpa_utility.UPLOAD_WINDOW_BYTES // len(line_size))
+
+def test_upload_probes_smaller_lines(monkeypatch, script, contents):
+	module = FakeAtModule(max_chunk=btpa_utility.MAX_UPLOAD_SIZE)
+	assert session(monkeypatch, module).upload('$autorun$', script) == btpa_utility.EXIT_CODE_SUCCESS
+	assert module.files['$autorun$'] == contents
+	lengths = [len(line) for line in module.writes if line.startswith('AT+FWRH')]
+	assert lengths[0] > lengths[1] > lengths[2] == lengths[3]
+
+def test_upload_failure(monkeypatch, script):
+	module = FakeAtModule(max_chunk=8)
+	assert session(monkeypatch, module).upload('$autorun$', script) == btpa_utility.errno.EPERM
+	assert '$autorun$' not in module.files
+
+def test_skip_existing_needs_the_size(monkeypatch, script, contents):
+	# Listed by name only: the contents may have changed, so it is uploaded
+	module = FakeAtModule({'$autorun$': b'old'})
+	assert session(monkeypatch, module).upload('$autorun$', script, skip_existing=True) == btpa_utility.EXIT_CODE_SUCCESS
+	assert module.files['$autorun$'] == contents
+
+	# Listed with another size
+	module = FakeAtModule({'$autorun$': b'old'}, list_sizes=True)
+	assert session(monkeypatch, module).upload('$autorun$', script, skip_existing=True) == btpa_utility.EXIT_CODE_SUCCESS
+	assert module.files['$autorun$'] == contents
+
+	# Listed with the same size
+	module = FakeAtModule({'$autorun$': contents}, list_sizes=True)
+	assert session(monkeypatch, module).upload('$autorun$', script, skip_existing=True) == btpa_utility.UPLOAD_SKIPPED
+	assert not [line for line in module.writes if line.startswith('AT+FOW')]
+
+def test_session(monkeypatch):
+	module = FakeAtModule({'a.sb': b'a', 'b.sb': b'b'})
+	with session(monkeypatch, module) as at:
+		assert at.ready
+		assert at.list() == ['a.sb', 'b.sb']
+		assert at.rename('a.sb', 'c.sb') == btpa_utility.EXIT_CODE_SUCCESS
+		assert at.delete('b.sb', True) == btpa_utility.EXIT_CODE_SUCCESS
+		assert at.delete('b.sb') == btpa_utility.errno.EPERM
+		assert at.command('AT') == btpa_utility.EXIT_CODE_SUCCESS
+		assert at.list() == ['c.sb']
+	assert module.writes[-2:] == ['AT', 'AT+DIR']
+	assert 'AT+DEL "b.sb" +' in module.writes
+	assert module.closed
+
+def test_run_command(monkeypatch, script, capsys):
+	module = FakeAtModule({'$autorun$': bytes(5 * 256 + 4)}, list_sizes=True)
+	at = session(monkeypatch, module)
+
+	# A file the module already has is reported and counts as a success
+	assert btpa_utility.run_command(at, 'upload', ['$autorun$', script, '--skip-existing']) == btpa_utility.EXIT_CODE_SUCCESS
+	assert 'already uploaded' in capsys.readouterr().out
+	assert btpa_utility.run_command(at, 'upload', ['$autorun$']) == btpa_utility.errno.EINVAL
+	assert btpa_utility.run_command(at, 'format', []) == btpa_utility.errno.EINVAL
+
+def test_run_batch(monkeypatch, tmp_path, script, contents, capsys):
+	batch = tmp_path / 'batch.txt'
+	batch.write_text('# Load the application\n\nupload $autorun$ "{}"\nrename $autorun$ app\nlist\ndelete missing\nlist\n'.format(script))
+	module = FakeAtModule()
+	assert btpa_utility.run_batch(session(monkeypatch, module), str(batch)) == btpa_utility.errno.EPERM
+	assert module.files == {'app': contents}
+
+	# Stopped at the failed delete, which is reported with its line
+	output = capsys.readouterr()
+	assert output.out.split() == ['app']
+	assert '{}:6: delete failed'.format(batch) in output.err
+	assert [line for line in module.writes if line.startswith('AT+DIR')] == ['AT+DIR']
+
+def test_run_batch_missing_script(monkeypatch, tmp_path):
+	assert btpa_utility.run_batch(session(monkeypatch, FakeAtModule()), str(tmp_path / 'missing.txt')) == btpa_utility.errno.ENOENT
+
+class ChunkedSerial():
+	"""
+	Serial port stand-in handing out its input in the given chunks, one per read
+	"""
+	def __init__(self, chunks):
+		self.chunks = list(chunks)
+		self.timeout = btpa_utility.SERIAL_TIMEOUT
+		self.reads = 0
+
+	@property
+	def in_waiting(self):
+		return len(self.chunks[0]) if self.chunks else 0
+
+	def read(self, size=1):
+		self.reads += 1
+		if not self.chunks:
+			return b''
+		data, self.chunks[0] = self.chunks[0][:size], self.chunks[0][size:]
+		if not self.chunks[0]:
+			self.chunks.pop(0)
+		return data
+
+def test_framer_joins_split_records():
+	port = btpa_utility.AtPort(ChunkedSerial([b'\n0', b'1\tE0', b'07\r']))
+	assert port.read_record() == b'01\tE007'
+	assert port.read_record() is None
+
+def test_framer_splits_one_read():
+	serial = ChunkedSerial([b'\n06\ta.sb\r\n06\tb.sb\r\n00\r'])
+	port = btpa_utility.AtPort(serial)
+	assert [port.read_record() for i in range(3)] == [b'06\ta.sb', b'06\tb.sb', b'00']
+	assert serial.reads == 1
+
+def test_framer_skips_empty_records():
+	port = btpa_utility.AtPort(ChunkedSerial([b'\r\n\r', b'\n00\r']))
+	assert port.read_record() == b'00'
+
+def test_read_response():
+	port = btpa_utility.AtPort(ChunkedSerial([b'\n00\r\n01\tE00F\r']))
+	assert btpa_utility.read_response(port) == ('00', '')
+	assert btpa_utility.read_response(port) == ('01', 'E00F')
+
+	# Timeout
+	assert btpa_utility.read_response(port) == ('', '')
@@ -0,0 +1,107 @@
+"""
+Waits for the DeviceService boot mode signals of the IG60 processor, without a system bus
+"""
+import threading
+import pytest
+
+pytest.importorskip('serial')
+
+import ig60_bl654_uwf_processor
+from ig60_bl654_uwf_processor import BT_BOOTLOADER_MODE
+from ig60_bl654_uwf_processor import BT_SMART_BASIC_MODE
+
+SIGNAL = 'BtBootModeChanged'
+
+class FakeServiceBus(ig60_bl654_uwf_processor.DeviceServiceBus):
+	"""
+	DeviceServiceBus with the signal state only; signals are delivered by calling on_signal
+	"""
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.events = 0
+		self.boot_mode = None
+		self.signals = [SIGNAL]
+
+class FakeDeviceService():
+	"""
+	SetBtBootMode that signals the new boot mode from another thread, like the GLib loop
+	"""
+	def __init__(self, service_bus, signal=True, result=0):
+		self.service_bus = service_bus
+		self.signal = signal
+		self.result = result
+		self.modes = []
+
+	def SetBtBootMode(self, mode):
+		self.modes.append(mode)
+		if self.signal:
+			threading.Timer(0.05, self.service_bus.on_signal, (mode,), {'member': SIGNAL}).start()
+		return self.result
+
+def signal_later(service_bus, *args, **keywords):
+	timer = threading.Timer(0.05, service_bus.on_signal, args, keywords)
+	timer.start()
+	return timer
+
+def test_wait_wakes_for_the_requested_mode():
+	service_bus = FakeServiceBus()
+	mark = service_bus.mark()
+	signal_later(service_bus, BT_BOOTLOADER_MODE, member=SIGNAL)
+	assert service_bus.wait(mark, BT_BOOTLOADER_MODE, 2)
+
+@pytest.mark.parametrize('args, keywords', [
+	((BT_SMART_BASIC_MODE,), {'member': SIGNAL}),
+	((BT_BOOTLOADER_MODE,), {'member': 'PropertiesChanged'}),
+	((BT_BOOTLOADER_MODE,), {}),
+	((), {'member': SIGNAL}),
+	(('bootloader',), {'member': SIGNAL}),
+])
+def test_wait_ignores_other_signals(args, keywords):
+	service_bus = FakeServiceBus()
+	mark = service_bus.mark()
+	signal_later(service_bus, *args, **keywords).join()
+	assert not service_bus.wait(mark, BT_BOOTLOADER_MODE, 0.1)
+
+def test_wait_ignores_signals_before_the_mark():
+	service_bus = FakeServiceBus()
+	service_bus.on_signal(BT_BOOTLOADER_MODE, member=SIGNAL)
+	mark = service_bus.mark()
+	assert not service_bus.wait(mark, BT_BOOTLOADER_MODE, 0.1)
+
+	# A signal for the same mode after the mark does count
+	signal_later(service_bus, BT_BOOTLOADER_MODE, member=SIGNAL)
+	assert service_bus.wait(mark, BT_BOOTLOADER_MODE, 2)
+
+def make_processor(service_bus, device_svc):
+	processor = object.__new__(ig60_bl654_uwf_processor.Ig60Bl654UwfProcessor)
+	processor.service_bus = service_bus
+	processor.device_svc = device_svc
+	processor.boot_mode_timeout = 2
+	return processor
+
+def test_set_boot_mode_waits_for_the_signal():
+	service_bus = FakeServiceBus()
+	processor = make_processor(service_bus, FakeDeviceService(service_bus))
+	assert processor.set_boot_mode(BT_BOOTLOADER_MODE) == 0
+	assert service_bus.boot_mode == BT_BOOTLOADER_MODE
+	processor.reset_into_firmware()
+	assert service_bus.boot_mode == BT_SMART_BASIC_MODE
+
+@pytest.mark.parametrize('signal, result', [(False, 0), (True, 1)])
+def test_set_boot_mode_without_a_signal(signal, result):
+	# A missing signal only costs the timeout; a failed call does not wait at all
+	service_bus = FakeServiceBus()
+	device_svc = FakeDeviceService(service_bus, signal, result)
+	processor = make_processor(service_bus, device_svc)
+	processor.boot_mode_timeout = 0.1
+	assert processor.set_boot_mode(BT_BOOTLOADER_MODE) == result
+	assert device_svc.modes == [BT_BOOTLOADER_MODE]
+
+def test_set_boot_mode_without_signals():
+	service_bus = FakeServiceBus()
+	service_bus.signals = []
+	device_svc = FakeDeviceService(service_bus, signal=False)
+	processor = make_processor(service_bus, device_svc)
+	processor.boot_mode_timeout = None
+	assert processor.set_boot_mode(BT_SMART_BASIC_MODE) == 0
+	assert device_svc.modes == [BT_SMART_BASIC_MODE]
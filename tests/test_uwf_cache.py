@@ -0,0 +1,84 @@
+"""
+Stores, restores and evicts image cache entries
+"""
+import os
+import json
+import pytest
+
+pytest.importorskip('serial')
+
+import uwf_plan
+import uwf_image
+import uwf_cache
+import uwf_checksum
+import uwf_simulator
+
+@pytest.fixture
+def paths(tmp_path):
+	paths = []
+	for i in range(3):
+		path = tmp_path / 'image{}.uwf'.format(i)
+		path.write_bytes(uwf_simulator.build_image(bytes(range(i, 256)) * 40))
+		paths.append(str(path))
+	return paths
+
+def open_image(path):
+	# Like the loader with --cache: the cache restores the index
+	return uwf_image.UwfImage(path, index=False)
+
+def test_load_restores_the_index(tmp_path, paths):
+	cache = uwf_cache.ImageCache(str(tmp_path / 'cache'))
+	with open_image(paths[0]) as image:
+		tables = cache.load(image)
+		sections = image.sections
+	assert os.path.exists(cache.path(image.digest()))
+
+	with open_image(paths[0]) as image:
+		restored = cache.load(image)
+		assert image.sections == sections
+		plan = uwf_plan.compile_flash_plan(image)
+	assert sorted(restored) == uwf_cache.CACHE_BLOCK_SIZES
+
+	for size in uwf_cache.CACHE_BLOCK_SIZES:
+		assert restored[size].blocks == tables[size].blocks
+
+	# Every block of the write ranges is in the table
+	write = plan.write_ranges[0]
+	block = write.payload[252:504]
+	assert restored[252].lookup(write.start + 252, 252) == uwf_checksum.checksum(block)
+	assert restored[252].lookup(write.start + 251, 252) is None
+	assert restored[252].lookup(write.start + 252, 100) is None
+
+def test_unreadable_entries_are_rebuilt(tmp_path, paths):
+	cache = uwf_cache.ImageCache(str(tmp_path / 'cache'))
+	with open_image(paths[0]) as image:
+		cache.load(image)
+		path = cache.path(image.digest())
+
+	for contents in ['{', json.dumps({'version': uwf_cache.CACHE_VERSION + 1})]:
+		with open(path, 'w') as f:
+			f.write(contents)
+		with open_image(paths[0]) as image:
+			assert sorted(cache.load(image)) == uwf_cache.CACHE_BLOCK_SIZES
+			assert image.sections
+		with open(path) as f:
+			assert json.load(f)['version'] == uwf_cache.CACHE_VERSION
+
+def test_least_recently_used_entries_are_evicted(tmp_path, paths):
+	cache = uwf_cache.ImageCache(str(tmp_path / 'cache'))
+	digests = []
+	for index, path in enumerate(paths[:2]):
+		with open_image(path) as image:
+			cache.load(image)
+			digests.append(image.digest())
+		os.utime(cache.path(digests[-1]), (index, index))
+
+	# Using the first entry again makes the second one the oldest
+	with open_image(paths[0]) as image:
+		cache.load(image)
+	cache.max_size = os.path.getsize(cache.path(digests[0])) * 2
+
+	with open_image(paths[2]) as image:
+		cache.load(image)
+		digests.append(image.digest())
+	assert [os.path.exists(cache.path(digest)) for digest in digests] == [True, False, True]
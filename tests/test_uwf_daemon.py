@@ -0,0 +1,117 @@
+"""
+Checks the image store, job validation and control socket of uwf_daemon
+"""
+import io
+import json
+import errno
+import socket
+import threading
+import pytest
+
+pytest.importorskip('serial')
+
+import uwf_daemon
+import uwf_simulator
+
+@pytest.fixture
+def paths(tmp_path):
+	paths = []
+	for i in range(3):
+		path = tmp_path / 'image{}.uwf'.format(i)
+		path.write_bytes(uwf_simulator.build_image(bytes([i]) * 0x1000))
+		paths.append(str(path))
+	return paths
+
+def is_closed(image):
+	return image.file.closed
+
+def test_image_store_reuses_images(paths):
+	store = uwf_daemon.ImageStore(limit=2)
+	image, plan, checksum_tables = store.get(paths[0])
+	store.release(image)
+	assert store.get(paths[0])[0] is image
+	store.release(image)
+	assert not is_closed(image)
+
+def test_image_store_closes_dropped_images(paths):
+	store = uwf_daemon.ImageStore(limit=1)
+	first = store.get(paths[0])[0]
+	store.release(first)
+	second = store.get(paths[1])[0]
+	assert is_closed(first)
+
+	# A job still using a dropped image keeps it open until it is done
+	store.get(paths[2])
+	assert not is_closed(second)
+	store.release(second)
+	assert is_closed(second)
+
+def test_image_store_rejects_bad_images(tmp_path):
+	path = tmp_path / 'bad.uwf'
+	path.write_bytes(b'T\x04\x00\x00\x00')
+	store = uwf_daemon.ImageStore()
+	with pytest.raises(ValueError):
+		store.get(str(path))
+	with pytest.raises(OSError):
+		store.get(str(tmp_path / 'missing.uwf'))
+
+@pytest.mark.parametrize('job, valid', [
+	({'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': 115200, 'file': 'fw.uwf'}, True),
+	({'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': 115200}, False),
+	({'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': '115200', 'file': 'fw.uwf'}, False),
+	({'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': 115200, 'file': 'fw.uwf', 'options': {'speed': 1}}, False),
+	({'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': 115200, 'file': 'fw.uwf', 'options': {'reset_lines': ['BOOT']}}, False),
+	({'job': 'upload', 'port': '/dev/ttyS2', 'baudrate': 115200, 'name': 'a', 'path': 'a.sb', 'window': 4}, True),
+	({'job': 'upload', 'port': '/dev/ttyS2', 'baudrate': 115200, 'name': 'a', 'path': 'a.sb', 'window': 0}, False),
+	({'job': 'upload', 'port': '/dev/ttyS2', 'baudrate': 115200, 'name': 'a', 'path': 'a.sb', 'window': '4'}, False),
+	({'job': 'upload', 'port': '/dev/ttyS2', 'baudrate': 115200, 'name': 'a'}, False),
+	({'job': 'reboot', 'port': '/dev/ttyS2', 'baudrate': 115200}, False),
+	(None, False),
+])
+def test_check_job(job, valid):
+	assert (uwf_daemon.FlashDaemon().check_job(job) is None) == valid
+
+def test_reset_locks():
+	service = uwf_daemon.FlashDaemon()
+	job = {'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': 115200, 'file': 'fw.uwf'}
+	shared = service.reset_locks(job, {})
+	assert service.reset_locks(dict(job, port='/dev/ttyS3'), {}) == shared
+	assert not set(service.reset_locks(job, {'reset_lines': ['BOOT_2', 'RESET_2']})) & set(shared)
+
+@pytest.fixture
+def server(tmp_path):
+	path = str(tmp_path / 'daemon.sock')
+	server = uwf_daemon.DaemonServer(path, uwf_daemon.FlashDaemon())
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield path
+	server.shutdown()
+	server.server_close()
+
+def test_submit(server, tmp_path):
+	stream = io.StringIO()
+	assert uwf_daemon.submit(server, {'job': 'reboot'}, stream) == errno.EINVAL
+	job = {'job': 'flash', 'port': '/dev/ttyS2', 'baudrate': 115200, 'file': str(tmp_path / 'missing.uwf')}
+	assert uwf_daemon.submit(server, job, stream) == errno.ENOENT
+
+	events = [json.loads(line) for line in stream.getvalue().splitlines()]
+	assert [event['event'] for event in events] == ['done', 'queued', 'started', 'done']
+
+def test_serve_refuses_a_running_daemon(server):
+	with pytest.raises(OSError) as e:
+		uwf_daemon.serve(server, uwf_daemon.FlashDaemon())
+	assert e.value.errno == errno.EADDRINUSE
+
+	# The running daemon still answers
+	assert uwf_daemon.submit(server, {'job': 'reboot'}, io.StringIO()) == errno.EINVAL
+
+def test_serve_replaces_a_stale_socket(monkeypatch, tmp_path):
+	path = str(tmp_path / 'daemon.sock')
+	stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	stale.bind(path)
+	stale.close()
+
+	served = []
+	monkeypatch.setattr(uwf_daemon.DaemonServer, 'serve_forever', lambda self: served.append(self.server_address))
+	uwf_daemon.serve(path, uwf_daemon.FlashDaemon())
+	assert served == [path]
@@ -0,0 +1,61 @@
+"""
+Builds delta and compressed distribution images and expands them through uwf_image
+"""
+import lzma
+import zlib
+import random
+import pytest
+
+pytest.importorskip('serial')
+
+import uwf_delta
+import uwf_image
+import uwf_simulator
+
+@pytest.fixture
+def payload():
+	return bytes(random.Random(1).getrandbits(8) for i in range(0x4000))
+
+@pytest.fixture
+def base(payload):
+	return uwf_simulator.build_image(payload)
+
+@pytest.fixture
+def target(payload):
+	# A patched payload with some new data at the end
+	patched = bytearray(payload)
+	patched[0x1000:0x1010] = b'\x55' * 0x10
+	return uwf_simulator.build_image(bytes(patched) + bytes(random.Random(2).getrandbits(8) for i in range(0x100)))
+
+def test_delta_round_trip(base, target):
+	delta = uwf_delta.make_delta(base, target)
+	assert len(delta) < len(target) // 4
+	assert uwf_delta.apply_delta(base, delta) == target
+
+	with pytest.raises(uwf_delta.DeltaError):
+		uwf_delta.apply_delta(target, delta)
+
+@pytest.mark.parametrize('method', ['xz', 'zlib', 'none'])
+@pytest.mark.parametrize('compress_base', [lzma.compress, zlib.compress, bytes])
+def test_make_image(tmp_path, base, target, method, compress_base):
+	# The base on the gateways may itself be a compressed distribution image
+	base_path = tmp_path / 'base.uwf'
+	base_path.write_bytes(compress_base(base))
+	target_path = tmp_path / 'target.uwf'
+	target_path.write_bytes(target)
+
+	size, packed = uwf_delta.make_image(str(target_path), str(base_path), method)
+	output = tmp_path / 'target.uwfd'
+	output.write_bytes(packed)
+
+	with uwf_image.UwfImage(str(output), str(base_path)) as image:
+		assert image.validate() is None
+		assert bytes(image.data) == target
+
+def test_make_image_compressed_target(tmp_path, target):
+	target_path = tmp_path / 'target.uwf.xz'
+	target_path.write_bytes(lzma.compress(target))
+
+	size, packed = uwf_delta.make_image(str(target_path), method='zlib')
+	assert size == len(target)
+	assert zlib.decompress(packed) == target
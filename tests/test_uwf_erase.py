@@ -0,0 +1,59 @@
+"""
+Plans erase commands from erase ranges
+"""
+import collections
+import pytest
+
+import uwf_erase
+from uwf_erase import EraseRange
+from uwf_erase import EraseCommand
+from uwf_erase import ERASE_BLOCK_64K
+
+SECTOR_SIZE = 0x1000
+
+Plan = collections.namedtuple('Plan', ['erase_ranges', 'erase_after_write'])
+
+def test_coalesce():
+	ranges = [EraseRange(0x5000, 0x1000), EraseRange(0x0, 0x2000), EraseRange(0x1000, 0x2000), EraseRange(0x3000, 0x1000)]
+	assert uwf_erase.coalesce(ranges) == [EraseRange(0x0, 0x4000), EraseRange(0x5000, 0x1000)]
+	assert uwf_erase.coalesce([EraseRange(0x0, 0x4000), EraseRange(0x1000, 0x1000)]) == [EraseRange(0x0, 0x4000)]
+
+def test_sector_erases():
+	# Rounded up to whole sectors
+	commands = uwf_erase.erase_commands([EraseRange(0x2000, 0x1800)], SECTOR_SIZE)
+	assert commands == [EraseCommand(0x2000, SECTOR_SIZE), EraseCommand(0x3000, SECTOR_SIZE)]
+
+def test_block_erases():
+	start = ERASE_BLOCK_64K - 2 * SECTOR_SIZE
+	end = 3 * ERASE_BLOCK_64K + SECTOR_SIZE
+	commands = uwf_erase.erase_commands([EraseRange(start, end - start)], SECTOR_SIZE, ERASE_BLOCK_64K)
+
+	# The unaligned edges in sectors first, then the aligned blocks
+	assert commands == [
+		EraseCommand(start, SECTOR_SIZE),
+		EraseCommand(start + SECTOR_SIZE, SECTOR_SIZE),
+		EraseCommand(3 * ERASE_BLOCK_64K, SECTOR_SIZE),
+		EraseCommand(ERASE_BLOCK_64K, ERASE_BLOCK_64K),
+		EraseCommand(2 * ERASE_BLOCK_64K, ERASE_BLOCK_64K),
+	]
+
+@pytest.mark.parametrize('block_size', [None, ERASE_BLOCK_64K])
+def test_commands_cover_the_ranges_once(block_size):
+	ranges = [EraseRange(0x3000, 0x25000), EraseRange(0x21000, 0x2000), EraseRange(0x40000, 0x800)]
+	erased = []
+	for command in uwf_erase.erase_commands(ranges, SECTOR_SIZE, block_size):
+		erased.extend(range(command.start, command.start + command.size, SECTOR_SIZE))
+	assert sorted(erased) == list(range(0x3000, 0x28000, SECTOR_SIZE)) + [0x40000]
+
+def test_small_range_in_one_block():
+	commands = uwf_erase.erase_commands([EraseRange(0x1000, 0x2000)], SECTOR_SIZE, ERASE_BLOCK_64K)
+	assert commands == [EraseCommand(0x1000, SECTOR_SIZE), EraseCommand(0x2000, SECTOR_SIZE)]
+
+def test_batch_ranges():
+	ranges = [EraseRange(0x2000, 0x1000), EraseRange(0x0, 0x2000)]
+	assert uwf_erase.batch_ranges(Plan(ranges, False)) == [EraseRange(0x0, 0x3000)]
+
+	# Erase records after an overlapping write must stay in image order
+	assert uwf_erase.batch_ranges(Plan(ranges, True)) is None
+	assert uwf_erase.batch_ranges(Plan([], False)) is None
+	assert uwf_erase.batch_ranges(None) is None
@@ -0,0 +1,123 @@
+"""
+Multi-device flashing: port checks, worker limits and per-device results
+"""
+import errno
+import random
+import asyncio
+import pytest
+
+pytest.importorskip('serial')
+
+import uwf_gpio
+import uwf_plan
+import uwf_flash
+import uwf_image
+import uwf_errors
+import uwf_processor
+import uwf_simulator
+
+TIME_SCALE = 0.001
+
+@pytest.fixture
+def payload():
+	return bytes(random.Random(2).getrandbits(8) for i in range(0x3000))
+
+@pytest.fixture
+def image(tmp_path, payload):
+	path = tmp_path / 'image.uwf'
+	path.write_bytes(uwf_simulator.build_image(payload))
+	with uwf_image.UwfImage(str(path)) as image:
+		yield image
+
+def port_reset_lines(ports):
+	return {'port_reset_lines': dict((port, ('boot{}'.format(index), 'reset{}'.format(index))) for index, port in enumerate(ports))}
+
+def test_parse_reset_lines():
+	assert uwf_gpio.parse_reset_lines(['/dev/ttyS1=boot1,reset1', '/dev/ttyS2=boot2, reset2']) == {
+		'/dev/ttyS1': ('boot1', 'reset1'),
+		'/dev/ttyS2': ('boot2', 'reset2'),
+	}
+	for value in ['/dev/ttyS1', '/dev/ttyS1=boot1', '=boot1,reset1', '/dev/ttyS1=boot1,']:
+		with pytest.raises(ValueError):
+			uwf_gpio.parse_reset_lines([value])
+
+def test_check_ports():
+	ports = ['/dev/ttyS1', '/dev/ttyS2']
+	assert uwf_flash.check_ports(ports[:1]) is None
+	assert 'share the GPIO line' in uwf_flash.check_ports(ports)
+	assert uwf_flash.check_ports(ports, None, port_reset_lines(ports)) is None
+
+	# One port keeps the default lines, which the other was also given
+	options = {'port_reset_lines': {'/dev/ttyS2': uwf_gpio.GPIO_LINES}}
+	assert 'share the GPIO line' in uwf_flash.check_ports(ports, None, options)
+
+	assert 'IG60' in uwf_flash.check_ports(ports, uwf_processor.DEVICE_TYPE_IG60, port_reset_lines(ports))
+
+def test_shared_reset_lines_are_rejected(image):
+	plan = uwf_plan.compile_flash_plan(image)
+	ports = ['/dev/ttyS1', '/dev/ttyS2']
+	with pytest.raises(ValueError):
+		uwf_flash.flash_devices(image, plan, ports, 115200)
+	with pytest.raises(ValueError):
+		uwf_flash.flash_devices_async(image, plan, ports, 115200)
+	with pytest.raises(ValueError):
+		uwf_flash.audit_devices(image, plan, ports, 115200)
+
+def test_async_workers(monkeypatch, image):
+	plan = uwf_plan.compile_flash_plan(image)
+	ports = ['/dev/ttyS{}'.format(index) for index in range(5)]
+	running = []
+	most = []
+
+	async def flash_device_async(image, plan, port, baudrate, type=None, options=None, collector=None):
+		running.append(port)
+		most.append(len(running))
+		await asyncio.sleep(0.01)
+		running.remove(port)
+		assert options['port_reset_lines'][port][0].startswith('boot')
+		return uwf_flash.DeviceResult(port, 0, None, 0.01, plan.write_bytes)
+
+	monkeypatch.setattr(uwf_flash, 'flash_device_async', flash_device_async)
+	results, elapsed = uwf_flash.flash_devices_async(image, plan, ports, 115200, None, port_reset_lines(ports), 2)
+	assert [result.port for result in results] == ports
+	assert max(most) == 2
+
+def simulated(monkeypatch, simulator):
+	def init_processor(type, port, baudrate, **options):
+		assert options['reset_lines'] == ('boot1', 'reset1')
+		return uwf_simulator.init_simulated_processor(simulator)
+	monkeypatch.setattr(uwf_processor, 'init_processor', init_processor)
+
+def test_flash_device(monkeypatch, image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	simulated(monkeypatch, simulator)
+	plan = uwf_plan.compile_flash_plan(image)
+	options = {'port_reset_lines': {'/dev/ttyS1': ('boot1', 'reset1')}, 'pipeline_window': 4}
+	result = uwf_flash.flash_device(image, plan, '/dev/ttyS1', 115200, None, options)
+	assert result.error is None
+	assert result.exit_code == uwf_flash.EXIT_CODE_SUCCESS
+	assert result.bytes == plan.write_bytes
+	assert bytes(simulator.flash[:len(payload)]) == payload
+
+def test_flash_device_failure(monkeypatch, image):
+	def init_processor(type, port, baudrate, **options):
+		raise uwf_errors.DeviceError('enter_bootloader: no answer\n')
+	monkeypatch.setattr(uwf_processor, 'init_processor', init_processor)
+	plan = uwf_plan.compile_flash_plan(image)
+	result = uwf_flash.flash_device(image, plan, '/dev/ttyS1', 115200)
+	assert result.error == 'enter_bootloader: no answer\n'
+	assert result.exit_code == uwf_errors.DeviceError.exit_code
+	assert result.bytes == 0
+
+def test_audit_device(monkeypatch, image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	simulator.flash[:len(payload)] = payload
+	simulator.flash[0x1234] ^= 0xff
+	simulated(monkeypatch, simulator)
+	plan = uwf_plan.compile_flash_plan(image)
+	options = {'port_reset_lines': {'/dev/ttyS1': ('boot1', 'reset1')}}
+	result = uwf_flash.audit_device(image, plan, '/dev/ttyS1', 115200, None, options)
+	assert result.error is None
+	assert result.exit_code == errno.EIO
+	assert len(result.mismatches) == 1
+	assert result.device_id is not None
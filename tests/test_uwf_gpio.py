@@ -0,0 +1,25 @@
+"""
+GPIO line roles and the sysfs backend
+"""
+import uwf_gpio
+
+def test_sysfs_lines_by_role(tmp_path):
+	for name in ['boot1', 'reset1']:
+		(tmp_path / name).mkdir()
+		(tmp_path / name / 'value').write_text('1')
+
+	gpio = uwf_gpio.SysfsGpio(0, ('boot1', 'reset1'), str(tmp_path))
+	try:
+		gpio.set({uwf_gpio.GPIO_BT_BOOT_MODE: 0, uwf_gpio.GPIO_CARD_NRESET: 0})
+		assert (tmp_path / 'boot1' / 'value').read_text() == '0'
+		assert (tmp_path / 'reset1' / 'value').read_text() == '0'
+		gpio.set({uwf_gpio.GPIO_CARD_NRESET: 1})
+		assert (tmp_path / 'reset1' / 'value').read_text() == '1'
+	finally:
+		gpio.close()
+
+def test_fake_gpio_open():
+	gpio = uwf_gpio.open_gpio(uwf_gpio.GPIO_BACKEND_FAKE, 0, ('boot1', 'reset1'))
+	assert gpio.names == {uwf_gpio.GPIO_BT_BOOT_MODE: 'boot1', uwf_gpio.GPIO_CARD_NRESET: 'reset1'}
+	gpio.reset(0)
+	assert gpio.values == {uwf_gpio.GPIO_BT_BOOT_MODE: 0, uwf_gpio.GPIO_CARD_NRESET: 1}
@@ -0,0 +1,39 @@
+"""
+FlashJournal progress, resume and save failures
+"""
+import os
+import uwf_journal
+
+def test_resume(tmp_path):
+	path = uwf_journal.journal_path(str(tmp_path), '/dev/ttyS1')
+	journal = uwf_journal.FlashJournal(path, 'hash')
+	assert not journal.begin_erase()
+	journal.end_erase()
+	assert journal.begin_write(0x1000, 0x800) == 0x1000
+	journal.verified(0x1400)
+	journal.save()
+
+	resumed = uwf_journal.FlashJournal(path, 'hash', True)
+	assert resumed.begin_erase()
+	assert resumed.begin_write(0x1000, 0x800) == 0x1400
+
+	# Another image starts over
+	other = uwf_journal.FlashJournal(path, 'other', True)
+	assert not other.begin_erase()
+	assert other.begin_write(0x1000, 0x800) == 0x1000
+
+	resumed.finish()
+	assert not os.path.exists(path)
+
+def test_save_failure_is_reported_once(tmp_path, capsys):
+	# The journal directory cannot be created below a file
+	blocker = tmp_path / 'file'
+	blocker.write_bytes(b'')
+	journal = uwf_journal.FlashJournal(uwf_journal.journal_path(str(blocker), '/dev/ttyS1'), 'hash')
+	journal.begin_write(0, 0x100)
+	journal.save()
+	journal.save()
+	journal.finish()
+
+	assert isinstance(journal.save_error, OSError)
+	assert capsys.readouterr().err.count('uwf_journal: warning') == 1
@@ -0,0 +1,75 @@
+"""
+Compiles flash plans from hand-built UWF images
+"""
+import struct
+import pytest
+
+import uwf_plan
+import uwf_image
+
+SECTOR_SIZE = 0x1000
+BANK_SIZE = 0x100000
+
+def section(command, data):
+	return command.encode('utf-8') + b'\x00' + struct.pack('<I', len(data)) + data
+
+def header():
+	return (section('T', b'BL65') +
+		section('G', struct.pack('<BIBIB', 0, 0, 1, BANK_SIZE, 1)) +
+		section('S', b'\x00\x00') +
+		section('M', struct.pack('<II', BANK_SIZE // SECTOR_SIZE, SECTOR_SIZE)))
+
+def erase(start, size):
+	return section('E', struct.pack('<II', start, size))
+
+def write(offset, payload):
+	return section('W', struct.pack('<II', offset, 0) + payload)
+
+def compile_plan(tmp_path, data, **options):
+	path = tmp_path / 'image.uwf'
+	path.write_bytes(data)
+	with uwf_image.UwfImage(str(path)) as image:
+		assert image.validate() is None
+		return uwf_plan.compile_flash_plan(image, **options)
+
+def test_plan(tmp_path):
+	payload = bytes(range(256)) * 20
+	plan = compile_plan(tmp_path, header() + erase(0, 0x2000) + write(0, payload) + section('U', b'\x00'))
+	assert not plan.errors
+	assert not plan.warnings
+	assert plan.erase_ranges == [uwf_plan.EraseRange(0, 0x2000)]
+	assert plan.write_bytes == len(payload)
+	assert plan.write_packets == uwf_plan.blocks(len(payload), 252)
+	assert plan.checksum(0, 0x2000) == sum(payload) + 0xff * (0x2000 - len(payload))
+
+def test_unknown_sections_are_skipped(tmp_path):
+	data = header() + section('X', b'\x01\x02') + section('S', b'\x00') + erase(0, 0x1000) + write(0, b'\x00' * 16)
+	plan = compile_plan(tmp_path, data)
+	assert not plan.errors
+	assert len(plan.warnings) == 2
+	assert "'X'" in plan.warnings[0]
+
+@pytest.mark.parametrize('data, error', [
+	(erase(0, 0x1000) + header() + write(0, b'\x00'), 'Erase before target platform'),
+	(header() + write(0, b'\x00'), 'Write before erase'),
+	(header() + erase(0x800, 0x1000) + write(0x800, b'\x00'), 'not sector aligned'),
+	(header() + erase(0, BANK_SIZE) + write(0, b'\x00'), 'outside the bank'),
+	(header() + erase(0, 0x1000) + write(0x1000, b'\x00'), 'not covered by an erase'),
+	(header() + erase(0, 0x1000) + write(0, b'\x00' * 16) + write(8, b'\x00'), 'overlaps an earlier write'),
+	(header() + erase(0, 0x1000), 'No write sections'),
+])
+def test_plan_errors(tmp_path, data, error):
+	plan = compile_plan(tmp_path, data)
+	assert any(error in e for e in plan.errors)
+
+def test_enhanced_estimate(tmp_path):
+	data = header() + erase(0, 0x20000) + write(0, b'\x00' * 0x20000)
+	legacy = compile_plan(tmp_path, data)
+	enhanced = compile_plan(tmp_path, data, write_block_size=8192, enhanced_mode=True)
+
+	# 64 KiB erases and long writes need far fewer round trips
+	assert enhanced.erase_packets == 2
+	assert legacy.erase_packets == 0x20
+	assert enhanced.round_trips() < legacy.round_trips() // 10
+	assert enhanced.estimate_seconds(1000000) < legacy.estimate_seconds(115200)
+	assert '64 KiB erases' in enhanced.describe_estimate(1000000)
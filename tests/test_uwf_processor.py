@@ -0,0 +1,374 @@
+"""
+Drives UwfProcessor and AsyncUwfProcessor against uwf_simulator
+"""
+import os
+import random
+import asyncio
+import pytest
+
+pytest.importorskip('serial')
+
+import uwf_gpio
+import uwf_plan
+import uwf_image
+import uwf_errors
+import uwf_link
+import uwf_journal
+import uwf_simulator
+from uwf_processor import BT_BOOTLOADER_MODE
+from uwf_processor import BT_FIRMWARE_MODE
+from uwf_processor import ENHANCED_BAUDRATE
+from uwf_processor import ENHANCED_WRITE_BLOCK_SIZE
+from uwf_processor import LEGACY_WRITE_BLOCK_SIZE
+from ig60_bl654_uwf_processor import AsyncIg60Bl654UwfProcessor
+
+TIME_SCALE = 0.001
+PTY_TIME_SCALE = 0.02
+
+@pytest.fixture
+def payload():
+	return bytes(random.Random(1).getrandbits(8) for i in range(0x6000))
+
+@pytest.fixture
+def image(tmp_path, payload):
+	path = tmp_path / 'image.uwf'
+	path.write_bytes(uwf_simulator.build_image(payload))
+	with uwf_image.UwfImage(str(path)) as image:
+		yield image
+
+def init_processor(simulator, image, **options):
+	processor = uwf_simulator.init_simulated_processor(simulator)
+	processor.plan = uwf_plan.compile_flash_plan(image)
+	for name, value in options.items():
+		setattr(processor, name, value)
+	return processor
+
+def flash(simulator, image, **options):
+	processor = init_processor(simulator, image, **options)
+	try:
+		processor.process_image(image)
+	finally:
+		processor.process_reboot()
+	return processor
+
+def flashed(simulator, payload):
+	return bytes(simulator.flash[:len(payload)]) == payload
+
+def test_legacy(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	processor = flash(simulator, image)
+	assert not processor.enhanced_mode
+	assert flashed(simulator, payload)
+
+def test_enhanced(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	processor = flash(simulator, image)
+	assert processor.enhanced_mode
+	assert processor.write_block_size == ENHANCED_WRITE_BLOCK_SIZE
+	assert processor.ser.baudrate == ENHANCED_BAUDRATE
+	assert flashed(simulator, payload)
+
+@pytest.mark.parametrize('version', [uwf_simulator.VERSION_LEGACY, uwf_simulator.VERSION_ENHANCED])
+@pytest.mark.parametrize('options', [{'pipeline_window': 4}, {'adaptive_verify': True}])
+def test_pipelined(image, payload, version, options):
+	simulator = uwf_simulator.SimulatedBootloader(version, time_scale=TIME_SCALE)
+	flash(simulator, image, **options)
+	assert flashed(simulator, payload)
+
+@pytest.mark.parametrize('options', [{}, {'pipeline_window': 4}])
+def test_verify_failure_is_erased_and_rewritten(image, payload, options):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE, verify_error_rate=0.02, seed=3)
+	flash(simulator, image, section_retries=10, **options)
+	assert simulator.errors > 0
+	assert simulator.overwrites == 0
+	assert flashed(simulator, payload)
+
+@pytest.mark.parametrize('options', [{}, {'pipeline_window': 4}, {'adaptive_verify': True}])
+@pytest.mark.parametrize('seed', range(3))
+def test_rewrites_stay_within_nwrite(image, payload, options, seed):
+	# Refused data blocks leave the rest of their window programmed
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE, data_error_rate=0.1, seed=seed)
+	try:
+		flash(simulator, image, section_retries=10, **options)
+	except uwf_errors.FlashError:
+		pass
+	assert simulator.errors > 0
+	assert simulator.overwrites == 0
+
+def test_section_handlers_block(image):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	processor = init_processor(simulator, image)
+	try:
+		assert processor.process_command_target_platform(uwf_simulator.SIMULATED_PLATFORM_ID) is None
+		assert processor.synchronized
+		assert processor.enhanced_mode
+		assert processor.process_bootloader_version() == uwf_simulator.VERSION_ENHANCED
+	finally:
+		processor.process_reboot()
+
+def test_differential(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	flash(simulator, image)
+	simulator.reset_stats()
+
+	# The flash already holds the image: nothing is erased or written again
+	flash(simulator, image, differential=True)
+	assert simulator.erases == 0
+	assert simulator.writes == 0
+	assert flashed(simulator, payload)
+
+def test_resume(tmp_path, image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	processor = init_processor(simulator, image, journal_dir=str(tmp_path), verify_write_limit=2)
+
+	# Pull the cable halfway through the writes
+	write_to_comm = processor.write_to_comm
+	exchanges = []
+	def interrupted(data, resp_size):
+		exchanges.append(data)
+		if len(exchanges) == 100:
+			raise IOError('cable pulled')
+		return write_to_comm(data, resp_size)
+	processor.write_to_comm = interrupted
+
+	with pytest.raises(IOError):
+		processor.process_image(image)
+	processor.close()
+	path = uwf_journal.journal_path(str(tmp_path), processor.port)
+	assert os.path.exists(path)
+
+	# The same simulator keeps the port name and so the journal
+	simulator.reset_stats()
+	flash(simulator, image, journal_dir=str(tmp_path), resume=True)
+	assert simulator.erases == 0
+	assert 0 < simulator.writes < len(payload) // processor.write_block_size
+	assert flashed(simulator, payload)
+	assert not os.path.exists(path)
+
+def test_journal_only_kept_when_asked(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	processor = flash(simulator, image)
+	assert processor.journal.path is None
+	assert flashed(simulator, payload)
+
+def test_journal_that_cannot_be_written(tmp_path, image, payload):
+	blocker = tmp_path / 'file'
+	blocker.write_bytes(b'')
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	processor = flash(simulator, image, journal_dir=str(blocker), verify_write_limit=2)
+	assert processor.journal.save_error is not None
+	assert flashed(simulator, payload)
+
+def test_negotiate(tmp_path, image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	processor = flash(simulator, image, negotiate=True)
+	assert processor.enhanced_mode
+	assert processor.ser.baudrate == ENHANCED_BAUDRATE
+	assert processor.write_block_size == ENHANCED_WRITE_BLOCK_SIZE
+	assert processor.probed_ranges
+	assert flashed(simulator, payload)
+
+def test_negotiate_smaller_writes(tmp_path, image, payload):
+	# 8 KiB data frames get corrupted; 1 Mbaud is fine with the default write length
+	link_cache = uwf_link.LinkCache(str(tmp_path / 'link.json'))
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE, frame_limit=1000)
+	processor = flash(simulator, image, negotiate=True, link_cache=link_cache)
+	assert processor.failed_links == {(ENHANCED_BAUDRATE, ENHANCED_WRITE_BLOCK_SIZE)}
+	assert processor.ser.baudrate == ENHANCED_BAUDRATE
+	assert processor.write_block_size == LEGACY_WRITE_BLOCK_SIZE
+	assert flashed(simulator, payload)
+
+	# The cached pair is probed first
+	processor = flash(simulator, image, negotiate=True, link_cache=link_cache)
+	assert not processor.failed_links
+	assert processor.write_block_size == LEGACY_WRITE_BLOCK_SIZE
+	assert flashed(simulator, payload)
+
+def test_negotiate_slower_baudrate(image, payload):
+	# Nothing above the port's baudrate gets through
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE, max_baudrate=115200)
+	processor = flash(simulator, image, negotiate=True)
+	assert not processor.legacy_link
+	assert processor.ser.baudrate == 115200
+	assert processor.write_block_size == ENHANCED_WRITE_BLOCK_SIZE
+	assert flashed(simulator, payload)
+
+class FixedWriteLenBootloader(uwf_simulator.SimulatedBootloader):
+	"""
+	Refuses every write length setting
+	"""
+	def setting(self, option, value):
+		if option == uwf_simulator.FUP_OPTION_CURRENT_WRITE_LEN_BYTES:
+			return self.fail(0)
+		return super().setting(option, value)
+
+def test_negotiate_falls_back_to_legacy(image, payload):
+	simulator = FixedWriteLenBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	processor = flash(simulator, image, negotiate=True)
+	assert processor.legacy_link
+	assert not processor.enhanced_mode
+	assert processor.write_block_size == LEGACY_WRITE_BLOCK_SIZE
+	assert flashed(simulator, payload)
+
+def test_negotiate_erases_probed_flash(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	flash(simulator, image)
+	simulator.reset_stats()
+
+	# The probes wrote over current sectors, which are erased and written again
+	processor = flash(simulator, image, differential=True, negotiate=True)
+	assert simulator.erases > 0
+	assert processor.current_sectors
+	assert flashed(simulator, payload)
+
+def test_negotiate_fallback_without_retries(image):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE, max_baudrate=115200)
+	with pytest.raises(uwf_errors.LinkError):
+		flash(simulator, image, negotiate=True, section_retries=0)
+
+def test_audit(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	simulator.flash[:len(payload)] = payload
+	simulator.flash[0x2345] ^= 0x01
+
+	processor = init_processor(simulator, image)
+	try:
+		mismatches = processor.audit_image(image)
+	finally:
+		processor.process_reboot()
+	assert len(mismatches) == 1
+	start, end = mismatches[0]
+	assert start <= 0x2345 < end
+	assert simulator.writes == 0
+	assert simulator.erases == 0
+
+def test_audit_clean(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=TIME_SCALE)
+	simulator.flash[:len(payload)] = payload
+	processor = init_processor(simulator, image)
+	try:
+		assert processor.audit_image(image) == []
+	finally:
+		processor.process_reboot()
+
+def test_gpio_sequence(image):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=TIME_SCALE)
+	processor = init_processor(simulator, image)
+	gpio = processor.gpio
+	assert isinstance(gpio, uwf_gpio.FakeGpio)
+	processor.process_reboot()
+
+	changes = [values for when, values in gpio.log]
+	assert changes == [
+		{uwf_gpio.GPIO_BT_BOOT_MODE: BT_BOOTLOADER_MODE, uwf_gpio.GPIO_CARD_NRESET: 0},
+		{uwf_gpio.GPIO_CARD_NRESET: 1},
+		{uwf_gpio.GPIO_BT_BOOT_MODE: BT_FIRMWARE_MODE, uwf_gpio.GPIO_CARD_NRESET: 0},
+		{uwf_gpio.GPIO_CARD_NRESET: 1},
+	]
+	# Reset is held low for at least the pulse, and the lines are released after the reboot
+	assert gpio.log[1][0] - gpio.log[0][0] >= uwf_gpio.GPIO_RESET_PULSE_SEC
+	assert gpio.log[3][0] - gpio.log[2][0] >= uwf_gpio.GPIO_RESET_PULSE_SEC
+	assert gpio.closed
+	assert processor.gpio is None
+	assert not simulator.in_bootloader
+
+async def flash_async(simulator, link, image, type=None, **options):
+	processor = await uwf_simulator.init_simulated_async_processor(simulator, link, type)
+	processor.plan = uwf_plan.compile_flash_plan(image)
+	for name, value in options.items():
+		setattr(processor, name, value)
+	try:
+		await processor.process_image(image)
+	finally:
+		await processor.process_reboot()
+	return processor
+
+@pytest.mark.parametrize('version, options', [
+	(uwf_simulator.VERSION_LEGACY, {}),
+	(uwf_simulator.VERSION_LEGACY, {'pipeline_window': 4}),
+	(uwf_simulator.VERSION_ENHANCED, {'adaptive_verify': True}),
+	(uwf_simulator.VERSION_ENHANCED, {'negotiate': True}),
+])
+def test_async(image, payload, version, options):
+	simulator = uwf_simulator.SimulatedBootloader(version, time_scale=PTY_TIME_SCALE)
+	link = uwf_simulator.SimulatedPty(simulator)
+	try:
+		processor = asyncio.run(flash_async(simulator, link, image, **options))
+	finally:
+		link.close()
+	assert processor.enhanced_mode == (version == uwf_simulator.VERSION_ENHANCED)
+	assert flashed(simulator, payload)
+
+def test_async_section_handlers_are_awaited(image):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=PTY_TIME_SCALE)
+	link = uwf_simulator.SimulatedPty(simulator)
+
+	async def sync():
+		processor = await uwf_simulator.init_simulated_async_processor(simulator, link)
+		try:
+			error = await processor.process_command_target_platform(uwf_simulator.SIMULATED_PLATFORM_ID)
+			return error, processor.synchronized
+		finally:
+			await processor.process_reboot()
+
+	try:
+		assert asyncio.run(sync()) == (None, True)
+	finally:
+		link.close()
+
+def test_async_keeps_the_loop_running(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=PTY_TIME_SCALE)
+	link = uwf_simulator.SimulatedPty(simulator)
+
+	async def flash_and_tick():
+		ticks = []
+		async def tick():
+			while True:
+				ticks.append(None)
+				await asyncio.sleep(0.001)
+		ticker = asyncio.ensure_future(tick())
+		await flash_async(simulator, link, image)
+		ticker.cancel()
+		return len(ticks)
+
+	try:
+		ticks = asyncio.run(flash_and_tick())
+	finally:
+		link.close()
+	assert ticks > 10
+	assert flashed(simulator, payload)
+
+def test_async_ig60(image, payload):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_ENHANCED, time_scale=PTY_TIME_SCALE)
+	link = uwf_simulator.SimulatedPty(simulator)
+	try:
+		asyncio.run(flash_async(simulator, link, image, uwf_simulator.DEVICE_TYPE_IG60))
+	finally:
+		link.close()
+	assert flashed(simulator, payload)
+	assert not simulator.in_bootloader
+
+def test_async_ig60_device_service_failure(image):
+	simulator = uwf_simulator.SimulatedBootloader(uwf_simulator.VERSION_LEGACY, time_scale=PTY_TIME_SCALE)
+	link = uwf_simulator.SimulatedPty(simulator)
+	ports = []
+
+	class FailingProcessor(uwf_simulator.simulated_processor_class(AsyncIg60Bl654UwfProcessor, simulator, link)):
+		def open_port(self, baudrate):
+			ports.append(super().open_port(baudrate))
+			return ports[-1]
+
+		def connect_device_service(self):
+			raise RuntimeError('DeviceService is not running')
+
+	async def init():
+		return FailingProcessor(link.port, 115200)
+
+	try:
+		# The DBus error comes through, and the port is closed
+		with pytest.raises(RuntimeError, match='DeviceService'):
+			asyncio.run(init())
+	finally:
+		link.close()
+	assert len(ports) == 1
+	assert not ports[0].is_open
@@ -0,0 +1,65 @@
+"""
+Compares the frames of ProtocolEncoder with the commands as the processor built them before
+"""
+import struct
+import random
+import pytest
+
+import uwf_checksum
+import uwf_protocol
+
+@pytest.fixture
+def encoder():
+	return uwf_protocol.ProtocolEncoder()
+
+@pytest.mark.parametrize('offset, size', [(0x0, 1), (0x1000, 252), (0xfffff, 255)])
+def test_write(encoder, offset, size):
+	assert bytes(encoder.write(offset, size, False)) == b'w' + struct.pack('<I', offset) + struct.pack('B', size)
+
+@pytest.mark.parametrize('offset, size', [(0x1000, 252), (0x2000, 0x1234), (0x3000, 8192)])
+def test_write_enhanced(encoder, offset, size):
+	frame = encoder.write(offset, size, True)
+	assert bytes(frame) == b'w' + struct.pack('<I', offset) + struct.pack('B', size & 0xff) + struct.pack('B', (size & 0xff00) >> 8)
+
+@pytest.mark.parametrize('size', [1, 252, 8192, 8193])
+def test_data(encoder, size):
+	data = bytes(random.Random(size).getrandbits(8) for i in range(size))
+	checksum = sum(data)
+	frame, full_checksum = encoder.data(data)
+	assert full_checksum == checksum
+	assert bytes(frame) == b'd' + data + bytes([checksum & 0xff])
+
+	# A given checksum is sent as is
+	frame, full_checksum = encoder.data(data, checksum + 1)
+	assert full_checksum == checksum + 1
+	assert bytes(frame)[-1] == (checksum + 1) & 0xff
+
+def test_data_reuses_the_frame(encoder):
+	# A shorter block after a longer one sends only its own bytes
+	encoder.data(b'\x11' * 300)
+	frame, checksum = encoder.data(b'\x22' * 4)
+	assert bytes(frame) == b'd' + b'\x22' * 4 + bytes([0x88])
+	assert checksum == uwf_checksum.checksum(b'\x22' * 4)
+
+def test_verify(encoder):
+	frame = encoder.verify(0x1000, 2016, 0x12345)
+	assert bytes(frame) == b'v' + struct.pack('<I', 0x1000) + struct.pack('<I', 2016) + struct.pack('<I', 0x12345)
+
+def test_erase(encoder):
+	assert bytes(encoder.erase(0x3000)) == b'e' + struct.pack('<I', 0x3000)
+	assert bytes(encoder.erase(0x10000, 2)) == b'e' + struct.pack('<I', 0x10000) + struct.pack('<I', 2)
+
+	# The plain erase frame is untouched by the one with a length
+	assert bytes(encoder.erase(0x4000)) == b'e' + struct.pack('<I', 0x4000)
+
+@pytest.mark.parametrize('fup_option, set_value', [(0x0000, 0x2), (0x0005, 0xa), (0x0102, 0x1ff)])
+def test_setting(encoder, fup_option, set_value):
+	expected = bytearray(b's')
+	expected.append(fup_option & 0xff)
+	expected.append((fup_option & 0xff00) >> 8)
+	expected.append(set_value & 0xff)
+	expected += b'\x00\x00\x00'
+	assert bytes(encoder.setting(fup_option, set_value)) == bytes(expected)
+
+def test_platform(encoder):
+	assert encoder.platform(b'BL65') == b'pBL65'